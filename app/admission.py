@@ -0,0 +1,141 @@
+"""
+Admission control: per route group in-flight limits with a bounded wait queue
+
+A request of a limited group runs once fewer than `limit` requests of the group are in flight.
+Otherwise it waits in a FIFO queue of at most `queue_size` requests for up to ADMISSION_MAX_WAIT_MS.
+A request finding the queue full, or still waiting at the deadline, is answered with a 503 right
+away instead of piling up on the DB pool.
+"""
+import asyncio
+import json
+from collections import deque
+from http import HTTPStatus
+from typing import Deque, Dict, Optional, Tuple
+
+from starlette.responses import Response
+
+from app.settings import BASE_ROUTE, ADMISSION_CONTROL_ENABLED, ADMISSION_MAX_WAIT_MS, ADMISSION_RETRY_AFTER, \
+    ADMISSION_LOGIN_LIMIT, ADMISSION_LOGIN_QUEUE, ADMISSION_USER_CREATION_LIMIT, ADMISSION_USER_CREATION_QUEUE, \
+    ADMISSION_PERMISSION_READ_LIMIT, ADMISSION_PERMISSION_READ_QUEUE
+
+
+class ConcurrencyLimiter:
+    """
+    Admits at most `limit` holders at a time, a released slot is handed to the longest waiting request
+    """
+
+    def __init__(self, limit: int, queue_size: int, max_wait: float):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        """
+        Take a slot, False when the request has to be shed
+        """
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            self.shed += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over as the deadline passed, it is ours
+                self.admitted += 1
+                return True
+            # release() may have popped the cancelled waiter while wait_for awaited its cancellation
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            self.shed += 1
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just before the request went away
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+        self.admitted += 1
+        return True
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # the slot passes to the waiter, in_flight stays the same
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+# group -> (method, path) of the routes it limits, paths are matched exactly
+ROUTE_GROUPS: Dict[str, Tuple[Tuple[str, str], ...]] = {
+    "login": (("GET", f"{BASE_ROUTE}/login"), ("PATCH", f"{BASE_ROUTE}/password")),
+    "user_creation": (("POST", f"{BASE_ROUTE}/"), ("POST", f"{BASE_ROUTE}/global"), ("POST", f"{BASE_ROUTE}/bulk")),
+    "permission_reads": (("GET", f"{BASE_ROUTE}/permission/entity"),),
+}
+
+
+def init_limiters() -> Dict[str, ConcurrencyLimiter]:
+    max_wait = ADMISSION_MAX_WAIT_MS / 1000
+    return {
+        "login": ConcurrencyLimiter(ADMISSION_LOGIN_LIMIT, ADMISSION_LOGIN_QUEUE, max_wait),
+        "user_creation": ConcurrencyLimiter(ADMISSION_USER_CREATION_LIMIT, ADMISSION_USER_CREATION_QUEUE, max_wait),
+        "permission_reads": ConcurrencyLimiter(
+            ADMISSION_PERMISSION_READ_LIMIT, ADMISSION_PERMISSION_READ_QUEUE, max_wait
+        ),
+    }
+
+
+limiters = init_limiters()
+_route_limiters = {route: limiters[group] for group, routes in ROUTE_GROUPS.items() for route in routes}
+
+SHED_RESPONSE_BODY = json.dumps(
+    {"success": False, "message": "service overloaded, retry later", "data": {}}, separators=(",", ":")
+).encode("utf-8")
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying the limiter of the request's route group, other routes pass through
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def _limiter(self, scope) -> Optional[ConcurrencyLimiter]:
+        if scope["type"] != "http" or not ADMISSION_CONTROL_ENABLED:
+            return None
+        limiter = _route_limiters.get((scope["method"], scope["path"]))
+        return limiter if limiter is not None and limiter.limit > 0 else None
+
+    async def __call__(self, scope, receive, send):
+        limiter = self._limiter(scope)
+        if limiter is None:
+            return await self.app(scope, receive, send)
+
+        if not await limiter.acquire():
+            response = Response(
+                content=SHED_RESPONSE_BODY, status_code=HTTPStatus.SERVICE_UNAVAILABLE, media_type="application/json",
+                headers={"Retry-After": str(ADMISSION_RETRY_AFTER)}
+            )
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
@@ -0,0 +1,93 @@
+import math
+from hashlib import blake2b
+from typing import AsyncIterator, Dict, Iterable, List, Tuple
+
+from app.settings import EMAIL_FILTER_ENABLED, EMAIL_FILTER_CAPACITY, EMAIL_FILTER_ERROR_RATE
+
+
+class BloomFilter:
+    """
+    Bloom filter sized for `capacity` items at a false positive rate of `error_rate`
+
+    The bit positions of an item are derived by double hashing a single 128 bit blake2b digest.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _hashes(self, item: str) -> Tuple[int, int]:
+        digest = blake2b(item.encode("utf-8"), digest_size=16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+    def add(self, item: str):
+        position, step = self._hashes(item)
+        bits, size = self._bits, self.size
+        for _ in range(self.hash_count):
+            position %= size
+            bits[position >> 3] |= 1 << (position & 7)
+            position += step
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        position, step = self._hashes(item)
+        bits, size = self._bits, self.size
+        for _ in range(self.hash_count):
+            position %= size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+            position += step
+        return True
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self._bits)
+
+    def expected_error_rate(self) -> float:
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+
+class EmailFilter:
+    """
+    Bloom filter of the known user emails, lets creations skip the existence query for new emails
+
+    Emails are compared lower cased, like the unique key on user_details.user_email. Until `load`
+    has streamed the whole column every email may exist. Users created by another worker aren't
+    added here, creations fall back to the DB when their insert hits the unique key.
+    """
+
+    def __init__(self, capacity: int, error_rate: float, enabled: bool = True):
+        self.enabled = enabled
+        self.ready = False
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.checks: Dict[str, int] = {"absent": 0, "maybe": 0}
+        self.false_positives = 0
+
+    def might_exist(self, email: str) -> bool:
+        if not (self.enabled and self.ready):
+            return True
+        maybe = email.lower() in self.bloom
+        self.checks["maybe" if maybe else "absent"] += 1
+        return maybe
+
+    def add(self, email: str):
+        if self.enabled:
+            self.bloom.add(email.lower())
+
+    def add_many(self, emails: Iterable[str]):
+        for email in emails:
+            self.add(email)
+
+    def record_false_positive(self):
+        if self.ready:
+            self.false_positives += 1
+
+    async def load(self, pages: AsyncIterator[List[str]]):
+        async for emails in pages:
+            self.add_many(emails)
+        self.ready = self.enabled
+
+
+email_filter = EmailFilter(EMAIL_FILTER_CAPACITY, EMAIL_FILTER_ERROR_RATE, enabled=EMAIL_FILTER_ENABLED)
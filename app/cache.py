@@ -0,0 +1,445 @@
+import asyncio
+import base64
+import json
+import logging
+import uuid
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Optional, Set, Tuple
+
+from app.permission_index import PermissionIndex
+from app.resp import RESPClient
+from app.settings import AUTH_TOKEN_CACHE_SIZE, AUTH_TOKEN_CACHE_TTL, ENTITY_PERMISSION_CACHE_SIZE, \
+    ENTITY_PERMISSION_CACHE_TTL, IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    Bounded in-process LRU cache whose entries expire after `ttl` seconds
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        if expires_at <= monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return entry[1] if entry else default
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class AuthTokenCache(TTLCache):
+    """
+    authentication token -> user details cache used by `login_required`
+
+    Keeps a reverse index of user_id -> tokens so that login and password
+    changes can evict every cached token of a user.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self._user_tokens: Dict[str, Set[str]] = {}
+
+    def set(self, key: str, value: dict):
+        super().set(key, value)
+        self._user_tokens.setdefault(value["user_id"], set()).add(key)
+        # entries pushed out by the LRU bound leave stale reverse index references behind,
+        # prune them once the index noticeably outgrows the cache itself
+        if len(self._user_tokens) > 2 * max(self.maxsize, 1):
+            self._prune_user_index()
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        value = super().pop(key, default)
+        if isinstance(value, dict):
+            tokens = self._user_tokens.get(value["user_id"])
+            if tokens:
+                tokens.discard(key)
+                if not tokens:
+                    del self._user_tokens[value["user_id"]]
+        return value
+
+    def evict_user(self, user_id: str):
+        for token in self._user_tokens.pop(user_id, set()):
+            self._data.pop(token, None)
+
+    def clear(self):
+        super().clear()
+        self._user_tokens.clear()
+
+    def _prune_user_index(self):
+        for user_id in list(self._user_tokens):
+            tokens = {token for token in self._user_tokens[user_id] if token in self._data}
+            if tokens:
+                self._user_tokens[user_id] = tokens
+            else:
+                del self._user_tokens[user_id]
+
+
+class VersionedCache(TTLCache):
+    """
+    TTL/LRU cache where every key carries a version counter
+
+    Writers bump the version of a key whenever the underlying rows change. Values are
+    stored together with the version they were read at, so a value loaded concurrently
+    with a bump is never served afterwards.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self._versions: Dict[Hashable, int] = {}
+        self._bumped_at: Dict[Hashable, float] = {}
+
+    def version(self, key: Hashable) -> int:
+        return self._versions.get(key, 0)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is not None:
+            expires_at, (version, value) = entry
+            if expires_at > monotonic() and version == self.version(key):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, version: Optional[int] = None):
+        version = self.version(key) if version is None else version
+        if version != self.version(key):
+            return
+        super().set(key, (version, value))
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return entry[1][1] if entry else default
+
+    def bump(self, key: Hashable) -> int:
+        version = self._versions[key] = self.version(key) + 1
+        self._bumped_at[key] = monotonic()
+        self._data.pop(key, None)
+        return version
+
+    def changed_within(self, key: Hashable, seconds: float) -> bool:
+        bumped_at = self._bumped_at.get(key)
+        return bumped_at is not None and monotonic() - bumped_at < seconds
+
+
+class CacheBackend:
+    """
+    Storage shared by the workers behind the service caches, this base shares nothing
+    """
+
+    shared = False
+    available = True
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return None
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        pass
+
+    async def delete(self, *keys: str):
+        pass
+
+    async def publish(self, message: str):
+        pass
+
+
+class RESPCacheBackend(CacheBackend):
+    """
+    Cache entries and invalidation messages on a Redis protocol server
+    """
+
+    shared = True
+
+    def __init__(self, client: RESPClient, prefix: str = "user_service:cache"):
+        self.client = client
+        self.prefix = prefix
+        self.channel = f"{prefix}:invalidate"
+
+    @property
+    def available(self) -> bool:
+        return self.client.available
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.execute("GET", f"{self.prefix}:{key}")
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self.client.execute("SET", f"{self.prefix}:{key}", value, "PX", int(ttl * 1000))
+
+    async def delete(self, *keys: str):
+        await self.client.execute("DEL", *(f"{self.prefix}:{key}" for key in keys))
+
+    async def publish(self, message: str):
+        await self.client.execute("PUBLISH", self.channel, message)
+
+
+# tags the invalidation messages of this process so that it skips its own
+WORKER_ID = uuid.uuid4().hex
+
+
+class SharedCache:
+    """
+    Cache used by the services layer: an in-process LRU in front of the configured CacheBackend
+
+    Local misses are read from the backend and kept locally, writes go to both. Invalidations
+    are broadcast to the other workers, which drop their local copy. Backend failures are
+    logged and the cache keeps working in-process.
+    """
+
+    def __init__(self, name: str, local: TTLCache, encode: Callable[[Any], bytes], decode: Callable[[bytes], Any]):
+        self.name = name
+        self.local = local
+        self.encode = encode
+        self.decode = decode
+        self.backend = CacheBackend()
+
+    async def _backend_call(self, operation: str, *args):
+        # an unreachable backend is skipped until its client retries the connection
+        if not self.backend.shared or not self.backend.available:
+            return None
+        try:
+            return await getattr(self.backend, operation)(*args)
+        except Exception as e:
+            logger.warning(f"{self.name} cache backend {operation} failed: {e}")
+            return None
+
+    async def _backend_set(self, key: Hashable, value: Any):
+        # values are only encoded when a worker can read them back
+        if self.backend.shared:
+            await self._backend_call("set", self._backend_key(key), self.encode(value), self.local.ttl)
+
+    def _backend_key(self, key: Hashable) -> str:
+        return f"{self.name}:{key}"
+
+    def _set_local(self, key: Hashable, value: Any):
+        self.local.set(key, value)
+
+    def _drop_local(self, key: Hashable):
+        self.local.pop(key)
+
+    async def get(self, key: Hashable, default: Any = None) -> Any:
+        value = self.local.get(key)
+        if value is not None or not self.backend.shared:
+            return default if value is None else value
+
+        raw = await self._backend_call("get", self._backend_key(key))
+        if raw is None:
+            return default
+        try:
+            value = self.decode(raw)
+        except (ValueError, KeyError, TypeError):
+            value = None
+        if value is None:
+            return default
+        self._set_local(key, value)
+        return value
+
+    async def set(self, key: Hashable, value: Any):
+        self._set_local(key, value)
+        await self._backend_set(key, value)
+
+    async def invalidate(self, key: Hashable):
+        self._drop_local(key)
+        await self._backend_call("delete", self._backend_key(key))
+        await self._backend_call("publish", f"{self.name}\t{WORKER_ID}\t{key}")
+
+    def handle_invalidation(self, key: str):
+        self._drop_local(key)
+
+    def stats(self) -> Dict[str, int]:
+        return self.local.stats()
+
+
+class SharedVersionedCache(SharedCache):
+    """
+    SharedCache over a VersionedCache, an invalidation bumps the key's version in every worker
+    """
+
+    local: VersionedCache
+
+    def _drop_local(self, key: Hashable):
+        self.local.bump(key)
+
+    def version(self, key: Hashable) -> int:
+        return self.local.version(key)
+
+    def changed_within(self, key: Hashable, seconds: float) -> bool:
+        return self.local.changed_within(key, seconds)
+
+    async def set(self, key: Hashable, value: Any, version: Optional[int] = None):
+        if version is not None and version != self.local.version(key):
+            return
+        await super().set(key, value)
+
+
+class SharedAuthTokenCache(SharedCache):
+    """
+    SharedCache over an AuthTokenCache, invalidations are per user and evict all their tokens
+
+    The backend keeps a user_id -> token entry next to every token entry, a user has at most
+    one opaque token at a time.
+    """
+
+    local: AuthTokenCache
+
+    async def set(self, key: str, value: dict):
+        await super().set(key, value)
+        await self._backend_call("set", self._backend_key(f"user:{value['user_id']}"), key, self.local.ttl)
+
+    async def invalidate_user(self, user_id: str):
+        self.local.evict_user(user_id)
+        user_key = self._backend_key(f"user:{user_id}")
+        token = await self._backend_call("get", user_key)
+        if token is not None:
+            await self._backend_call("delete", user_key, self._backend_key(token.decode("utf-8")))
+        await self._backend_call("publish", f"{self.name}\t{WORKER_ID}\t{user_id}")
+
+    async def replace_user_token(self, user_id: str, token: str, user: dict):
+        """
+        Write through a newly issued token, the user's previous tokens are evicted everywhere
+        """
+        await self.invalidate_user(user_id)
+        await self.set(token, user)
+
+    def handle_invalidation(self, key: str):
+        self.local.evict_user(key)
+
+
+def _encode_permissions(permissions: PermissionIndex) -> str:
+    return base64.b64encode(permissions.to_bits()).decode("ascii")
+
+
+def _decode_permissions(permissions: str) -> Optional[PermissionIndex]:
+    return PermissionIndex.from_bits(base64.b64decode(permissions))
+
+
+def _encode_user(user: dict) -> bytes:
+    return json.dumps({**user, "permissions": _encode_permissions(user["permissions"])}).encode("utf-8")
+
+
+def _decode_user(raw: bytes) -> Optional[dict]:
+    # entries referencing permission slots this worker hasn't loaded yet are treated as misses
+    user = json.loads(raw)
+    user["permissions"] = _decode_permissions(user["permissions"])
+    return user if user["permissions"] is not None else None
+
+
+def _encode_session_permissions(value: Tuple[bool, PermissionIndex]) -> bytes:
+    return json.dumps([value[0], _encode_permissions(value[1])]).encode("utf-8")
+
+
+def _decode_session_permissions(raw: bytes) -> Optional[Tuple[bool, PermissionIndex]]:
+    active, permissions = json.loads(raw)
+    permissions = _decode_permissions(permissions)
+    return (active, permissions) if isinstance(active, bool) and permissions is not None else None
+
+
+def _encode_json(value: Any) -> bytes:
+    return json.dumps(value).encode("utf-8")
+
+
+def _encode_stored_response(value: dict) -> bytes:
+    return _encode_json({**value, "body": base64.b64encode(value["body"]).decode("ascii")})
+
+
+def _decode_stored_response(raw: bytes) -> dict:
+    value = json.loads(raw)
+    value["body"] = base64.b64decode(value["body"])
+    return value
+
+
+auth_token_cache = SharedAuthTokenCache(
+    "auth_token", AuthTokenCache(maxsize=AUTH_TOKEN_CACHE_SIZE, ttl=AUTH_TOKEN_CACHE_TTL), _encode_user, _decode_user
+)
+# user_id -> (active, PermissionIndex) for signed session tokens, invalidated whenever the user's permissions change
+session_permission_cache = SharedVersionedCache(
+    "session_permission", VersionedCache(maxsize=AUTH_TOKEN_CACHE_SIZE, ttl=AUTH_TOKEN_CACHE_TTL),
+    _encode_session_permissions, _decode_session_permissions
+)
+entity_permission_cache = SharedVersionedCache(
+    "entity_permission", VersionedCache(maxsize=ENTITY_PERMISSION_CACHE_SIZE, ttl=ENTITY_PERMISSION_CACHE_TTL),
+    _encode_json, json.loads
+)
+# caller, route and Idempotency-Key -> stored response, see app.core.idempotent
+idempotency_cache = SharedCache(
+    "idempotency", TTLCache(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL),
+    _encode_stored_response, _decode_stored_response
+)
+# entity_id -> (cached permission sets, their ETag), an entry is used while the cache returns the same sets
+entity_permission_etags = TTLCache(maxsize=ENTITY_PERMISSION_CACHE_SIZE, ttl=ENTITY_PERMISSION_CACHE_TTL)
+SHARED_CACHES = {
+    cache.name: cache
+    for cache in (auth_token_cache, session_permission_cache, entity_permission_cache, idempotency_cache)
+}
+
+
+def use_cache_backend(backend: CacheBackend):
+    for cache in SHARED_CACHES.values():
+        cache.backend = backend
+
+
+async def consume_invalidations(client: RESPClient, channel: str):
+    """
+    Apply the invalidations published by other workers, runs until cancelled
+
+    Messages may have been missed while the subscription was down, local entries are
+    dropped whenever it is re-established.
+    """
+    reconnecting = False
+    while True:
+        try:
+            async for message in client.subscribe(channel):
+                if reconnecting:
+                    for cache in SHARED_CACHES.values():
+                        cache.local.clear()
+                    reconnecting = False
+                name, worker_id, key = message.decode("utf-8").split("\t", 2)
+                cache = SHARED_CACHES.get(name)
+                if cache is not None and worker_id != WORKER_ID:
+                    cache.handle_invalidation(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"cache invalidation subscription lost: {e}")
+        reconnecting = True
+        await asyncio.sleep(client.retry_interval)
@@ -0,0 +1,5 @@
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+# endpoint placeholder used when a permission grants read/write on a whole submodule
+WILDCARD_ENDPOINT = "*"
@@ -1,48 +1,193 @@
-import json
+import asyncio
 import logging
+import math
+import time
 
 from functools import wraps
+from hashlib import sha256
 from http import HTTPStatus
+from typing import Dict, List
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 
-from app.enums import UserTypes
+from app.cache import auth_token_cache, session_permission_cache, idempotency_cache
+from app.negotiation import response_format
+from app.permission_index import PermissionIndex, EMPTY_PERMISSION_INDEX
 from app.services.user_details import UserDetails
-from app.settings import MODULE_NAME, CUSTOM_HEADER_RPC_SECRET_KEY
-from app.utils import _is_valid_uuid, standard_response_generator
+from app.session_tokens import decode_session_token, is_signed_token
+from app.settings import MODULE_NAME, CUSTOM_HEADER_RPC_SECRET_KEY, LOGIN_THROTTLE_TRUST_FORWARDED_FOR, \
+    TOKEN_WRITE_BEHIND, TOKEN_INTROSPECTION_TTL, DB_POOL_MAX_SIZE, IDEMPOTENCY_WAIT_TIMEOUT
+from app.throttle import login_throttle
+from app.write_behind import token_write_behind
+from app.utils import _is_valid_uuid, standard_response_generator, gather_limited
 
 logger = logging.getLogger(__name__)
 
 
+def is_rpc_request(request: Request) -> bool:
+    rpc_secret_key = CUSTOM_HEADER_RPC_SECRET_KEY
+    return bool(rpc_secret_key) and request.headers.get("RPC_SECRET_KEY") == rpc_secret_key
+
+
+def client_ip(request: Request):
+    if LOGIN_THROTTLE_TRUST_FORWARDED_FOR:
+        forwarded_for = request.headers.get("x-forwarded-for")
+        if forwarded_for:
+            return forwarded_for.split(",")[0].strip()
+    return request.client.host if request.client else None
+
+
+async def admit_password_check(request: Request, user_email: str):
+    """
+    Run the login throttle ahead of a password check, returns a 429 response when the attempt is shed
+    """
+    retry_after = await login_throttle.acquire(client_ip(request), user_email)
+    if not retry_after:
+        return None
+    return standard_response_generator(
+        success=False, message="too many login attempts, retry later", http_status=HTTPStatus.TOO_MANY_REQUESTS,
+        headers={"Retry-After": str(math.ceil(retry_after))}
+    )
+
+
+async def authenticate_token(app: FastAPI, auth_token: str):
+    """
+    Resolve an authentication token to the logged in user, None if the token is invalid
+
+    Signed session tokens are verified locally, opaque UUID tokens are looked up in user_details.
+    """
+    if is_signed_token(auth_token):
+        return await _authenticate_signed_token(app, auth_token)
+    if not _is_valid_uuid(auth_token):
+        return None
+
+    user = await auth_token_cache.get(auth_token)
+    if user is None:
+        # tokens still buffered by the write-behind mode aren't in user_details yet
+        pending_user_id = token_write_behind.pending_user(auth_token) if TOKEN_WRITE_BEHIND else None
+        core_filters = None if pending_user_id else {"authentication_token": auth_token}
+        _, _, _, user = await UserDetails(db=app.db, read_db=app.read_db, logger=app.logger).fetch_user_details(
+            user_id=pending_user_id, core_filters=core_filters, with_permissions=True
+        )
+        if not user or not isinstance(user, dict):
+            return None
+        if TOKEN_WRITE_BEHIND and token_write_behind.pending_token(user["user_id"]) not in (None, auth_token):
+            return None
+        await auth_token_cache.set(auth_token, user)
+    return user
+
+
+async def _authenticate_signed_token(app: FastAPI, auth_token: str):
+    claims = decode_session_token(auth_token)
+    if not claims:
+        return None
+
+    # permissions are loaded once per user whatever version the token was issued with, entries are
+    # invalidated when the user's permissions change. inactive users are cached too, so their tokens
+    # are rejected without a query until the entry expires
+    session = await session_permission_cache.get(claims["uid"])
+    if session is None:
+        version = session_permission_cache.version(claims["uid"])
+        success, _, http_status, user = await UserDetails(
+            db=app.db, read_db=app.read_db, logger=app.logger
+        ).fetch_user_details(user_id=claims["uid"], with_permissions=True)
+        if not success and http_status != HTTPStatus.NOT_FOUND:
+            return None
+        session = (True, user["permissions"]) if success else (False, EMPTY_PERMISSION_INDEX)
+        await session_permission_cache.set(claims["uid"], session, version=version)
+
+    active, permissions = session
+    if not active:
+        return None
+    return {"user_id": claims["uid"], "is_chief_admin": claims["adm"], "permissions": permissions}
+
+
+def _introspection_ttl(auth_token: str) -> int:
+    # a signed token must not be cached past its expiry
+    claims = decode_session_token(auth_token) if is_signed_token(auth_token) else None
+    if not claims:
+        return TOKEN_INTROSPECTION_TTL
+    return max(0, min(TOKEN_INTROSPECTION_TTL, int(claims["exp"] / 1000 - time.time())))
+
+
+async def introspect_tokens(app: FastAPI, auth_tokens: List[str]) -> List[dict]:
+    """
+    Resolve many authentication tokens through the lookup used by login_required, in the order provided
+
+    Permissions are expanded to {module: {submodule: {endpoint: [methods]}}}, every result carries
+    the seconds the caller may cache it for.
+    """
+    unique_tokens = list(dict.fromkeys(auth_tokens))
+    users = await gather_limited((authenticate_token(app, token) for token in unique_tokens), DB_POOL_MAX_SIZE)
+
+    results = dict()
+    for auth_token, user in zip(unique_tokens, users):
+        result = {"authentication_token": auth_token, "valid": bool(user), "ttl": _introspection_ttl(auth_token)}
+        if user:
+            permissions: PermissionIndex = user.get("permissions") or EMPTY_PERMISSION_INDEX
+            result.update({
+                "user_id": user["user_id"],
+                "is_chief_admin": bool(user.get("is_chief_admin")),
+                "permission_version": permissions.fingerprint(),
+                "permissions": permissions.to_grants()
+            })
+        results[auth_token] = result
+    return [results[auth_token] for auth_token in auth_tokens]
+
+
+async def _authenticate_request(request: Request):
+    auth_token = request.headers.get("authenticationtoken", None)
+    if not auth_token:
+        return standard_response_generator(
+            success=False, message="authentication token is required", http_status=HTTPStatus.UNAUTHORIZED
+        )
+    user = await authenticate_token(request.app, auth_token)
+    if not user:
+        return standard_response_generator(
+            success=False, message="invalid authentication token", http_status=HTTPStatus.UNAUTHORIZED
+        )
+
+    # request.app.user is replaced by every request, code running after an await reads request.state.user
+    request.app.user = request.state.user = user
+
+
 def login_required(func):
     """
     Decorator to check if user is logged in
 
-    If enviroment variable ENV:
-    - local : Then user if fetched from redis or user service.
-    - production : Then X-CG-User if required in headers.
+    The user is resolved from the `authenticationtoken` header and set on `request.app.user`.
     """
 
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        request: FastAPI = kwargs.get("request")
+        request: Request = kwargs.get("request")
         logger.info("authentication.login_required")
 
-        headers_dict = dict(request.headers)
-        auth_token = request.headers.get("authenticationtoken", None)
-        if not (auth_token and _is_valid_uuid(auth_token)):
-            return standard_response_generator(
-                success=False, message="authentication token is required", http_status=HTTPStatus.UNAUTHORIZED
-            )
-        _, _, _, user = await UserDetails(db=request.app.db, logger=request.app.logger).fetch_user_details(
-            core_filters={"authentication_token = '%s'": auth_token}
-        )
-        if not user or not isinstance(user, dict):
-            return standard_response_generator(
-                success=False, message="invalid authentication token", http_status=HTTPStatus.UNAUTHORIZED
-            )
+        error_response = await _authenticate_request(request)
+        if error_response:
+            return error_response
+
+        return await func(*args, **kwargs)
+
+    return wrapper
 
-        request.app.user = user
+
+def rpc_or_login_required(func):
+    """
+    Decorator allowing internal RPC calls carrying RPC_SECRET_KEY, other callers must be logged in
+    """
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        request: Request = kwargs.get("request")
+        logger.info("authentication.rpc_or_login_required")
+
+        if is_rpc_request(request):
+            request.app.user = request.state.user = {}
+        else:
+            error_response = await _authenticate_request(request)
+            if error_response:
+                return error_response
 
         return await func(*args, **kwargs)
 
@@ -50,45 +195,107 @@ def login_required(func):
 
 
 def verify_permission(submodules: list = [], exempt_methods: list = []):
+    submodules = tuple(submodules)
+    exempt_methods = frozenset(exempt_methods)
+
     def innerfunc(func):
         @wraps(func)
         async def innerfunc1(*args, **kwargs):
             logger.info("cg_auth.verify_permission")
             request: Request = kwargs.get("request")
-            # request.
 
             # required for cases where verify permission is used to allow only internal RPC calls
             user = request.app.user if hasattr(request.app, "user") else {}
 
             is_chief_admin = user.get("is_chief_admin")
-            module_name = MODULE_NAME
-            route = request.scope.get("route")
-            endpoint_name = route.name
-
+            endpoint_name = request.scope.get("route").name
             method = request.method
-            rpc_secret_key = CUSTOM_HEADER_RPC_SECRET_KEY
-            service_permissions = user.get("permissions", {}).get(module_name, {})
-            verified = False
+            permissions: PermissionIndex = user.get("permissions") or EMPTY_PERMISSION_INDEX
 
-            if rpc_secret_key and request.headers.get("RPC_SECRET_KEY") == rpc_secret_key:
+            if is_rpc_request(request):
                 verified = True
             elif is_chief_admin:
                 verified = True
             else:
-                for submodule in submodules:
-                    submodule_permissions = service_permissions.get(submodule, {})
-                    if method in (
-                        submodule_permissions.get("read", {}).get(endpoint_name, [])
-                        + submodule_permissions.get("write", {}).get(endpoint_name, [])
-                        + exempt_methods
-                    ):
-                        verified = True
-                        break
+                verified = bool(submodules) and (
+                    method in exempt_methods or permissions.allows(MODULE_NAME, submodules, endpoint_name, method)
+                )
 
             if not verified:
-                return standard_response_generator(request, False, "Module access not permitted", HTTPStatus.FORBIDDEN)
+                return standard_response_generator(False, "Module access not permitted", HTTPStatus.FORBIDDEN)
             return await func(*args, **kwargs)
 
         return innerfunc1
 
     return innerfunc
+
+
+# idempotency keys of requests being processed by this worker -> future resolved once they completed
+_idempotency_in_flight: Dict[str, asyncio.Future] = {}
+
+
+def _replay_response(stored: dict, fingerprint: str):
+    if stored["fingerprint"] != fingerprint:
+        return standard_response_generator(
+            False, "Idempotency-Key was already used for a different request", HTTPStatus.UNPROCESSABLE_ENTITY
+        )
+    return Response(
+        content=stored["body"], status_code=stored["status_code"], media_type=stored["media_type"],
+        headers={"Idempotent-Replayed": "true"}
+    )
+
+
+def idempotent(func):
+    """
+    Decorator replaying the stored response when a request is retried with the same `Idempotency-Key` header
+
+    Keys are scoped to the caller and the route, responses are stored for IDEMPOTENCY_TTL seconds
+    except server errors, which the retry executes again. A duplicate arriving while the first request
+    is in flight on this worker waits for its response instead of running concurrently.
+    The wrapped handler runs after awaits, it takes the caller from `request.state.user`.
+    """
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        request: Request = kwargs.get("request")
+        idempotency_key = request.headers.get("idempotency-key")
+        if not idempotency_key:
+            return await func(*args, **kwargs)
+
+        user = getattr(request.state, "user", {})
+        key = f"{user.get('user_id', '')}:{request.method}:{request.url.path}:{response_format.get()}:{idempotency_key}"
+        fingerprint = sha256(await request.body()).hexdigest()
+
+        while True:
+            in_flight = _idempotency_in_flight.get(key)
+            if in_flight is not None:
+                try:
+                    await asyncio.wait_for(asyncio.shield(in_flight), IDEMPOTENCY_WAIT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return standard_response_generator(
+                        False, "a request with this Idempotency-Key is still in progress", HTTPStatus.CONFLICT
+                    )
+                continue
+
+            stored = await idempotency_cache.get(key)
+            if stored is not None:
+                return _replay_response(stored, fingerprint)
+            # the first request may have started or completed while the backend was read
+            if key not in _idempotency_in_flight and idempotency_cache.local.get(key) is None:
+                break
+
+        _idempotency_in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await func(*args, **kwargs)
+            if response.status_code < HTTPStatus.INTERNAL_SERVER_ERROR:
+                await idempotency_cache.set(key, {
+                    "fingerprint": fingerprint,
+                    "status_code": response.status_code,
+                    "media_type": response.media_type,
+                    "body": bytes(response.body)
+                })
+            return response
+        finally:
+            _idempotency_in_flight.pop(key).set_result(None)
+
+    return wrapper
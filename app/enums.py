@@ -6,6 +6,8 @@ class Tables:
     user_details = "user_details"
     entity_permissions = "entity_permissions"
     user_entity_details = "user_entity_details"
+    session_revocations = "session_revocations"
+    permission_slots = "permission_slots"
 
 
 class UserTypes(str, Enum):
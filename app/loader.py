@@ -0,0 +1,77 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class BatchLoader:
+    """
+    DataLoader style request coalescer
+
+    Concurrent `load(key)` calls arriving within `window` seconds are merged into a single
+    `batch_fn(keys)` call, which must return a dict of key -> value. Keys missing from the
+    result resolve to None, a failing batch raises in every caller of that batch.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]],
+        window: float,
+        max_batch_size: int,
+    ):
+        self.batch_fn = batch_fn
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.loads = 0
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # running batches, referenced until done so they can't be garbage collected mid-flight
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def load(self, key: Hashable) -> Any:
+        self.loads += 1
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._pending[key] = loop.create_future()
+            if len(self._pending) >= self.max_batch_size:
+                self._dispatch()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._dispatch)
+        # shield so that one cancelled caller doesn't cancel the result for the others
+        return await asyncio.shield(future)
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            self.batches += 1
+            task = asyncio.ensure_future(self._run_batch(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._batch_done)
+
+    def _batch_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"batch loader task failed due to {task.exception()}")
+
+    async def _run_batch(self, pending: Dict[Hashable, asyncio.Future]):
+        try:
+            results = await self.batch_fn(list(pending))
+        except asyncio.CancelledError:
+            for future in pending.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for key, future in pending.items():
+            if not future.done():
+                future.set_result(results.get(key))
@@ -0,0 +1,317 @@
+import bisect
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from databases import Database
+
+from app.cache import auth_token_cache, entity_permission_cache, session_permission_cache, idempotency_cache
+from app.admission import limiters
+from app.bloom import email_filter
+from app.throttle import login_throttle
+from app.write_behind import token_write_behind
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{key}="{str(value)}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.items())
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_format_labels(key)} {value}" for key, value in self._values.items())
+        return lines
+
+
+class Histogram:
+    """
+    Prometheus style histogram, observations are only bucketed when they're recorded
+    """
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # labels -> [per bucket counts (+Inf last), sum, count]
+        self._values: Dict[Tuple[Tuple[str, str], ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.items())
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_format_labels(key, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class CallbackMetric:
+    """
+    Counter or gauge whose labelled values are read from a callback at scrape time
+    """
+
+    def __init__(self, name: str, description: str, metric_type: str, callback: Callable[[], Dict[tuple, float]]):
+        self.name = name
+        self.description = description
+        self.metric_type = metric_type
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(f"{self.name}{_format_labels(key)} {value}" for key, value in self.callback().items())
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class RequestTimings:
+    """
+    Time spent per component while serving the current request
+    """
+
+    __slots__ = ("db_time", "db_queries", "hash_time", "serialize_time")
+
+    def __init__(self):
+        self.db_time = 0.0
+        self.db_queries = 0
+        self.hash_time = 0.0
+        self.serialize_time = 0.0
+
+    def server_timing(self, total: float) -> str:
+        return (
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.db_queries} queries", '
+            f"hash;dur={self.hash_time * 1000:.2f}, "
+            f"serialize;dur={self.serialize_time * 1000:.2f}, "
+            f"total;dur={total * 1000:.2f}"
+        )
+
+
+request_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+registry = Registry()
+request_duration = registry.register(Histogram(
+    "user_service_request_duration_seconds", "Request latency by route"
+))
+request_db_duration = registry.register(Histogram(
+    "user_service_request_db_duration_seconds", "Time spent in MySQL per request by route"
+))
+request_db_queries = registry.register(Counter(
+    "user_service_request_db_queries_total", "MySQL queries issued by route"
+))
+request_serialize_duration = registry.register(Histogram(
+    "user_service_request_serialize_duration_seconds", "Response encoding time per request by route"
+))
+db_query_duration = registry.register(Histogram(
+    "user_service_db_query_duration_seconds", "MySQL query latency by operation"
+))
+password_hash_duration = registry.register(Histogram(
+    "user_service_password_hash_duration_seconds", "Password hashing and verification latency",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+))
+
+CACHES = {
+    "auth_token": auth_token_cache,
+    "entity_permission": entity_permission_cache,
+    "session_permission": session_permission_cache,
+    "idempotency": idempotency_cache,
+}
+
+
+def _cache_stat(stat: str) -> Callable[[], Dict[tuple, float]]:
+    return lambda: {(("cache", name),): cache.stats()[stat] for name, cache in CACHES.items()}
+
+
+registry.register(CallbackMetric(
+    "user_service_cache_hits_total", "In-process cache hits", "counter", _cache_stat("hits")
+))
+registry.register(CallbackMetric(
+    "user_service_cache_misses_total", "In-process cache misses", "counter", _cache_stat("misses")
+))
+registry.register(CallbackMetric(
+    "user_service_cache_entries", "In-process cache size", "gauge", _cache_stat("size")
+))
+registry.register(CallbackMetric(
+    "user_service_login_attempts_admitted_total", "Login attempts let through the throttle", "counter",
+    lambda: {(): login_throttle.admitted}
+))
+registry.register(CallbackMetric(
+    "user_service_login_attempts_shed_total", "Login attempts rejected before any DB or hashing work", "counter",
+    lambda: {(("bucket", bucket),): count for bucket, count in login_throttle.shed.items()}
+))
+registry.register(CallbackMetric(
+    "user_service_admission_admitted_total", "Requests admitted by the route group limits", "counter",
+    lambda: {(("group", group),): limiter.admitted for group, limiter in limiters.items()}
+))
+registry.register(CallbackMetric(
+    "user_service_admission_shed_total", "Requests answered with a 503 by the route group limits", "counter",
+    lambda: {(("group", group),): limiter.shed for group, limiter in limiters.items()}
+))
+registry.register(CallbackMetric(
+    "user_service_admission_in_flight", "Requests in flight per limited route group", "gauge",
+    lambda: {(("group", group),): limiter.in_flight for group, limiter in limiters.items()}
+))
+registry.register(CallbackMetric(
+    "user_service_admission_queued", "Requests waiting for a slot per limited route group", "gauge",
+    lambda: {(("group", group),): limiter.queued for group, limiter in limiters.items()}
+))
+registry.register(CallbackMetric(
+    "user_service_email_filter_checks_total", "Email existence checks answered by the email filter", "counter",
+    lambda: {(("result", result),): count for result, count in email_filter.checks.items()}
+))
+registry.register(CallbackMetric(
+    "user_service_email_filter_false_positives_total", "Emails the email filter may have seen but MySQL hasn't",
+    "counter", lambda: {(): email_filter.false_positives}
+))
+registry.register(CallbackMetric(
+    "user_service_email_filter_entries", "Emails added to the email filter", "gauge",
+    lambda: {(): email_filter.bloom.count}
+))
+registry.register(CallbackMetric(
+    "user_service_token_write_behind_flushed_total", "Authentication tokens stored by write-behind flushes", "counter",
+    lambda: {(): token_write_behind.flushed}
+))
+registry.register(CallbackMetric(
+    "user_service_token_write_behind_flushes_total", "Write-behind flushes of authentication tokens", "counter",
+    lambda: {(): token_write_behind.flushes}
+))
+
+
+def record_hash_time(elapsed: float):
+    password_hash_duration.observe(elapsed)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.hash_time += elapsed
+
+
+def record_serialize_time(elapsed: float):
+    timings = request_timings.get()
+    if timings is not None:
+        timings.serialize_time += elapsed
+
+
+def _record_db_time(operation: str, elapsed: float):
+    db_query_duration.observe(elapsed, operation=operation)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.db_time += elapsed
+        timings.db_queries += 1
+
+
+class InstrumentedDatabase(Database):
+    """
+    databases.Database recording query count and latency per request and per operation
+    """
+
+    async def fetch_all(self, query, values=None):
+        start = perf_counter()
+        try:
+            return await super().fetch_all(query, values)
+        finally:
+            _record_db_time("fetch_all", perf_counter() - start)
+
+    async def fetch_one(self, query, values=None):
+        start = perf_counter()
+        try:
+            return await super().fetch_one(query, values)
+        finally:
+            _record_db_time("fetch_one", perf_counter() - start)
+
+    async def fetch_val(self, query, values=None, column=0):
+        start = perf_counter()
+        try:
+            return await super().fetch_val(query, values, column)
+        finally:
+            _record_db_time("fetch_val", perf_counter() - start)
+
+    async def execute(self, query, values=None):
+        start = perf_counter()
+        try:
+            return await super().execute(query, values)
+        finally:
+            _record_db_time("execute", perf_counter() - start)
+
+    async def execute_many(self, query, values):
+        start = perf_counter()
+        try:
+            return await super().execute_many(query, values)
+        finally:
+            _record_db_time("execute_many", perf_counter() - start)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording per route latency and component timings
+
+    The component timings of the request are also returned in a `Server-Timing` header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = RequestTimings()
+        token = request_timings.set(timings)
+        start = perf_counter()
+        status_code = 500
+
+        async def send_with_timings(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                header = timings.server_timing(perf_counter() - start).encode("latin-1")
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header)]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            request_timings.reset(token)
+            route = scope.get("route")
+            labels = {"method": scope["method"], "route": route.path if route else "unmatched"}
+            request_duration.observe(perf_counter() - start, status=status_code, **labels)
+            request_db_duration.observe(timings.db_time, **labels)
+            request_db_queries.inc(timings.db_queries, **labels)
+            request_serialize_duration.observe(timings.serialize_time, **labels)
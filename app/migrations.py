@@ -0,0 +1,209 @@
+"""
+Versioned schema migrations and query plan verification
+
+    python -m app.migrations upgrade   apply pending migrations from /migrations and backfill
+                                       permission_bits of permission sets created before 0003
+    python -m app.migrations status    list applied and pending migrations
+    python -m app.migrations explain   EXPLAIN every query shape the services issue,
+                                       exits non-zero if any of them scans a full table
+"""
+import asyncio
+import logging
+import sys
+import uuid
+from pathlib import Path
+from typing import List, Tuple
+
+from databases import Database
+
+from app.settings import MYSQL_CONFIG
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent.parent / "migrations"
+MIGRATIONS_TABLE = "schema_migrations"
+BACKFILL_BATCH_SIZE = 500
+# MySQL has no ADD KEY IF NOT EXISTS, a migration adding an index that already exists skips that statement
+DUPLICATE_KEY_NAME = 1061
+
+
+def database_url() -> str:
+    return (
+        f"mysql+aiomysql://{MYSQL_CONFIG['USER']}:{MYSQL_CONFIG['PASSWORD']}"
+        f"@{MYSQL_CONFIG['HOST']}:{MYSQL_CONFIG['PORT']}/{MYSQL_CONFIG['NAME']}"
+    )
+
+
+def available_migrations() -> List[Tuple[str, Path]]:
+    return sorted((path.stem, path) for path in MIGRATIONS_DIR.glob("*.sql"))
+
+
+def split_statements(sql: str) -> List[str]:
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+def is_duplicate_key_name(exc: Exception) -> bool:
+    # aiomysql raises the pymysql error itself, other drivers wrap it in `orig`
+    orig = getattr(exc, "orig", None) or exc
+    return bool(getattr(orig, "args", None)) and orig.args[0] == DUPLICATE_KEY_NAME
+
+
+async def backfill_permission_bits(db: Database) -> int:
+    """
+    Fill in the permission_bits of legacy permission sets, the authentication path doesn't write them
+    """
+    from app.services.permissions import EntityPermissions
+
+    entity_permissions = EntityPermissions(db=db, logger=logger)
+    await entity_permissions.load_permission_slots()
+    return await entity_permissions.backfill_permission_bits(BACKFILL_BATCH_SIZE)
+
+
+async def applied_migrations(db: Database) -> List[str]:
+    await db.execute(
+        f"CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} ("
+        "version VARCHAR(255) NOT NULL PRIMARY KEY, "
+        "applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+    )
+    rows = await db.fetch_all(f"SELECT version FROM {MIGRATIONS_TABLE} ORDER BY version;")
+    return [row["version"] for row in rows]
+
+
+async def apply_migrations(db: Database) -> List[str]:
+    """
+    Apply pending migrations in version order, returns the applied versions
+
+    MySQL commits DDL implicitly, every migration is recorded right after its statements ran. Statements
+    adding an index that already exists are skipped, so indexes can be added to databases created before
+    the migrations existed.
+    """
+    applied = set(await applied_migrations(db))
+    newly_applied = list()
+    for version, path in available_migrations():
+        if version in applied:
+            continue
+        logger.info("applying migration %s", version)
+        for statement in split_statements(path.read_text()):
+            try:
+                await db.execute(statement)
+            except Exception as e:
+                if not is_duplicate_key_name(e):
+                    raise
+                logger.info("index of migration %s already exists, skipped: %s", version, " ".join(statement.split()))
+        await db.execute(f"INSERT INTO {MIGRATIONS_TABLE} (version) VALUES (:version);", {"version": version})
+        newly_applied.append(version)
+    return newly_applied
+
+
+class QueryRecorder:
+    """
+    Stand-in database that records the statements a service issues and returns no rows
+    """
+
+    def __init__(self):
+        self.queries: List[Tuple[str, dict]] = []
+
+    async def fetch_all(self, query, values=None):
+        self.queries.append((query, values or {}))
+        return []
+
+    async def fetch_one(self, query, values=None):
+        self.queries.append((query, values or {}))
+        return None
+
+    async def execute(self, query, values=None):
+        self.queries.append((query, values or {}))
+
+
+async def service_query_shapes() -> List[Tuple[str, dict]]:
+    """
+    Collect the read and update statements of the services
+
+    Reads run against a QueryRecorder. Updates are only built, their service methods journal tokens
+    and publish cache invalidations.
+    """
+    from app.services.authentication import Login
+    from app.services.permissions import EntityPermissions
+    from app.services.user_details import UserCreation, UserDetails
+
+    recorder = QueryRecorder()
+    user_details = UserDetails(db=recorder, logger=logger)
+    user_creation = UserCreation(db=recorder, logger=logger)
+    entity_permissions = EntityPermissions(db=recorder, logger=logger)
+    login = Login(db=recorder, logger=logger)
+
+    await user_details.fetch_user_details(core_filters={"authentication_token": str(uuid.UUID(int=0))})
+    await user_details.fetch_user_permissions("0000000000")
+    await user_details.fetch_users(user_ids=["0000000000", "0000000001"], user_emails=["a@example.com"])
+    await user_details.fetch_entity_users("000000000000", "teacher", True, after="0000000000")
+    await user_details.fetch_recently_active_users(100)
+    await user_details.fetch_user_entity_ids(["0000000000", "0000000001"])
+    await user_creation.validate_user_already_exist("a@example.com", use_email_filter=False)
+    await user_creation.fetch_existing_users(["a@example.com", "b@example.com"], use_email_filter=False)
+    async for _ in user_creation.iterate_user_emails(100):
+        pass
+    await entity_permissions._query_entity_permissions("000000000000")
+    await entity_permissions._query_entity_permissions("000000000000", {"permission_name": "teacher"})
+    await entity_permissions.load_permission_slots(after=1)
+    await entity_permissions.fetch_entity_user_permissions("000000000000", permission_id="00000000")
+    await entity_permissions.fetch_entity_user_permissions("000000000000", user_ids=["0000000000", "0000000001"])
+    await login.validate_authentication("a@example.com", "")
+    await login.load_session_revocations()
+
+    recorder.queries.append(Login.authentication_token_update("0000000000", str(uuid.UUID(int=0))))
+    recorder.queries.append(
+        Login.authentication_tokens_flush({"0000000000": str(uuid.UUID(int=0)), "0000000001": str(uuid.UUID(int=1))})
+    )
+
+    # inserts can't scan, everything else is checked
+    return [(query, values) for query, values in recorder.queries if not query.lstrip().upper().startswith("INSERT")]
+
+
+async def verify_query_plans(db: Database) -> List[str]:
+    """
+    EXPLAIN every service query shape, returns a description of each full table scan found
+    """
+    failures = list()
+    for query, values in await service_query_shapes():
+        for row in await db.fetch_all(f"EXPLAIN {query}", values):
+            plan = row._mapping
+            if str(plan.get("type")).upper() == "ALL":
+                failures.append(f"full scan of {plan.get('table')} in: {' '.join(query.split())}")
+    return failures
+
+
+COMMANDS = ("upgrade", "status", "explain")
+
+
+async def _run(command: str) -> int:
+    if command not in COMMANDS:
+        print(__doc__)
+        return 2
+
+    db = Database(database_url())
+    await db.connect()
+    try:
+        if command == "upgrade":
+            for version in await apply_migrations(db):
+                print(f"applied {version}")
+            print(f"backfilled permission_bits of {await backfill_permission_bits(db)} permission sets")
+        elif command == "status":
+            applied = set(await applied_migrations(db))
+            for version, _ in available_migrations():
+                print(f"{'applied' if version in applied else 'pending'} {version}")
+        elif command == "explain":
+            failures = await verify_query_plans(db)
+            for failure in failures:
+                print(failure)
+            if failures:
+                return 1
+            print("no full table scans found")
+    finally:
+        await db.disconnect()
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_run(sys.argv[1] if len(sys.argv) > 1 else "")))
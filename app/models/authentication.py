@@ -2,6 +2,8 @@ from typing import List, Optional
 
 from pydantic import BaseModel, field_validator, model_validator, EmailStr
 
+from app.settings import TOKEN_INTROSPECTION_MAX_BATCH
+
 
 class ValidateLogin(BaseModel):
     user_email: EmailStr
@@ -18,3 +20,14 @@ class UpdatePassword(BaseModel):
         if v.old_password == v.new_password:
             raise ValueError("old and new passwords should be different")
         return v
+
+
+class IntrospectTokens(BaseModel):
+    authentication_tokens: List[str]
+
+    @field_validator("authentication_tokens")
+    def validate_batch_size(cls, val: List[str]) -> List[str]:
+        assert len(val) > 0, "at least one authentication token is required"
+        assert len(val) <= TOKEN_INTROSPECTION_MAX_BATCH, \
+            f"at most {TOKEN_INTROSPECTION_MAX_BATCH} tokens can be introspected at once"
+        return val
@@ -2,6 +2,8 @@ from typing import List, Optional, Dict
 
 from pydantic import BaseModel, field_validator, model_validator, EmailStr, Field
 
+from app.settings import PERMISSION_REASSIGN_MAX_USERS
+
 
 class GetEntityPermissions(BaseModel):
     entity_id: str
@@ -36,3 +38,24 @@ class CreateEntityPermission(BaseModel):
     def permissions_cannot_be_empty(cls, val: Dict) -> Dict:
         assert len(val) > 0, "permission set cannot be empty"
         return val
+
+
+class ReassignEntityPermission(BaseModel):
+    """
+    Users to move to `permission_name`, either listed by id or all users holding `from_permission_name`
+    """
+
+    entity_id: str
+    permission_name: str
+    user_ids: List[str] = []
+    from_permission_name: Optional[str] = None
+
+    @model_validator(mode="after")
+    def one_user_selection_must_be_present(cls, v):
+        if bool(v.user_ids) == bool(v.from_permission_name):
+            raise ValueError("either user_ids or from_permission_name must be provided")
+        if len(v.user_ids) > PERMISSION_REASSIGN_MAX_USERS:
+            raise ValueError(f"at most {PERMISSION_REASSIGN_MAX_USERS} users can be reassigned at once")
+        if v.from_permission_name == v.permission_name:
+            raise ValueError("from_permission_name must differ from permission_name")
+        return v
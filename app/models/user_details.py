@@ -3,6 +3,7 @@ from typing import List, Optional
 from pydantic import BaseModel, field_validator, model_validator, EmailStr, Field
 
 from app.enums import UserRoles
+from app.settings import USER_LOOKUP_MAX_BATCH, USER_LIST_MAX_PAGE_SIZE
 
 
 class UserCreationModel(BaseModel):
@@ -17,3 +18,35 @@ class UserCreationModel(BaseModel):
 class GlobalUserCreationModel(BaseModel):
     user_name: str
     user_email: EmailStr
+
+
+class UserLookupModel(BaseModel):
+    user_ids: List[str] = []
+    user_emails: List[EmailStr] = []
+
+    @model_validator(mode="after")
+    def validate_batch_size(cls, v):
+        total = len(v.user_ids) + len(v.user_emails)
+        if not total:
+            raise ValueError("at least one user id or email is required")
+        if total > USER_LOOKUP_MAX_BATCH:
+            raise ValueError(f"at most {USER_LOOKUP_MAX_BATCH} users can be looked up at once")
+        return v
+
+
+class SingleUserLookupModel(BaseModel):
+    user_id: str
+
+
+class ListEntityUsersModel(BaseModel):
+    entity_id: str = Field(min_length=12, max_length=12)
+    user_role: Optional[UserRoles] = None
+    active: Optional[bool] = True
+    after: Optional[str] = None
+    limit: int = Field(default=100, ge=1, le=USER_LIST_MAX_PAGE_SIZE)
+
+
+class ExportEntityUsersModel(BaseModel):
+    entity_id: str = Field(min_length=12, max_length=12)
+    user_role: Optional[UserRoles] = None
+    active: Optional[bool] = True
@@ -0,0 +1,132 @@
+"""
+MessagePack content negotiation, JSON stays the default
+
+Requests with a `Content-Type: application/msgpack` body are decoded before validation and
+responses are encoded as MessagePack when the `Accept` header prefers it. Both are limited to
+internal RPC callers passing RPC_SECRET_KEY and need the optional msgpack package, every other
+request and response is JSON.
+"""
+from contextvars import ContextVar
+from typing import Any, Callable, Coroutine, Optional
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = frozenset((MSGPACK_MEDIA_TYPE, "application/x-msgpack"))
+
+# format of the responses built by standard_response_generator, set per request by NegotiatedRoute
+response_format: ContextVar[str] = ContextVar("response_format", default="json")
+
+
+def msgpack_available() -> bool:
+    return msgpack is not None
+
+
+def _media_type(value: str) -> str:
+    return value.split(";", 1)[0].strip().lower()
+
+
+def is_msgpack(content_type: Optional[str]) -> bool:
+    return msgpack is not None and bool(content_type) and _media_type(content_type) in MSGPACK_MEDIA_TYPES
+
+
+def prefers_msgpack(accept: Optional[str]) -> bool:
+    """
+    True when the Accept header lists MessagePack with a quality at least that of an explicit JSON range
+    """
+    if msgpack is None or not accept:
+        return False
+    msgpack_quality, json_quality = 0.0, 0.0
+    for media_range in accept.split(","):
+        media_type, *params = media_range.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        media_type = media_type.strip().lower()
+        if media_type in MSGPACK_MEDIA_TYPES:
+            msgpack_quality = max(msgpack_quality, quality)
+        elif media_type == JSON_MEDIA_TYPE:
+            json_quality = max(json_quality, quality)
+    return msgpack_quality > 0 and msgpack_quality >= json_quality
+
+
+def packb(content: Any) -> bytes:
+    return msgpack.packb(content, use_bin_type=True)
+
+
+def unpackb(body: bytes) -> Any:
+    return msgpack.unpackb(body, raw=False)
+
+
+def representation_etag(etag: str) -> str:
+    """
+    ETags are per representation, the MessagePack encoding of a resource gets its own
+    """
+    if response_format.get() == "msgpack":
+        return f'{etag[:-1]}-msgpack"'
+    return etag
+
+
+class MsgPackRequest(Request):
+    """
+    Request whose body is MessagePack, `json()` returns the decoded body
+
+    The Content-Type header is dropped from the scope, FastAPI then reads the body through `json()`.
+    Handlers reading the raw body get the media type from `request_content_type`.
+    """
+
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = unpackb(await self.body())
+        return self._json
+
+
+def request_content_type(request: Request) -> Optional[str]:
+    """
+    Content-Type the body is read as, MessagePack for the bodies NegotiatedRoute decodes and JSON for
+    MessagePack bodies of other callers, which no route accepts
+    """
+    if isinstance(request, MsgPackRequest):
+        return MSGPACK_MEDIA_TYPE
+    content_type = request.headers.get("content-type")
+    return JSON_MEDIA_TYPE if is_msgpack(content_type) else content_type
+
+
+class NegotiatedRoute(APIRoute):
+    """
+    APIRoute decoding MessagePack request bodies and choosing the response format from `Accept`, for RPC callers
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        # app.core imports this module, routes are only built once both are loaded
+        from app.core import is_rpc_request
+
+        route_handler = super().get_route_handler()
+
+        async def negotiated_route_handler(request: Request) -> Response:
+            rpc_request = is_rpc_request(request)
+            if rpc_request and is_msgpack(request.headers.get("content-type")):
+                scope = dict(request.scope)
+                scope["headers"] = [(name, value) for name, value in scope["headers"] if name != b"content-type"]
+                request = MsgPackRequest(scope, request.receive)
+
+            use_msgpack = rpc_request and prefers_msgpack(request.headers.get("accept"))
+            token = response_format.set("msgpack" if use_msgpack else "json")
+            try:
+                return await route_handler(request)
+            finally:
+                response_format.reset(token)
+
+        return negotiated_route_handler
@@ -0,0 +1,99 @@
+import asyncio
+import hashlib
+import hmac
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from app.metrics import record_hash_time
+from app.settings import PASSWORD_HASH_ALGORITHM, PBKDF2_ITERATIONS, SCRYPT_N, SCRYPT_R, SCRYPT_P, \
+    PASSWORD_HASH_WORKERS, PASSWORD_HASH_BULK_WORKERS
+from app.utils import get_passkey
+
+# hashlib's pbkdf2_hmac and scrypt release the GIL, so a thread pool keeps the event loop free
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_bulk_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_BULK_WORKERS, thread_name_prefix="password-hash-bulk")
+
+LEGACY_ALGORITHM = "sha256"
+
+
+def make_passkey(password: str, salt: str, algorithm: str = PASSWORD_HASH_ALGORITHM, **params) -> str:
+    """
+    Derive the stored passkey for a password
+
+    Passkeys are prefixed with the algorithm and its cost parameters, e.g.
+    `pbkdf2_sha256$600000$<hex>` or `scrypt$16384$8$1$<hex>`. The legacy algorithm
+    produces the bare salted SHA-256 hex digest.
+    """
+    if algorithm == LEGACY_ALGORITHM:
+        return get_passkey(password, salt)
+
+    password, salt = password.encode("utf-8"), salt.encode("utf-8")
+    if algorithm == "pbkdf2_sha256":
+        iterations = int(params.get("iterations", PBKDF2_ITERATIONS))
+        digest = hashlib.pbkdf2_hmac("sha256", password, salt, iterations)
+        return f"pbkdf2_sha256${iterations}${digest.hex()}"
+    if algorithm == "scrypt":
+        n, r, p = int(params.get("n", SCRYPT_N)), int(params.get("r", SCRYPT_R)), int(params.get("p", SCRYPT_P))
+        maxmem = 128 * r * (n + p + 2) + 1024 * 1024
+        digest = hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=maxmem, dklen=32)
+        return f"scrypt${n}${r}${p}${digest.hex()}"
+    raise ValueError(f"unsupported password hash algorithm {algorithm}")
+
+
+def parse_passkey(passkey: str):
+    """
+    Split a stored passkey into its algorithm and cost parameters
+    """
+    parts = passkey.split("$")
+    if len(parts) == 1:
+        return LEGACY_ALGORITHM, {}
+    if parts[0] == "pbkdf2_sha256" and len(parts) == 3:
+        return parts[0], {"iterations": int(parts[1])}
+    if parts[0] == "scrypt" and len(parts) == 5:
+        return parts[0], {"n": int(parts[1]), "r": int(parts[2]), "p": int(parts[3])}
+    raise ValueError("unrecognised passkey format")
+
+
+def verify_passkey(passkey: str, salt: str, password: str) -> bool:
+    try:
+        algorithm, params = parse_passkey(passkey)
+    except ValueError:
+        return False
+    return hmac.compare_digest(make_passkey(password, salt, algorithm, **params), passkey)
+
+
+def passkey_needs_rehash(passkey: str) -> bool:
+    """
+    True when the passkey was not derived with the currently configured algorithm and cost
+    """
+    try:
+        algorithm, params = parse_passkey(passkey)
+    except ValueError:
+        return True
+    if algorithm != PASSWORD_HASH_ALGORITHM:
+        return True
+    if algorithm == "pbkdf2_sha256":
+        return params["iterations"] != PBKDF2_ITERATIONS
+    if algorithm == "scrypt":
+        return (params["n"], params["r"], params["p"]) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return False
+
+
+async def hash_password(password: str, salt: str, bulk: bool = False) -> str:
+    """
+    Derive a passkey on the hashing pool, bulk imports pass `bulk` to use the pool kept apart from logins
+    """
+    start = perf_counter()
+    try:
+        executor = _bulk_executor if bulk else _executor
+        return await asyncio.get_running_loop().run_in_executor(executor, make_passkey, password, salt)
+    finally:
+        record_hash_time(perf_counter() - start)
+
+
+async def check_password(passkey: str, salt: str, password: str) -> bool:
+    start = perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, verify_passkey, passkey, salt, password)
+    finally:
+        record_hash_time(perf_counter() - start)
@@ -0,0 +1,187 @@
+import hashlib
+import struct
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from app.constants import READ_METHODS, WRITE_METHODS, WILDCARD_ENDPOINT
+
+PermissionKey = Tuple[str, str, str, str]
+# (module, submodule, endpoint), interned into a permission slot id
+SlotName = Tuple[str, str, str]
+
+# one bit per HTTP method in the permission masks
+METHOD_BITS = {method: 1 << index for index, method in enumerate(READ_METHODS + WRITE_METHODS)}
+
+
+def compile_permissions(permission_json: dict) -> FrozenSet[PermissionKey]:
+    """
+    Flatten a stored permission set into (module, submodule, endpoint, method) keys
+
+    Both shapes found in `permission_json` are supported:
+    - {module: {submodule: {"read": true, "write": false}}} grants the methods of
+      the access type on every endpoint of the submodule.
+    - {module: {submodule: {"read": {endpoint: [methods]}}}} grants the listed
+      methods on the listed endpoints only.
+    """
+    keys = set()
+    for module, submodules in permission_json.items():
+        if not isinstance(submodules, dict):
+            continue
+        for submodule, grants in submodules.items():
+            if not isinstance(grants, dict):
+                continue
+            for access, default_methods in (("read", READ_METHODS), ("write", WRITE_METHODS)):
+                grant = grants.get(access)
+                if grant is True:
+                    keys.update((module, submodule, WILDCARD_ENDPOINT, method) for method in default_methods)
+                elif isinstance(grant, dict):
+                    for endpoint, methods in grant.items():
+                        keys.update((module, submodule, endpoint, method.upper()) for method in methods)
+    return frozenset(keys)
+
+
+def compile_permission_masks(permission_json: dict) -> Dict[SlotName, int]:
+    """
+    Fold the keys of a stored permission set into a method bitmask per (module, submodule, endpoint)
+    """
+    masks = dict()
+    for module, submodule, endpoint, method in compile_permissions(permission_json):
+        bit = METHOD_BITS.get(method)
+        if bit:
+            masks[(module, submodule, endpoint)] = masks.get((module, submodule, endpoint), 0) | bit
+    return masks
+
+
+def encode_permission_bits(slot_masks: Dict[int, int]) -> bytes:
+    """
+    Pack slot masks into the `permission_bits` column, one big-endian uint32 `slot_id << 8 | mask` per slot
+    """
+    return struct.pack(f">{len(slot_masks)}I", *(slot_id << 8 | mask for slot_id, mask in sorted(slot_masks.items())))
+
+
+def decode_permission_bits(permission_bits: bytes) -> Dict[int, int]:
+    return {value >> 8: value & 0xFF for value in struct.unpack(f">{len(permission_bits) // 4}I", permission_bits)}
+
+
+class PermissionRegistry:
+    """
+    In-process mirror of the `permission_slots` table interning (module, submodule, endpoint) names
+
+    Slot ids are assigned by the database so that the `permission_bits` written by one instance
+    decode the same way on every other, see EntityPermissions.register_permission_slots.
+    """
+
+    def __init__(self):
+        self._slots: Dict[SlotName, int] = {}
+        self._names: Dict[int, SlotName] = {}
+        # (module, submodules, endpoint) of a permission check -> slot ids granting it
+        self._check_slots: Dict[Tuple[str, Tuple[str, ...], str], Tuple[int, ...]] = {}
+        self.max_slot_id = 0
+
+    def add(self, slot_id: int, module: str, submodule: str, endpoint: str):
+        self._slots[(module, submodule, endpoint)] = slot_id
+        self._names[slot_id] = (module, submodule, endpoint)
+        self._check_slots.clear()
+        self.max_slot_id = max(self.max_slot_id, slot_id)
+
+    def has_slots(self, slot_ids: Iterable[int]) -> bool:
+        return all(slot_id in self._names for slot_id in slot_ids)
+
+    def name(self, slot_id: int) -> Optional[SlotName]:
+        return self._names.get(slot_id)
+
+    def slot(self, module: str, submodule: str, endpoint: str) -> Optional[int]:
+        return self._slots.get((module, submodule, endpoint))
+
+    def check_slots(self, module: str, submodules: Tuple[str, ...], endpoint: str) -> Tuple[int, ...]:
+        """
+        Slot ids of the submodules' endpoint and wildcard endpoint, memoized per permission check
+        """
+        key = (module, submodules, endpoint)
+        slot_ids = self._check_slots.get(key)
+        if slot_ids is None:
+            names = [(module, submodule, name) for submodule in submodules for name in (endpoint, WILDCARD_ENDPOINT)]
+            slot_ids = self._check_slots[key] = tuple(self._slots[name] for name in names if name in self._slots)
+        return slot_ids
+
+    def has_names(self, names: Iterable[SlotName]) -> bool:
+        return all(name in self._slots for name in names)
+
+    def slot_masks(self, name_masks: Dict[SlotName, int]) -> Dict[int, int]:
+        """
+        Translate name keyed masks to slot keyed masks, every name must be registered
+        """
+        return {self._slots[name]: mask for name, mask in name_masks.items()}
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+permission_registry = PermissionRegistry()
+
+
+class PermissionIndex:
+    """
+    Immutable lookup structure for the permissions of an authenticated user
+
+    Holds one method bitmask per granted permission slot, a check is a memoized registry
+    lookup of the slots that could grant it followed by a bit test per slot.
+    """
+
+    __slots__ = ("_masks",)
+
+    def __init__(self, masks: Dict[int, int] = None):
+        self._masks = masks or {}
+
+    @classmethod
+    def from_slot_masks(cls, permission_sets: Iterable[Dict[int, int]]) -> "PermissionIndex":
+        masks = dict()
+        for slot_masks in permission_sets:
+            for slot_id, mask in slot_masks.items():
+                masks[slot_id] = masks.get(slot_id, 0) | mask
+        return cls(masks)
+
+    def allows(self, module: str, submodules: Tuple[str, ...], endpoint: str, method: str) -> bool:
+        bit = METHOD_BITS.get(method, 0)
+        masks = self._masks
+        for slot_id in permission_registry.check_slots(module, submodules, endpoint):
+            if masks.get(slot_id, 0) & bit:
+                return True
+        return False
+
+    @classmethod
+    def from_bits(cls, permission_bits: bytes) -> Optional["PermissionIndex"]:
+        """
+        Decode an index packed by `to_bits`, None if it references slots missing from the registry
+        """
+        masks = decode_permission_bits(permission_bits)
+        return cls(masks) if permission_registry.has_slots(masks) else None
+
+    def to_bits(self) -> bytes:
+        return encode_permission_bits(self._masks)
+
+    def to_grants(self) -> Dict[str, Dict[str, Dict[str, List[str]]]]:
+        """
+        Expand the index into {module: {submodule: {endpoint: [methods]}}} for callers without the slot registry
+        """
+        grants = dict()
+        for slot_id, mask in sorted(self._masks.items()):
+            name = permission_registry.name(slot_id)
+            if name is None:
+                continue
+            module, submodule, endpoint = name
+            grants.setdefault(module, {}).setdefault(submodule, {})[endpoint] = [
+                method for method, bit in METHOD_BITS.items() if mask & bit
+            ]
+        return grants
+
+    def fingerprint(self) -> str:
+        """
+        Short content hash, used as the permission version of signed session tokens
+        """
+        return hashlib.sha1(self.to_bits()).hexdigest()[:12]
+
+    def __len__(self) -> int:
+        return len(self._masks)
+
+
+EMPTY_PERMISSION_INDEX = PermissionIndex()
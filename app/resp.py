@@ -0,0 +1,126 @@
+import asyncio
+from time import monotonic
+from typing import AsyncIterator, List, Optional, Union
+from urllib.parse import urlparse
+
+Reply = Union[None, int, bytes, str, List["Reply"]]
+
+
+class RESPError(Exception):
+    """
+    Error reply sent by the server
+    """
+
+
+def encode_command(*args) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        parts.append(f"${len(arg)}\r\n".encode() + arg + b"\r\n")
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader) -> Reply:
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("connection closed by server")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode("utf-8")
+    if kind == b"-":
+        raise RESPError(payload.decode("utf-8"))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"unexpected reply type {kind!r}")
+
+
+class RESPClient:
+    """
+    Minimal asyncio client for servers speaking the Redis protocol (Redis, Valkey, KeyDB, ...)
+
+    Commands are sent one at a time over a single lazily opened connection. A broken or
+    timed out connection is dropped, commands then fail fast for `retry_interval` seconds
+    before a new connection is attempted. A command cancelled before its reply was read
+    drops the connection too, the next command opens a new one.
+    """
+
+    def __init__(self, url: str, timeout: float = 1.0, retry_interval: float = 5.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.database = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._unavailable_until = 0.0
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    async def open_connection(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        try:
+            if self.password:
+                writer.write(encode_command("AUTH", self.password))
+                await read_reply(reader)
+            if self.database:
+                writer.write(encode_command("SELECT", self.database))
+                await read_reply(reader)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    @property
+    def available(self) -> bool:
+        return monotonic() >= self._unavailable_until
+
+    async def execute(self, *args) -> Reply:
+        if not self.available:
+            raise ConnectionError(f"{self.host}:{self.port} unavailable")
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    self._reader, self._writer = await self.open_connection()
+                self._writer.write(encode_command(*args))
+                return await asyncio.wait_for(read_reply(self._reader), self.timeout)
+            except RESPError:
+                raise
+            except asyncio.CancelledError:
+                # the reply may still be in flight, it would be read as the reply of the next command
+                self.close()
+                raise
+            except Exception:
+                self.close()
+                self._unavailable_until = monotonic() + self.retry_interval
+                raise
+
+    async def subscribe(self, channel: str) -> AsyncIterator[bytes]:
+        """
+        Yield the messages published on `channel` over a dedicated connection
+        """
+        reader, writer = await self.open_connection()
+        try:
+            writer.write(encode_command("SUBSCRIBE", channel))
+            while True:
+                reply = await read_reply(reader)
+                if isinstance(reply, list) and reply[0] == b"message":
+                    yield reply[2]
+        finally:
+            writer.close()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
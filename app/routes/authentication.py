@@ -1,15 +1,24 @@
+from http import HTTPStatus
+
 from fastapi import APIRouter, Depends, Request
 
-from app.models.authentication import ValidateLogin, UpdatePassword
+from app.core import login_required, rpc_or_login_required, verify_permission, admit_password_check, \
+    introspect_tokens
+from app.models.authentication import ValidateLogin, UpdatePassword, IntrospectTokens
+from app.negotiation import NegotiatedRoute
 from app.services.authentication import Login
 from app.utils import standard_response_generator
 
-authentication = APIRouter()
+authentication = APIRouter(route_class=NegotiatedRoute)
 
 
 @authentication.get("/login")
 async def validate_login(request: Request, query_args: ValidateLogin = Depends()):
-    login_processor = Login(db=request.app.db, logger=request.app.logger)
+    throttled_response = await admit_password_check(request, query_args.user_email)
+    if throttled_response:
+        return throttled_response
+
+    login_processor = Login(db=request.app.db, read_db=request.app.read_db, logger=request.app.logger)
     success, message, status_code, data = await login_processor.validate_authentication(
         query_args.user_email,
         query_args.user_password
@@ -19,10 +28,34 @@ async def validate_login(request: Request, query_args: ValidateLogin = Depends()
 
 @authentication.patch("/password")
 async def _update_password(request: Request, data: UpdatePassword):
-    login_processor = Login(db=request.app.db, logger=request.app.logger)
+    throttled_response = await admit_password_check(request, data.user_email)
+    if throttled_response:
+        return throttled_response
+
+    login_processor = Login(db=request.app.db, read_db=request.app.read_db, logger=request.app.logger)
     success, message, status_code = await login_processor.update_password(
         data.user_email,
         data.old_password,
         data.new_password
     )
     return standard_response_generator(success, message, status_code)
+
+
+@authentication.post("/logout")
+@login_required
+async def _logout(request: Request):
+    login_processor = Login(db=request.app.db, read_db=request.app.read_db, logger=request.app.logger)
+    success, message, status_code = await login_processor.logout(request.app.user["user_id"])
+    return standard_response_generator(success, message, status_code)
+
+
+@authentication.post("/introspect", name="token_introspection")
+@rpc_or_login_required
+@verify_permission()
+async def _introspect_tokens(request: Request, data: IntrospectTokens):
+    """
+    Validate a batch of authentication tokens for internal RPC callers
+    """
+    results = await introspect_tokens(request.app, data.authentication_tokens)
+    valid = sum(1 for result in results if result["valid"])
+    return standard_response_generator(True, f"{valid} of {len(results)} tokens valid", HTTPStatus.OK, results)
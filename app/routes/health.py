@@ -0,0 +1,14 @@
+from http import HTTPStatus
+
+from fastapi import APIRouter, Request
+
+from app.utils import standard_response_generator
+
+health = APIRouter()
+
+
+@health.get("/ready", include_in_schema=False)
+async def _ready(request: Request):
+    if not getattr(request.app, "ready", False):
+        return standard_response_generator(False, "warming up", HTTPStatus.SERVICE_UNAVAILABLE)
+    return standard_response_generator(True, "ready", HTTPStatus.OK)
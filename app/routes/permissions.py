@@ -1,31 +1,61 @@
+from http import HTTPStatus
+
 from fastapi import APIRouter, Depends, Request
+from fastapi.responses import Response
 
-from app.core import login_required, verify_permission
+from app.core import login_required, verify_permission, idempotent
 from app.models.authentication import ValidateLogin
-from app.models.permissions import GetEntityPermissions, CreateEntityPermission
+from app.models.permissions import GetEntityPermissions, CreateEntityPermission, ReassignEntityPermission
+from app.negotiation import NegotiatedRoute, representation_etag
 from app.services.authentication import Login
 from app.services.permissions import EntityPermissions
-from app.utils import standard_response_generator
+from app.settings import ENTITY_PERMISSION_CACHE_CONTROL
+from app.utils import standard_response_generator, etag_matches
 
-permissions = APIRouter()
+permissions = APIRouter(route_class=NegotiatedRoute)
 
 
 @permissions.get("/entity")
 async def get_entity_permissions(request: Request, query_args: GetEntityPermissions = Depends()):
-    entity_permissions_processor = EntityPermissions(db=request.app.db, logger=request.app.logger)
-    success, message, status_code, data = await entity_permissions_processor.fetch_entity_permissions(
+    entity_permissions_processor = EntityPermissions(
+        db=request.app.db, read_db=request.app.read_db, logger=request.app.logger
+    )
+    success, message, status_code, data, etag = await entity_permissions_processor.fetch_entity_permissions_with_etag(
         query_args.entity_id
     )
-    return standard_response_generator(success, message, status_code, data)
+    if not success:
+        return standard_response_generator(success, message, status_code, data)
+
+    etag = representation_etag(etag)
+    headers = {"ETag": etag, "Cache-Control": ENTITY_PERMISSION_CACHE_CONTROL, "Vary": "Accept"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    return standard_response_generator(success, message, status_code, data, headers=headers)
 
 
 @permissions.post("/entity", name="entity_permissions")
 @login_required
 @verify_permission(submodules=["permissions"])
+@idempotent
 async def _create_entity_permission(request: Request, data: CreateEntityPermission):
-    entity_permissions_processor = EntityPermissions(db=request.app.db, logger=request.app.logger, x_user=request.app.user)
+    entity_permissions_processor = EntityPermissions(
+        db=request.app.db, read_db=request.app.read_db, logger=request.app.logger, x_user=request.state.user
+    )
     success, message, status_code = await entity_permissions_processor.create_entity_permission(
         data.entity_id, data.permission_name, data.permissions
     )
     return standard_response_generator(success, message, status_code)
 
+
+
+@permissions.patch("/entity/users", name="entity_permission_users")
+@login_required
+@verify_permission(submodules=["permissions"])
+async def _reassign_entity_permission(request: Request, data: ReassignEntityPermission):
+    entity_permissions_processor = EntityPermissions(
+        db=request.app.db, read_db=request.app.read_db, logger=request.app.logger, x_user=request.state.user
+    )
+    success, message, status_code, data = await entity_permissions_processor.reassign_user_permissions(
+        data.entity_id, data.permission_name, data.user_ids, data.from_permission_name
+    )
+    return standard_response_generator(success, message, status_code, data)
@@ -1,28 +1,99 @@
+from http import HTTPStatus
 
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
 
-from app.models.user_details import UserCreationModel, GlobalUserCreationModel
-from app.services.user_details import UserCreation
-from app.utils import standard_response_generator
-from app.core import login_required
+from app.models.user_details import UserCreationModel, GlobalUserCreationModel, UserLookupModel, \
+    SingleUserLookupModel, ListEntityUsersModel, ExportEntityUsersModel
+from app.negotiation import NegotiatedRoute, request_content_type
+from app.services.user_details import UserCreation, UserDetails
+from app.utils import standard_response_generator, parse_bulk_rows, ndjson_stream
+from app.core import login_required, rpc_or_login_required, verify_permission, idempotent
 
-user_details = APIRouter()
+user_details = APIRouter(route_class=NegotiatedRoute)
 
 
 @user_details.post("/")
 @login_required
+@idempotent
 async def _create_entity_user(request: Request, data: UserCreationModel):
-    user_creation_processor = UserCreation(db=request.app.db, logger=request.app.logger, x_user=request.app.user)
+    user_creation_processor = UserCreation(
+        db=request.app.db, read_db=request.app.read_db, logger=request.app.logger, x_user=request.state.user
+    )
     success, message, status_code, data = await user_creation_processor.create_entity_user(data.model_dump())
     return standard_response_generator(success, message, status_code, data)
 
 
 @user_details.post("/global")
 @login_required
+@idempotent
 async def _create_global_user(request: Request, data: GlobalUserCreationModel):
-    user_creation_processor = UserCreation(db=request.app.db, logger=request.app.logger, x_user=request.app.user)
+    user_creation_processor = UserCreation(
+        db=request.app.db, read_db=request.app.read_db, logger=request.app.logger, x_user=request.state.user
+    )
     success, message, status_code, data = await user_creation_processor.create_global_user(data.model_dump())
     return standard_response_generator(success, message, status_code, data)
 
 
+@user_details.post("/bulk")
+@login_required
+async def _bulk_create_entity_users(request: Request):
+    """
+    Create entity users from a JSON or MessagePack array or a CSV upload (Content-Type: text/csv) of
+    UserCreationModel rows
+    """
+    # request.app.user is shared by all requests, it has to be read before the body is awaited
+    x_user = request.app.user
+    try:
+        rows = parse_bulk_rows(await request.body(), request_content_type(request))
+    except ValueError as e:
+        return standard_response_generator(False, f"invalid bulk upload: {e}", HTTPStatus.BAD_REQUEST)
+
+    user_creation_processor = UserCreation(
+        db=request.app.db, read_db=request.app.read_db, logger=request.app.logger, x_user=x_user
+    )
+    success, message, status_code, data = await user_creation_processor.bulk_create_entity_users(rows)
+    return standard_response_generator(success, message, status_code, data)
+
 
+@user_details.post("/lookup", name="user_lookup")
+@rpc_or_login_required
+@verify_permission(submodules=["users"])
+async def _lookup_users(request: Request, data: UserLookupModel):
+    user_details_processor = UserDetails(db=request.app.db, read_db=request.app.read_db, logger=request.app.logger)
+    success, message, status_code, data = await user_details_processor.lookup_users(data.user_ids, data.user_emails)
+    return standard_response_generator(success, message, status_code, data)
+
+
+@user_details.get("/lookup", name="user_lookup")
+@rpc_or_login_required
+@verify_permission(submodules=["users"])
+async def _lookup_user(request: Request, query_args: SingleUserLookupModel = Depends()):
+    user_details_processor = UserDetails(db=request.app.db, read_db=request.app.read_db, logger=request.app.logger)
+    success, message, status_code, data = await user_details_processor.lookup_user(
+        query_args.user_id, request.app.user_loader
+    )
+    return standard_response_generator(success, message, status_code, data)
+
+
+@user_details.get("/users", name="entity_users")
+@login_required
+@verify_permission(submodules=["users"])
+async def _list_entity_users(request: Request, query_args: ListEntityUsersModel = Depends()):
+    user_details_processor = UserDetails(db=request.app.db, read_db=request.app.read_db, logger=request.app.logger)
+    success, message, status_code, data = await user_details_processor.list_entity_users(
+        query_args.entity_id, query_args.user_role, query_args.active, query_args.after, query_args.limit
+    )
+    return standard_response_generator(success, message, status_code, data)
+
+
+@user_details.get("/users/export", name="entity_users")
+@login_required
+@verify_permission(submodules=["users"])
+async def _export_entity_users(request: Request, query_args: ExportEntityUsersModel = Depends()):
+    """
+    Stream every user of an entity as newline delimited JSON
+    """
+    user_details_processor = UserDetails(db=request.app.db, read_db=request.app.read_db, logger=request.app.logger)
+    users = user_details_processor.iterate_entity_users(query_args.entity_id, query_args.user_role, query_args.active)
+    return StreamingResponse(ndjson_stream(users, request.app.logger), media_type="application/x-ndjson")
@@ -1,24 +1,80 @@
+import asyncio
 import logging
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
-from databases import Database
 from starlette.middleware.cors import CORSMiddleware
 
+from app.cache import RESPCacheBackend, consume_invalidations, use_cache_backend
+from app.loader import BatchLoader
+from app.metrics import InstrumentedDatabase, MetricsMiddleware
+from app.migrations import database_url, verify_query_plans
 from app.routes.permissions import permissions
 from app.routes.authentication import authentication
+from app.routes.health import health
+from app.routes.metrics import metrics
 from app.routes.user_details import user_details
-from app.settings import MYSQL_CONFIG, BASE_ROUTE, LOG_LEVEL, APP_NAME
+from app.settings import BASE_ROUTE, LOG_LEVEL, APP_NAME, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, \
+    DB_CONNECT_TIMEOUT, DB_POOL_RECYCLE, READ_REPLICA_DATABASE_URL, USER_LOOKUP_MAX_BATCH, \
+    USER_LOOKUP_COALESCE_WINDOW_MS, SESSION_REVOCATION_REFRESH_INTERVAL, VERIFY_QUERY_PLANS, \
+    METRICS_ENABLED, WARMUP_ENABLED, CACHE_REDIS_URL, TOKEN_WRITE_BEHIND, EMAIL_FILTER_ENABLED
+from app.services.authentication import Login
+from app.resp import RESPClient
+from app.services.permissions import EntityPermissions
+from app.services.user_details import UserDetails
+from app.session_tokens import signed_tokens_enabled, validate_session_token_settings
+from app.admission import AdmissionMiddleware
+from app.warmup import run_warm_up, load_email_filter
+from app.write_behind import token_write_behind
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     init_logger(app)
     app.logger.info("✅ logger initialized")
+    validate_session_token_settings()
     await init_db(app)
     app.logger.info("✅ MySQL database initialized and connected")
+    if VERIFY_QUERY_PLANS:
+        failures = await verify_query_plans(app.db)
+        for failure in failures:
+            app.logger.error(failure)
+        if failures:
+            raise RuntimeError("query plan verification failed, see logged full table scans")
+        app.logger.info("✅ query plans verified")
+    await EntityPermissions(db=app.db, read_db=app.read_db, logger=app.logger).load_permission_slots()
+    app.logger.info("✅ permission slots loaded")
+    init_loaders(app)
+    init_cache_backend(app)
+    if TOKEN_WRITE_BEHIND:
+        await token_write_behind.start(
+            Login(db=app.db, read_db=app.read_db, logger=app.logger).flush_authentication_tokens
+        )
+        app.logger.info("✅ authentication token write-behind started")
+    if signed_tokens_enabled():
+        app.revocation_task = asyncio.create_task(refresh_session_revocations(app))
+    app.ready = not WARMUP_ENABLED
+    if WARMUP_ENABLED:
+        app.warmup_task = asyncio.create_task(run_warm_up(app))
+    if EMAIL_FILTER_ENABLED:
+        app.email_filter_task = asyncio.create_task(load_email_filter(app))
 
     yield
 
+    if signed_tokens_enabled():
+        app.revocation_task.cancel()
+    if WARMUP_ENABLED:
+        app.warmup_task.cancel()
+    if EMAIL_FILTER_ENABLED:
+        app.email_filter_task.cancel()
+    if CACHE_REDIS_URL:
+        app.invalidation_task.cancel()
+    if TOKEN_WRITE_BEHIND:
+        await token_write_behind.stop()
+        app.logger.info("🛑 pending authentication tokens flushed")
+
+    if app.read_db is not app.db:
+        await app.read_db.disconnect()
+        app.logger.info("🛑 MySQL read replica connection closed")
     await app.db.disconnect()
     app.logger.info("🛑 MySQL database connection closed")
 
@@ -32,6 +88,8 @@ def get_application() -> FastAPI:
         lifespan=lifespan
     )
 
+    # innermost, so that shed requests still get CORS headers
+    app.add_middleware(AdmissionMiddleware)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
@@ -39,10 +97,15 @@ def get_application() -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    if METRICS_ENABLED:
+        app.add_middleware(MetricsMiddleware)
 
     app.include_router(authentication, tags=["authentication"], prefix=BASE_ROUTE)
     app.include_router(permissions, tags=["permissions"], prefix=BASE_ROUTE + "/permission")
     app.include_router(user_details, tags=["user_details"], prefix=BASE_ROUTE)
+    app.include_router(health, tags=["health"], prefix=BASE_ROUTE)
+    if METRICS_ENABLED:
+        app.include_router(metrics, tags=["metrics"], prefix=BASE_ROUTE)
 
     return app
 
@@ -51,14 +114,48 @@ app = get_application()
 
 
 async def init_db(app: FastAPI):
-    db_config = MYSQL_CONFIG
-    DATABASE_URL = (
-        f"mysql+aiomysql://{db_config['USER']}:{db_config['PASSWORD']}"
-        f"@{db_config['HOST']}:{db_config['PORT']}/{db_config['NAME']}"
-    )
-    app.db = Database(DATABASE_URL)
+    DATABASE_URL = database_url()
+    pool_options = {
+        "min_size": DB_POOL_MIN_SIZE,
+        "max_size": DB_POOL_MAX_SIZE,
+        "connect_timeout": DB_CONNECT_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+    app.db = InstrumentedDatabase(DATABASE_URL, **pool_options)
     await app.db.connect()
 
+    # pure reads are routed to the replica when configured, writes and transactions stay on the primary
+    app.read_db = app.db
+    if READ_REPLICA_DATABASE_URL:
+        app.read_db = InstrumentedDatabase(READ_REPLICA_DATABASE_URL, **pool_options)
+        await app.read_db.connect()
+        app.logger.info("✅ MySQL read replica initialized and connected")
+
+
+def init_loaders(app: FastAPI):
+    user_details_processor = UserDetails(db=app.db, read_db=app.read_db, logger=app.logger)
+    app.user_loader = BatchLoader(
+        user_details_processor.load_users_by_id,
+        window=USER_LOOKUP_COALESCE_WINDOW_MS / 1000,
+        max_batch_size=USER_LOOKUP_MAX_BATCH,
+    )
+
+
+def init_cache_backend(app: FastAPI):
+    if not CACHE_REDIS_URL:
+        return
+    backend = RESPCacheBackend(RESPClient(CACHE_REDIS_URL))
+    use_cache_backend(backend)
+    app.invalidation_task = asyncio.create_task(consume_invalidations(backend.client, backend.channel))
+    app.logger.info("✅ shared cache backend configured")
+
+
+async def refresh_session_revocations(app: FastAPI):
+    login_processor = Login(db=app.db, read_db=app.read_db, logger=app.logger)
+    while True:
+        await login_processor.load_session_revocations()
+        await asyncio.sleep(SESSION_REVOCATION_REFRESH_INTERVAL)
+
 
 def init_logger(app: FastAPI):
     extra = {"app_name": APP_NAME}
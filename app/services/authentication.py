@@ -1,26 +1,36 @@
+import time
 import uuid
-from _sha256 import sha256
 from http import HTTPStatus
+from typing import Optional
 
+from app.cache import auth_token_cache, session_permission_cache
 from app.enums import Tables
-from app.utils import get_passkey, create_update_query_with_values
+from app.passwords import check_password, hash_password, passkey_needs_rehash
+from app.services.user_details import UserDetails
+from app.session_tokens import issue_session_token, signed_tokens_enabled, session_revocations
+from app.settings import SESSION_TOKEN_MODE, SESSION_TOKEN_TTL, TOKEN_WRITE_BEHIND
+from app.utils import create_update_query_with_values, create_select_query_with_values, \
+    create_case_update_query_with_values, create_insert_query_with_values, create_comparison_condition
+from app.write_behind import token_write_behind
 
 
 class Login:
-    def __init__(self, db=None, logger=None):
+    def __init__(self, db=None, read_db=None, logger=None):
         self.db = db
+        self.read_db = read_db or db
         self.logger = logger
 
     async def validate_authentication(self, user_email, user_password, validate_only=False):
-        _columns = ["ud.user_id", "ua.user_passkey", "ua.salt"]
-        _where = f"ud.user_email = '{user_email}' and ud.active = true"
-
-        query = f"""
-        SELECT {', '.join(_columns)} from {Tables.user_details} ud JOIN {Tables.user_authentication} ua
-        ON ud.user_id = ua.user_id WHERE {_where};"""
+        _columns = ["ud.user_id", "ud.user_name", "ud.is_chief_admin", "ua.user_passkey", "ua.salt"]
+        _table = f"{Tables.user_details} ud JOIN {Tables.user_authentication} ua ON ud.user_id = ua.user_id"
+        query, values = create_select_query_with_values(
+            _table, _columns, {"ud.user_email": user_email, "ud.active": True}
+        )
 
         try:
-            response = await self.db.fetch_all(query)
+            response = await self.read_db.fetch_all(query=query, values=values)
+            if not response and self.read_db is not self.db:
+                response = await self.db.fetch_all(query=query, values=values)
         except Exception as e:
             self.logger.error(f"failed to fetch authentication details due to {e}")
             return False, "failed to fetch authentication details", HTTPStatus.INTERNAL_SERVER_ERROR, {}
@@ -30,34 +40,109 @@ class Login:
 
         response = response[0]
 
-        status = self.verify_password(response["user_passkey"], response["salt"], user_password)
+        status = await self.verify_password(response["user_passkey"], response["salt"], user_password)
         if not status:
             return False, "incorrect password provided", HTTPStatus.BAD_REQUEST, {}
 
         if validate_only:
             return True, "validation successful", HTTPStatus.OK, {"authentication_details": response}
 
-        return await self.update_authentication_token(response["user_id"])
+        if passkey_needs_rehash(response["user_passkey"]):
+            await self.rehash_password(response["user_id"], response["salt"], user_password)
+
+        if SESSION_TOKEN_MODE == "signed":
+            return await self.issue_signed_token(response["user_id"], response["is_chief_admin"])
+        user = {key: response[key] for key in ("user_id", "user_name", "is_chief_admin")}
+        return await self.update_authentication_token(response["user_id"], user)
+
+    async def issue_signed_token(self, user_id: str, is_chief_admin: bool):
+        """
+        Issue a stateless signed session token, nothing is written to user_details
+        """
+        success, permissions = await UserDetails(
+            db=self.db, read_db=self.read_db, logger=self.logger
+        ).fetch_user_permissions(user_id)
+        if not success:
+            return False, "failed to authenticate user", HTTPStatus.INTERNAL_SERVER_ERROR, {}
+
+        permission_version = permissions.fingerprint()
+        await session_permission_cache.set(user_id, (True, permissions))
+        auth_token = issue_session_token(user_id, is_chief_admin, permission_version)
 
-    async def update_authentication_token(self, user_id: str):
+        return True, "login successful", HTTPStatus.OK, {"user_id": user_id, "authenticationtoken": auth_token}
+
+    async def update_authentication_token(self, user_id: str, user: dict = None):
+        """
+        Issue a new opaque token, with `user` details the token is written through to the token cache
+
+        In write-behind mode the token is journaled and stored later by `flush_authentication_tokens`.
+        """
         auth_token = str(uuid.uuid4())
-        query = f"""UPDATE {Tables.user_details} SET authentication_token = '{auth_token}' WHERE user_id = '{user_id}';"""
+        query, values = self.authentication_token_update(user_id, auth_token)
 
         try:
-            await self.db.execute(query)
+            if TOKEN_WRITE_BEHIND:
+                await token_write_behind.record(user_id, auth_token)
+            else:
+                await self.db.execute(query=query, values=values)
         except Exception as e:
             self.logger.error(f"failed to execute update query due to {e}")
             return False, "failed to authenticate user", HTTPStatus.INTERNAL_SERVER_ERROR, {}
 
+        permissions = None
+        if user is not None:
+            _, permissions = await UserDetails(
+                db=self.db, read_db=self.read_db, logger=self.logger
+            ).fetch_user_permissions(user_id)
+        if permissions is None:
+            await auth_token_cache.invalidate_user(user_id)
+        else:
+            await auth_token_cache.replace_user_token(user_id, auth_token, {**user, "permissions": permissions})
+
         return True, "login successful", HTTPStatus.OK, {"user_id": user_id, "authenticationtoken": auth_token}
 
     @staticmethod
-    def verify_password(user_passkey: str, salt: str, provided_password: str) -> bool:
-        provided_passkey = get_passkey(provided_password, salt)
-        if user_passkey != provided_passkey:
+    def authentication_token_update(user_id: str, auth_token: Optional[str]):
+        return create_update_query_with_values(
+            Tables.user_details,
+            update_data={"authentication_token": auth_token},
+            where_condition={"user_id": user_id}
+        )
+
+    @staticmethod
+    def authentication_tokens_flush(tokens: dict):
+        return create_case_update_query_with_values(Tables.user_details, "authentication_token", "user_id", tokens)
+
+    async def flush_authentication_tokens(self, tokens: dict) -> bool:
+        """
+        Store the user_id -> token updates buffered by the write-behind mode with a single UPDATE
+        """
+        query, values = self.authentication_tokens_flush(tokens)
+        try:
+            await self.db.execute(query=query, values=values)
+        except Exception as e:
+            self.logger.error(f"failed to flush authentication tokens due to {e}")
             return False
         return True
 
+    @staticmethod
+    async def verify_password(user_passkey: str, salt: str, provided_password: str) -> bool:
+        return await check_password(user_passkey, salt, provided_password)
+
+    async def rehash_password(self, user_id: str, salt: str, password: str):
+        """
+        Upgrade a passkey derived with a legacy algorithm or cost, failures only get logged
+        """
+        query, values = create_update_query_with_values(
+            Tables.user_authentication,
+            update_data={"user_passkey": await hash_password(password, salt)},
+            where_condition={"user_id": user_id}
+        )
+        try:
+            await self.db.execute(query=query, values=values)
+        except Exception as e:
+            self.logger.error(f"failed to rehash password due to {e}")
+
     async def update_password(self, user_email, old_password, new_password):
         success, message, status_code, data = await self.validate_authentication(
             user_email=user_email,
@@ -65,10 +150,10 @@ class Login:
             validate_only=True
         )
         if not success:
-            return success, message, status_code, data
+            return success, message, status_code
 
         authentication_details = data.get("authentication_details", {})
-        new_passkey = get_passkey(new_password, authentication_details["salt"])
+        new_passkey = await hash_password(new_password, authentication_details["salt"])
 
         query, values = create_update_query_with_values(
             Tables.user_authentication,
@@ -81,4 +166,61 @@ class Login:
             self.logger.error(f"failed to execute query due to {e}")
             return False, "Failed to update password", HTTPStatus.INTERNAL_SERVER_ERROR
 
+        await auth_token_cache.invalidate_user(authentication_details["user_id"])
+        if signed_tokens_enabled():
+            await self.revoke_sessions(authentication_details["user_id"])
+
         return True, "Successfully updated password", HTTPStatus.OK
+
+    async def logout(self, user_id: str):
+        query, values = self.authentication_token_update(user_id, None)
+        try:
+            if TOKEN_WRITE_BEHIND:
+                # a pending token flushed after this update would log the user back in
+                await token_write_behind.discard(user_id)
+            await self.db.execute(query=query, values=values)
+        except Exception as e:
+            self.logger.error(f"failed to execute update query due to {e}")
+            return False, "Failed to logout", HTTPStatus.INTERNAL_SERVER_ERROR
+
+        await auth_token_cache.invalidate_user(user_id)
+        if signed_tokens_enabled() and not await self.revoke_sessions(user_id):
+            return False, "Failed to logout", HTTPStatus.INTERNAL_SERVER_ERROR
+
+        return True, "Successfully logged out", HTTPStatus.OK
+
+    async def revoke_sessions(self, user_id: str) -> bool:
+        """
+        Deny-list every signed session token of the user issued until now
+        """
+        revoked_at = int(time.time() * 1000)
+        query, values = create_insert_query_with_values(
+            Tables.session_revocations, {"user_id": user_id, "revoked_at": revoked_at},
+            update_on_duplicate=["revoked_at"]
+        )
+        session_revocations.revoke(user_id, revoked_at)
+        try:
+            await self.db.execute(query=query, values=values)
+        except Exception as e:
+            self.logger.error(f"failed to revoke sessions due to {e}")
+            return False
+        return True
+
+    async def load_session_revocations(self):
+        """
+        Refresh the local deny-list with the revocations that can still match an unexpired token
+        """
+        since = int(time.time() * 1000) - SESSION_TOKEN_TTL * 1000
+        query, values = create_select_query_with_values(
+            Tables.session_revocations, ["user_id", "revoked_at"],
+            conditions=[create_comparison_condition("revoked_at", ">", since, "since")]
+        )
+        try:
+            response = await self.db.fetch_all(query=query, values=values)
+        except Exception as e:
+            self.logger.error(f"failed to fetch session revocations due to {e}")
+            return
+
+        for row in response:
+            session_revocations.revoke(row["user_id"], row["revoked_at"])
+        session_revocations.compact()
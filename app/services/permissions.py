@@ -1,32 +1,93 @@
 import json
 from http import HTTPStatus
+from typing import Dict, Iterable, List
 
 from pymysql import IntegrityError
 
+from app.cache import auth_token_cache, entity_permission_cache, entity_permission_etags, session_permission_cache
 from app.enums import Tables
-from app.utils import create_query_params, generate_nano_id, create_insert_query_with_values, is_unique_violation
+from app.permission_index import SlotName, compile_permission_masks, encode_permission_bits, permission_registry
+from app.settings import READ_REPLICA_MAX_LAG, PERMISSION_REASSIGN_CHUNK_SIZE
+from app.utils import create_select_query_with_values, generate_nano_id, create_insert_query_with_values, \
+    create_bulk_insert_query_with_values, is_unique_violation, create_in_condition, chunked, \
+    content_etag, create_update_query_with_values, create_comparison_condition, \
+    create_null_condition
 
 
 class EntityPermissions:
 
-    def __init__(self, db=None, logger=None, x_user=None):
+    def __init__(self, db=None, read_db=None, logger=None, x_user=None):
         self.db = db
+        self.read_db = read_db or db
         self.logger = logger
         self.x_user = x_user
 
+    # row fields that can be filtered on in memory when serving from the entity cache
+    cacheable_filters = ("permission_id", "permission_name")
+
     async def fetch_entity_permissions(self, entity_id: str, filters: dict = {}):
-        _columns = ["permission_id", "permission_json", "permission_name"]
-        _where = {
-            "entity_id = '%s'": entity_id,
-            "active = %s": True
-        }
-        for key, value in filters.items():
-            _where[f"{key} = '%s'"] = value
+        """
+        Fetch the active permission sets of an entity
+
+        The parsed permission sets of every entity are cached and invalidated through the entity's
+        version counter, filters on permission_id/permission_name are applied on the cached data.
+        The returned permission dicts are shared with the cache and must not be mutated.
+        """
+        if any(key not in self.cacheable_filters for key in filters):
+            return await self._query_entity_permissions(entity_id, filters)
+
+        success, message, status_code, data = await self._cached_entity_permissions(entity_id)
+        if not success:
+            return success, message, status_code, data
+
+        if filters:
+            data = {
+                permission_id: detail for permission_id, detail in data.items()
+                if all(detail[key] == value for key, value in filters.items())
+            }
+        else:
+            data = dict(data)
+
+        return True, "successfully fetched permissions", HTTPStatus.OK, data
+
+    async def fetch_entity_permissions_with_etag(self, entity_id: str):
+        """
+        Fetch the active permission sets of an entity along with their ETag
+
+        The ETag hashes the content, so every worker hands out the same one. It's computed once per
+        cached copy of the sets, a cache hit is answered without hashing or reading the DB.
+        """
+        success, message, status_code, data = await self._cached_entity_permissions(entity_id)
+        if not success:
+            return success, message, status_code, data, None
 
-        _columns, _where = create_query_params(columns=_columns, where_dict=_where)
-        query = f"SELECT {_columns} FROM {Tables.entity_permissions} WHERE {_where};"
+        cached = entity_permission_etags.get(entity_id)
+        if cached is not None and cached[0] is data:
+            etag = cached[1]
+        else:
+            etag = content_etag(data)
+            entity_permission_etags.set(entity_id, (data, etag))
+
+        return True, "successfully fetched permissions", HTTPStatus.OK, dict(data), etag
+
+    async def _cached_entity_permissions(self, entity_id: str):
+        data = await entity_permission_cache.get(entity_id)
+        if data is None:
+            version = entity_permission_cache.version(entity_id)
+            success, message, status_code, data = await self._query_entity_permissions(entity_id)
+            if not success:
+                return success, message, status_code, data
+            await entity_permission_cache.set(entity_id, data, version=version)
+        return True, "successfully fetched permissions", HTTPStatus.OK, data
+
+    async def _query_entity_permissions(self, entity_id: str, filters: dict = {}):
+        _columns = ["permission_id", "permission_json", "permission_name"]
+        _where = {"entity_id": entity_id, "active": True, **filters}
+        query, values = create_select_query_with_values(Tables.entity_permissions, _columns, _where)
+        # an entity that changed within the replica lag window is read from the primary
+        db = self.db if entity_permission_cache.changed_within(entity_id, READ_REPLICA_MAX_LAG) else self.read_db
         try:
-            response = await self.db.fetch_all(query)
+            response = await db.fetch_all(query=query, values=values)
         except Exception as e:
             self.logger.error(f"failed to fetch entity permissions due to {e}")
             return False, "Failed to fetch entity permissions", HTTPStatus.INTERNAL_SERVER_ERROR, {}
@@ -43,13 +104,98 @@ class EntityPermissions:
 
         return True, "successfully fetched permissions", HTTPStatus.OK, data
 
+    async def load_permission_slots(self, after: int = 0):
+        """
+        Mirror the permission slots with an id above `after` into the in-process registry
+        """
+        query, values = create_select_query_with_values(
+            Tables.permission_slots, ["slot_id", "module", "submodule", "endpoint"],
+            conditions=[create_comparison_condition("slot_id", ">", after, "after")]
+        )
+        # slots are read from the primary, a slot registered by another instance must be visible right away
+        for row in await self.db.fetch_all(query=query, values=values):
+            permission_registry.add(row["slot_id"], row["module"], row["submodule"], row["endpoint"])
+
+    async def register_permission_slots(self, names: Iterable[SlotName]):
+        """
+        Intern (module, submodule, endpoint) names missing from the registry into permission_slots
+        """
+        missing = [name for name in set(names) if permission_registry.slot(*name) is None]
+        if not missing:
+            return
+        rows = [
+            {"module": module, "submodule": submodule, "endpoint": endpoint} for module, submodule, endpoint in missing
+        ]
+        # names registered concurrently by another instance are skipped by the unique key
+        query, values = create_bulk_insert_query_with_values(Tables.permission_slots, rows, ignore=True)
+        await self.db.execute(query=query, values=values)
+
+        await self.load_permission_slots(after=permission_registry.max_slot_id)
+        if not permission_registry.has_names(missing):
+            # ids are allocated before commit, a concurrent insert can land below the last id seen
+            await self.load_permission_slots()
+
+    async def compile_permission_bits(self, permission_json: dict) -> Dict[int, int]:
+        name_masks = compile_permission_masks(permission_json)
+        await self.register_permission_slots(name_masks)
+        return permission_registry.slot_masks(name_masks)
+
+    async def registered_permission_bits(self, permission_json: dict) -> Dict[int, int]:
+        """
+        Compile a permission set from the slots registered so far, without writing new ones
+
+        Used on the authentication path for sets not backfilled yet, names without a slot are left out.
+        """
+        name_masks = compile_permission_masks(permission_json)
+        if not permission_registry.has_names(name_masks):
+            await self.load_permission_slots(after=permission_registry.max_slot_id)
+        missing = [name for name in name_masks if permission_registry.slot(*name) is None]
+        if missing:
+            self.logger.warning(f"permission set without permission_bits grants unregistered names {missing}")
+        return permission_registry.slot_masks({name: mask for name, mask in name_masks.items() if name not in missing})
+
+    async def backfill_permission_bits(self, batch_size: int) -> int:
+        """
+        Compile and store permission_bits of the sets created before the column existed, returns their count
+        """
+        backfilled, after = 0, ""
+        while True:
+            query, values = create_select_query_with_values(
+                Tables.entity_permissions, ["permission_id", "permission_json"],
+                conditions=[
+                    create_null_condition("permission_bits"),
+                    create_comparison_condition("permission_id", ">", after, "after")
+                ],
+                suffix=" ORDER BY permission_id LIMIT :limit"
+            )
+            rows = await self.db.fetch_all(query=query, values={**values, "limit": batch_size})
+            for row in rows:
+                slot_masks = await self.compile_permission_bits(json.loads(row["permission_json"]))
+                update_query, update_values = create_update_query_with_values(
+                    Tables.entity_permissions,
+                    {"permission_bits": encode_permission_bits(slot_masks)},
+                    {"permission_id": row["permission_id"]}
+                )
+                await self.db.execute(query=update_query, values=update_values)
+                backfilled += 1
+            if len(rows) < batch_size:
+                return backfilled
+            after = rows[-1]["permission_id"]
+
     async def create_entity_permission(self, entity_id: str, permission_name: str, permission_json: dict):
+        try:
+            slot_masks = await self.compile_permission_bits(permission_json)
+        except Exception as e:
+            self.logger.error(f"failed to register permission slots due to {e}")
+            return False, "Failed to create permission", HTTPStatus.INTERNAL_SERVER_ERROR
+
         permission_id = generate_nano_id(length=8)
         insert_values = {
             "entity_id": entity_id,
             "permission_id": permission_id,
             "permission_name": permission_name,
             "permission_json": json.dumps(permission_json),
+            "permission_bits": encode_permission_bits(slot_masks),
             "created_by": self.x_user["user_id"],
             "updated_by": self.x_user["user_id"]
         }
@@ -63,4 +209,98 @@ class EntityPermissions:
             self.logger.error(f"failed to insert data in table due to {e}")
             return False, "Failed to create permission", HTTPStatus.INTERNAL_SERVER_ERROR
 
+        # merging the new set into the cached ones would race the other workers, the next read reloads them
+        # from the primary
+        await entity_permission_cache.invalidate(entity_id)
+
         return True, "Successfully created permission", HTTPStatus.CREATED
+
+    async def fetch_entity_user_permissions(
+        self, entity_id: str, user_ids: List[str] = None, permission_id: str = None, for_update: bool = False
+    ):
+        """
+        Fetch the permission_id of the entity's users, limited to `user_ids` or to holders of `permission_id`
+
+        Read from the primary, the result decides which rows a reassignment updates. Within a transaction
+        `for_update` locks the rows until it ends.
+        """
+        user_permissions = dict()
+        suffix = " FOR UPDATE" if for_update else ""
+        if permission_id:
+            query, values = create_select_query_with_values(
+                Tables.user_entity_details, ["user_id", "permission_id"],
+                {"entity_id": entity_id, "permission_id": permission_id}, suffix=suffix
+            )
+            for row in await self.db.fetch_all(query=query, values=values):
+                user_permissions[row["user_id"]] = row["permission_id"]
+            return user_permissions
+
+        for chunk in chunked(user_ids or [], PERMISSION_REASSIGN_CHUNK_SIZE):
+            query, values = create_select_query_with_values(
+                Tables.user_entity_details, ["user_id", "permission_id"], {"entity_id": entity_id},
+                conditions=[create_in_condition("user_id", chunk)], suffix=suffix
+            )
+            for row in await self.db.fetch_all(query=query, values=values):
+                user_permissions[row["user_id"]] = row["permission_id"]
+        return user_permissions
+
+    async def reassign_user_permissions(
+        self, entity_id: str, permission_name: str, user_ids: List[str] = None, from_permission_name: str = None
+    ):
+        """
+        Move users of an entity to the permission set `permission_name`
+
+        Users are selected by `user_ids` or by the permission set `from_permission_name` they hold. Their links
+        are locked and updated with one UPDATE per chunk of users within a single transaction, afterwards the
+        cached tokens and permissions of the moved users are invalidated.
+        """
+        success, _, _, permission_data = await self.fetch_entity_permissions(entity_id)
+        if not success:
+            return False, "Failed to fetch entity permissions", HTTPStatus.INTERNAL_SERVER_ERROR, {}
+        permission_ids = {detail["permission_name"]: permission_id for permission_id, detail in permission_data.items()}
+
+        permission_id = permission_ids.get(permission_name)
+        if not permission_id:
+            return False, "permission name provided doesn't exist", HTTPStatus.BAD_REQUEST, {}
+        from_permission_id = None
+        if from_permission_name:
+            from_permission_id = permission_ids.get(from_permission_name)
+            if not from_permission_id:
+                return False, "permission name to reassign from doesn't exist", HTTPStatus.BAD_REQUEST, {}
+
+        user_ids = list(dict.fromkeys(user_ids or []))
+        conditions = list()
+        if from_permission_id:
+            # a holder moved away by a concurrent reassignment is left alone
+            conditions.append(
+                create_comparison_condition("permission_id", "=", from_permission_id, "from_permission_id")
+            )
+        try:
+            async with self.db.transaction():
+                user_permissions = await self.fetch_entity_user_permissions(
+                    entity_id, user_ids, from_permission_id, for_update=True
+                )
+                moved_user_ids = [user_id for user_id, current in user_permissions.items() if current != permission_id]
+                for chunk in chunked(moved_user_ids, PERMISSION_REASSIGN_CHUNK_SIZE):
+                    query, values = create_update_query_with_values(
+                        Tables.user_entity_details,
+                        {"permission_id": permission_id, "updated_by": self.x_user["user_id"]},
+                        {"entity_id": entity_id},
+                        conditions=[create_in_condition("user_id", chunk), *conditions]
+                    )
+                    await self.db.execute(query=query, values=values)
+        except Exception as e:
+            self.logger.error(f"failed to execute transactional query due to {e}")
+            return False, "Failed to reassign permissions", HTTPStatus.INTERNAL_SERVER_ERROR, {}
+
+        for user_id in moved_user_ids:
+            await auth_token_cache.invalidate_user(user_id)
+            await session_permission_cache.invalidate(user_id)
+
+        data = {
+            "permission_id": permission_id,
+            "reassigned": len(moved_user_ids),
+            "user_ids": moved_user_ids,
+            "not_found": [user_id for user_id in user_ids if user_id not in user_permissions]
+        }
+        return True, f"reassigned {len(moved_user_ids)} users", HTTPStatus.OK, data
@@ -1,23 +1,40 @@
+import asyncio
+import json
 from http import HTTPStatus
+from typing import AsyncIterator, List
 
 import shortuuid
+from pydantic import ValidationError
 
+from app.bloom import email_filter
+from app.cache import session_permission_cache
 from app.enums import Tables
+from app.loader import BatchLoader
+from app.models.user_details import UserCreationModel
+from app.passwords import hash_password
+from app.permission_index import PermissionIndex, decode_permission_bits, permission_registry
 from app.services.permissions import EntityPermissions
-from app.utils import create_query_params, create_insert_query_with_values, execute_transactional_queries, \
-    create_update_query_with_values, get_default_password, generate_salt, get_passkey, generate_nano_id
+from app.settings import BULK_USER_CREATION_MAX_ROWS, BULK_USER_CREATION_CHUNK_SIZE, USER_EXPORT_BATCH_SIZE, \
+    READ_REPLICA_MAX_LAG
+from app.utils import create_select_query_with_values, create_insert_query_with_values, execute_transactional_queries, \
+    create_update_query_with_values, get_default_password, generate_salt, generate_nano_id, \
+    create_bulk_insert_query_with_values, create_in_condition, chunked, is_unique_violation, \
+    create_comparison_condition, create_null_condition, create_or_condition
 
 
 class UserCreation:
 
-    def __init__(self, db=None, logger=None, x_user=None):
+    def __init__(self, db=None, read_db=None, logger=None, x_user=None):
         self.db = db
+        self.read_db = read_db or db
         self.logger = logger
         self.x_user = x_user
 
     core_user_detail_columns = ["user_id", "user_name", "user_email", "user_code", "created_by", "updated_by"]
     user_entity_detail_columns = ["entity_id", "user_id", "user_role", "permission_id", "created_by", "updated_by"]
     core_global_user_columns = ["user_id", "user_name", "user_email", "created_by", "updated_by", "is_chief_admin"]
+    # creations skipping the existence query rely on it to reject duplicates, see migration 0006
+    user_email_unique_key = "uq_user_details_user_email"
 
     async def create_global_user(self, payload: dict):
         success, user_details = await self.validate_user_already_exist(
@@ -32,7 +49,7 @@ class UserCreation:
         user_id = generate_nano_id(length=10)
         default_password = get_default_password(payload["user_name"])
         salt = generate_salt()
-        passkey = get_passkey(default_password, salt)
+        passkey = await hash_password(default_password, salt)
         payload.update({
             "user_id": user_id,
             "created_by": self.x_user["user_id"],
@@ -64,14 +81,19 @@ class UserCreation:
         try:
             await execute_transactional_queries(db=self.db, queries=queries)
         except Exception as e:
+            if is_unique_violation(e, self.user_email_unique_key):
+                # created by another worker, unknown to this worker's email filter
+                email_filter.add(payload["user_email"])
+                return False, "User with the provided email already exist", HTTPStatus.BAD_REQUEST, {}
             self.logger.error(f"failed to execute transactional query due to {e}")
             return False, "Failed to to create user", HTTPStatus.INTERNAL_SERVER_ERROR, {}
 
+        email_filter.add(payload["user_email"])
         return True, "Successfully created user", HTTPStatus.OK, {"user_id": user_id}
 
-    async def create_entity_user(self, payload: dict):
+    async def create_entity_user(self, payload: dict, use_email_filter: bool = True):
         success, user_details = await self.validate_user_already_exist(
-            payload.get("user_email")
+            payload.get("user_email"), use_email_filter
         )
         if not success:
             return False, "Failed to fetch existing user details", HTTPStatus.OK.value, {}
@@ -80,7 +102,9 @@ class UserCreation:
             return False, "User with the provided email already exist", HTTPStatus.BAD_REQUEST, {}
 
         filters = {"permission_name": payload["permission_name"]}
-        status, _, _, permission_data = await EntityPermissions(db=self.db, logger=self.logger).fetch_entity_permissions(
+        status, _, _, permission_data = await EntityPermissions(
+            db=self.db, read_db=self.read_db, logger=self.logger
+        ).fetch_entity_permissions(
             payload["entity_id"], filters=filters
         )
         if not status:
@@ -102,6 +126,11 @@ class UserCreation:
             )
         else:
             success, message, status_code, data = await self.insert_user_details(payload)
+            if status_code == HTTPStatus.CONFLICT:
+                if use_email_filter:
+                    # the email filter missed a user created by another worker, decide again on the DB
+                    return await self.create_entity_user(payload, use_email_filter=False)
+                return False, "User with the provided email already exist", HTTPStatus.BAD_REQUEST, {}
 
         return success, message, status_code, data
 
@@ -135,7 +164,7 @@ class UserCreation:
         user_id = generate_nano_id(length=10)
         default_password = get_default_password(payload["user_name"])
         salt = generate_salt()
-        passkey = get_passkey(default_password, salt)
+        passkey = await hash_password(default_password, salt)
         payload.update({"user_id": user_id})
 
         core_user_details, entity_user_details = dict(), dict()
@@ -169,32 +198,225 @@ class UserCreation:
         try:
             await execute_transactional_queries(db=self.db, queries=queries)
         except Exception as e:
+            if is_unique_violation(e, self.user_email_unique_key):
+                email_filter.add(payload["user_email"])
+                return False, "User with the provided email already exist", HTTPStatus.CONFLICT, {}
             self.logger.error(f"failed to execute transactional query due to {e}")
             return False, "Failed to to create user", HTTPStatus.INTERNAL_SERVER_ERROR, {}
 
+        email_filter.add(payload["user_email"])
         return True, "Successfully created user", HTTPStatus.OK, {"user_id": user_id}
 
-    async def validate_user_already_exist(self, user_email):
-        _columns = ["ud.user_id", "ud.active", "ud.user_code"]
-        where_dict = {
-            "user_email = '%s'": user_email
-        }
-
-        _columns, _where = create_query_params(_columns, where_dict)
-        query = f"""SELECT {_columns} FROM {Tables.user_details} ud WHERE {_where};"""
+    async def bulk_create_entity_users(self, rows: List[dict]):
+        """
+        Create entity users in bulk
+
+        Permission names are resolved once per entity and existing emails are checked with IN queries,
+        the users are then written with multi-row inserts, one transaction per chunk of rows.
+        Returns a result for every row in the order they were provided.
+        """
+        if len(rows) > BULK_USER_CREATION_MAX_ROWS:
+            return False, f"at most {BULK_USER_CREATION_MAX_ROWS} users can be created at once", \
+                HTTPStatus.BAD_REQUEST, {}
+
+        results = [None] * len(rows)
+        payloads, seen_emails = dict(), set()
+        for index, row in enumerate(rows):
+            try:
+                payload = UserCreationModel.model_validate(row).model_dump()
+            except ValidationError as e:
+                errors = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+                results[index] = self._bulk_row_result(index, row.get("user_email"), False, errors)
+                continue
+
+            email_key = payload["user_email"].lower()
+            if email_key in seen_emails:
+                results[index] = self._bulk_row_result(index, payload["user_email"], False, "duplicate email in upload")
+                continue
+            seen_emails.add(email_key)
+            payloads[index] = payload
+
+        permission_ids = dict()
+        for entity_id in {payload["entity_id"] for payload in payloads.values()}:
+            status, _, _, permission_data = await EntityPermissions(
+                db=self.db, read_db=self.read_db, logger=self.logger
+            ).fetch_entity_permissions(entity_id)
+            if not status:
+                return False, "failed to fetch permission details", HTTPStatus.INTERNAL_SERVER_ERROR, {}
+            for permission_id, detail in permission_data.items():
+                permission_ids[(entity_id, detail["permission_name"])] = permission_id
+
+        emails = [payload["user_email"] for payload in payloads.values()]
+        success, existing_users = await self.fetch_existing_users(emails)
+        if not success:
+            return False, "Failed to fetch existing user details", HTTPStatus.INTERNAL_SERVER_ERROR, {}
+
+        pending = self._bulk_pending_rows(payloads.items(), permission_ids, existing_users, results)
+        for chunk in chunked(pending, BULK_USER_CREATION_CHUNK_SIZE):
+            success, unique_violation = await self._bulk_insert_chunk([payload for _, payload in chunk])
+            if unique_violation:
+                # the email filter missed users created by another worker, check the chunk's emails on the DB
+                success, existing_users = await self.fetch_existing_users(
+                    [payload["user_email"] for _, payload in chunk], use_email_filter=False
+                )
+                if success:
+                    chunk = self._bulk_pending_rows(chunk, permission_ids, existing_users, results)
+                    success, _ = await self._bulk_insert_chunk([payload for _, payload in chunk])
+            for index, payload in chunk:
+                if success:
+                    results[index] = self._bulk_row_result(
+                        index, payload["user_email"], True, "Successfully created user", payload["user_id"]
+                    )
+                else:
+                    results[index] = self._bulk_row_result(
+                        index, payload["user_email"], False, "Failed to to create user"
+                    )
+
+        created = sum(1 for result in results if result["success"])
+        data = {"created": created, "failed": len(results) - created, "results": results}
+        return True, f"processed {len(results)} users", HTTPStatus.OK, data
+
+    def _bulk_pending_rows(self, rows, permission_ids: dict, existing_users: dict, results: list) -> list:
+        """
+        Resolve the permission and the existing user of every (index, payload) row, returns the rows to write
+
+        Rows that can't be created get their failure in `results`.
+        """
+        pending = list()
+        for index, payload in rows:
+            permission_id = permission_ids.get((payload["entity_id"], payload["permission_name"]))
+            existing_user = existing_users.get(payload["user_email"].lower())
+            if not permission_id:
+                results[index] = self._bulk_row_result(
+                    index, payload["user_email"], False, "permission name provided doesn't exist"
+                )
+            elif existing_user and existing_user["active"]:
+                results[index] = self._bulk_row_result(
+                    index, payload["user_email"], False, "User with the provided email already exist"
+                )
+            else:
+                payload.update({
+                    "user_id": existing_user["user_id"] if existing_user else generate_nano_id(length=10),
+                    "is_existing_user": bool(existing_user),
+                    "permission_id": permission_id,
+                    "created_by": self.x_user["user_id"],
+                    "updated_by": self.x_user["user_id"]
+                })
+                pending.append((index, payload))
+        return pending
+
+    async def _bulk_insert_chunk(self, payloads: List[dict]):
+        """
+        Write a chunk of users in one transaction, returns whether it succeeded and whether it hit a unique key
+        """
+        core_user_rows, entity_user_rows, credential_rows, reactivation_rows = list(), list(), list(), list()
+        for payload in payloads:
+            if payload["is_existing_user"]:
+                reactivation_rows.append({
+                    "user_name": payload["user_name"],
+                    "user_code": payload["user_code"],
+                    "updated_by": payload["updated_by"],
+                    "active": True,
+                    "is_deleted": False,
+                    "user_id": payload["user_id"]
+                })
+            else:
+                core_user_rows.append({column: payload[column] for column in self.core_user_detail_columns})
+                credential_rows.append({"user_id": payload["user_id"], "user_passkey": None, "salt": generate_salt()})
+            entity_user_rows.append({column: payload[column] for column in self.user_entity_detail_columns})
+
+        # default passwords are derived on the bulk hashing pool, logins keep the main pool to themselves
+        passkeys = await asyncio.gather(*(
+            hash_password(get_default_password(core_user["user_name"]), credential["salt"], bulk=True)
+            for core_user, credential in zip(core_user_rows, credential_rows)
+        ))
+        for credential, passkey in zip(credential_rows, passkeys):
+            credential["user_passkey"] = passkey
+
+        queries = list()
+        if core_user_rows:
+            queries.append(create_bulk_insert_query_with_values(Tables.user_details, core_user_rows))
+            queries.append(create_bulk_insert_query_with_values(Tables.user_authentication, credential_rows))
+        queries.append(create_bulk_insert_query_with_values(Tables.user_entity_details, entity_user_rows))
+
+        reactivation_query = None
+        if reactivation_rows:
+            reactivation_query, _ = create_update_query_with_values(
+                Tables.user_details,
+                {key: value for key, value in reactivation_rows[0].items() if key != "user_id"},
+                {"user_id": reactivation_rows[0]["user_id"]}
+            )
 
         try:
-            response = await self.db.fetch_all(query)
+            async with self.db.transaction():
+                for query, values in queries:
+                    await self.db.execute(query=query, values=values)
+                if reactivation_query:
+                    await self.db.execute_many(query=reactivation_query, values=reactivation_rows)
         except Exception as e:
-            self.logger.error(f"failed to fetch user details due to {e}")
-            return False, {}
-
+            if is_unique_violation(e, self.user_email_unique_key):
+                return False, True
+            self.logger.error(f"failed to execute bulk user creation due to {e}")
+            return False, False
+
+        email_filter.add_many(payload["user_email"] for payload in payloads)
+        return True, False
+
+    @staticmethod
+    def _bulk_row_result(index: int, user_email: str, success: bool, message: str, user_id: str = None) -> dict:
+        return {"row": index, "user_email": user_email, "success": success, "message": message, "user_id": user_id}
+
+    async def fetch_existing_users(self, user_emails: List[str], use_email_filter: bool = True):
+        """
+        Fetch existing users for the provided emails, keyed by lower cased email
+
+        Emails the email filter has never seen are skipped.
+        """
+        if use_email_filter:
+            user_emails = [email for email in user_emails if email_filter.might_exist(email)]
+        existing_users = dict()
+        for emails in chunked(user_emails, BULK_USER_CREATION_CHUNK_SIZE):
+            query, values = create_select_query_with_values(
+                Tables.user_details, ["user_id", "user_email", "active"],
+                conditions=[create_in_condition("user_email", emails)]
+            )
+            try:
+                response = await self.read_db.fetch_all(query=query, values=values)
+            except Exception as e:
+                self.logger.error(f"failed to fetch user details due to {e}")
+                return False, {}
+
+            for row in response:
+                existing_users[row["user_email"].lower()] = {"user_id": row["user_id"], "active": row["active"]}
+
+        if use_email_filter:
+            for email in user_emails:
+                if email.lower() not in existing_users:
+                    email_filter.record_false_positive()
+        return True, existing_users
+
+    async def validate_user_already_exist(self, user_email, use_email_filter: bool = True):
         user_details = {
             "is_active": False,
             "user_id": None,
             "user_code": None
         }
+        if use_email_filter and not email_filter.might_exist(user_email):
+            return True, user_details
+
+        _columns = ["ud.user_id", "ud.active", "ud.user_code"]
+        query, values = create_select_query_with_values(
+            f"{Tables.user_details} ud", _columns, {"ud.user_email": user_email}
+        )
+
+        try:
+            response = await self.read_db.fetch_all(query=query, values=values)
+        except Exception as e:
+            self.logger.error(f"failed to fetch user details due to {e}")
+            return False, {}
 
+        if not response and use_email_filter:
+            email_filter.record_false_positive()
         if response:
             user_details["user_id"] = response[0]["user_id"]
             user_details["is_active"] = response[0]["active"]
@@ -202,29 +424,259 @@ class UserCreation:
 
         return True, user_details
 
+    async def has_user_email_unique_key(self) -> bool:
+        query, values = create_select_query_with_values(
+            "information_schema.statistics", ["1"],
+            {"table_name": Tables.user_details, "index_name": self.user_email_unique_key, "non_unique": 0},
+            conditions=[("table_schema = DATABASE()", {})], suffix=" LIMIT 1"
+        )
+        return await self.db.fetch_one(query=query, values=values) is not None
+
+    async def iterate_user_emails(self, batch_size: int) -> AsyncIterator[List[str]]:
+        """
+        Yield every user email in pages of `batch_size`, walking the unique email index
+        """
+        after = ""
+        while True:
+            query, values = create_select_query_with_values(
+                Tables.user_details, ["user_email"],
+                conditions=[create_comparison_condition("user_email", ">", after, "after")],
+                suffix=" ORDER BY user_email LIMIT :limit"
+            )
+            response = await self.read_db.fetch_all(query=query, values={**values, "limit": batch_size})
+            emails = [row["user_email"] for row in response]
+            if emails:
+                yield emails
+            if len(emails) < batch_size:
+                return
+            after = emails[-1]
+
 
 class UserDetails:
 
-    def __init__(self, db=None, logger=None):
+    def __init__(self, db=None, read_db=None, logger=None):
         self.db = db
+        self.read_db = read_db or db
         self.logger = logger
 
-    async def fetch_user_details(self, user_id: str = None, core_filters: dict = None):
+    async def fetch_user_details(self, user_id: str = None, core_filters: dict = None, with_permissions: bool = False):
         columns = ["user_id", "user_name", "is_chief_admin"]
-        _where = {f"{key} = '%s'": value for key, value in core_filters.items()}
-        _where["active = %s"] = True
+        _where = dict(core_filters or {})
         if user_id:
-            _where["user_id = '%s'"] = user_id
-        _columns, _where = create_query_params(columns, core_filters)
-
-        query = f"""SELECT {_columns} from {Tables.user_details} WHERE {_where};"""
+            _where["user_id"] = user_id
+        _where["active"] = True
+        query, values = create_select_query_with_values(Tables.user_details, columns, _where)
 
         try:
-            response = await self.db.fetch_one(query)
+            response = await self.read_db.fetch_one(query=query, values=values)
+            if not response and self.read_db is not self.db:
+                # rows written moments ago (e.g. a fresh login token) may not have reached the replica yet
+                response = await self.db.fetch_one(query=query, values=values)
         except Exception as e:
             self.logger.error(f"failed to fetch authentication details due to {e}")
             return False, "failed to fetch authentication details", HTTPStatus.INTERNAL_SERVER_ERROR, {}
 
+        if not response:
+            return False, "user not found", HTTPStatus.NOT_FOUND, {}
+
         data = {key: response[key] for key in columns}
 
+        if with_permissions:
+            success, permissions = await self.fetch_user_permissions(data["user_id"])
+            if not success:
+                return False, "failed to fetch user permissions", HTTPStatus.INTERNAL_SERVER_ERROR, {}
+            data["permissions"] = permissions
+
         return True, "successfully fetched used details", HTTPStatus.OK, data
+
+    async def fetch_user_permissions(self, user_id: str):
+        """
+        Resolve the permission sets linked to the user and compile them into a PermissionIndex
+
+        Sets are read from their `permission_bits`, sets stored before the column existed and not
+        backfilled yet are compiled from their `permission_json` against the registered slots. Users
+        whose permissions changed within the replica lag window are read from the primary.
+        """
+        _table = (
+            f"{Tables.user_entity_details} ued JOIN {Tables.entity_permissions} ep "
+            "ON ep.permission_id = ued.permission_id AND ep.entity_id = ued.entity_id"
+        )
+        query, values = create_select_query_with_values(
+            _table, ["ep.permission_json", "ep.permission_bits"], {"ued.user_id": user_id, "ep.active": True}
+        )
+
+        entity_permissions = EntityPermissions(db=self.db, read_db=self.read_db, logger=self.logger)
+        db = self.db if session_permission_cache.changed_within(user_id, READ_REPLICA_MAX_LAG) else self.read_db
+        try:
+            response = await db.fetch_all(query=query, values=values)
+            permission_sets = list()
+            for row in response:
+                if row["permission_bits"] is None:
+                    permission_sets.append(
+                        await entity_permissions.registered_permission_bits(json.loads(row["permission_json"]))
+                    )
+                    continue
+                slot_masks = decode_permission_bits(row["permission_bits"])
+                if not permission_registry.has_slots(slot_masks):
+                    await entity_permissions.load_permission_slots()
+                permission_sets.append(slot_masks)
+        except Exception as e:
+            self.logger.error(f"failed to fetch user permissions due to {e}")
+            return False, None
+
+        return True, PermissionIndex.from_slot_masks(permission_sets)
+
+    recent_user_columns = ["user_id", "user_name", "is_chief_admin", "authentication_token"]
+
+    async def fetch_recently_active_users(self, limit: int, with_token: bool = True):
+        """
+        Fetch the most recently updated active users, a login updates the row through its new token
+        """
+        conditions = [create_null_condition("authentication_token", is_null=False)] if with_token else []
+        query, values = create_select_query_with_values(
+            Tables.user_details, self.recent_user_columns, {"active": True}, conditions=conditions,
+            suffix=" ORDER BY updated_at DESC LIMIT :limit"
+        )
+        values["limit"] = limit
+        try:
+            response = await self.read_db.fetch_all(query=query, values=values)
+        except Exception as e:
+            self.logger.error(f"failed to fetch recently active users due to {e}")
+            return False, []
+
+        return True, [{key: row[key] for key in self.recent_user_columns} for row in response]
+
+    async def fetch_user_entity_ids(self, user_ids: List[str]):
+        query, values = create_select_query_with_values(
+            Tables.user_entity_details, ["entity_id"], conditions=[create_in_condition("user_id", user_ids)],
+            distinct=True
+        )
+        try:
+            response = await self.read_db.fetch_all(query=query, values=values)
+        except Exception as e:
+            self.logger.error(f"failed to fetch user entities due to {e}")
+            return False, []
+
+        return True, [row["entity_id"] for row in response]
+
+    user_lookup_columns = ["user_id", "user_name", "user_email", "user_code", "is_chief_admin"]
+
+    async def fetch_users(self, user_ids: List[str] = None, user_emails: List[str] = None):
+        """
+        Fetch active users matching any of the provided ids or emails with a single query
+        """
+        key_conditions = [
+            create_in_condition(column, keys) for column, keys in (("user_id", user_ids), ("user_email", user_emails))
+            if keys
+        ]
+        if not key_conditions:
+            return True, []
+
+        query, values = create_select_query_with_values(
+            Tables.user_details, self.user_lookup_columns, {"active": True},
+            conditions=[create_or_condition(key_conditions)]
+        )
+        try:
+            response = await self.read_db.fetch_all(query=query, values=values)
+        except Exception as e:
+            self.logger.error(f"failed to fetch user details due to {e}")
+            return False, []
+
+        return True, [{key: row[key] for key in self.user_lookup_columns} for row in response]
+
+    async def lookup_users(self, user_ids: List[str], user_emails: List[str]):
+        success, users = await self.fetch_users(user_ids=user_ids, user_emails=user_emails)
+        if not success:
+            return False, "failed to fetch user details", HTTPStatus.INTERNAL_SERVER_ERROR, {}
+
+        found_ids = {user["user_id"] for user in users}
+        found_emails = {user["user_email"].lower() for user in users}
+        data = {
+            "users": users,
+            "missing_user_ids": [user_id for user_id in user_ids if user_id not in found_ids],
+            "missing_user_emails": [email for email in user_emails if email.lower() not in found_emails],
+        }
+        return True, "successfully fetched user details", HTTPStatus.OK, data
+
+    async def load_users_by_id(self, user_ids: List[str]) -> dict:
+        """
+        Batch function of the user lookup coalescer, see `app.loader.BatchLoader`
+        """
+        success, users = await self.fetch_users(user_ids=user_ids)
+        if not success:
+            raise RuntimeError("failed to fetch user details")
+        return {user["user_id"]: user for user in users}
+
+    async def lookup_user(self, user_id: str, loader: BatchLoader):
+        """
+        Single user lookup, concurrent lookups are merged into one query by the loader
+        """
+        try:
+            user = await loader.load(user_id)
+        except Exception as e:
+            self.logger.error(f"failed to fetch user details due to {e}")
+            return False, "failed to fetch user details", HTTPStatus.INTERNAL_SERVER_ERROR, {}
+
+        if not user:
+            return False, "user not found", HTTPStatus.NOT_FOUND, {}
+        return True, "successfully fetched user details", HTTPStatus.OK, user
+
+    entity_user_columns = [
+        "ud.user_id", "ud.user_name", "ud.user_email", "ud.user_code", "ud.active", "ued.user_role", "ued.permission_id"
+    ]
+
+    async def fetch_entity_users(
+        self, entity_id: str, user_role: str = None, active: bool = None, after: str = None, limit: int = 100
+    ):
+        """
+        Fetch one page of an entity's users ordered by user_id
+
+        Pages are keyset paginated, `after` is the last user_id of the previous page, so every page
+        is a range read on the (entity_id, user_id) index regardless of how deep it is.
+        """
+        _table = f"{Tables.user_entity_details} ued JOIN {Tables.user_details} ud ON ud.user_id = ued.user_id"
+        _where = {"ued.entity_id": entity_id}
+        if user_role is not None:
+            _where["ued.user_role"] = user_role
+        if active is not None:
+            _where["ud.active"] = active
+        conditions = [create_comparison_condition("ued.user_id", ">", after, "after")] if after else []
+
+        query, values = create_select_query_with_values(
+            _table, self.entity_user_columns, _where, conditions=conditions, suffix=" ORDER BY ued.user_id LIMIT :limit"
+        )
+        values["limit"] = limit
+
+        try:
+            response = await self.read_db.fetch_all(query=query, values=values)
+        except Exception as e:
+            self.logger.error(f"failed to fetch entity users due to {e}")
+            return False, []
+
+        columns = [column.split(".")[1] for column in self.entity_user_columns]
+        return True, [{column: row[column] for column in columns} for row in response]
+
+    async def list_entity_users(self, entity_id: str, user_role: str, active: bool, after: str, limit: int):
+        success, users = await self.fetch_entity_users(entity_id, user_role, active, after, limit)
+        if not success:
+            return False, "failed to fetch entity users", HTTPStatus.INTERNAL_SERVER_ERROR, {}
+
+        next_cursor = users[-1]["user_id"] if len(users) == limit else None
+        return True, "successfully fetched entity users", HTTPStatus.OK, {"users": users, "next_cursor": next_cursor}
+
+    async def iterate_entity_users(self, entity_id: str, user_role: str = None, active: bool = None):
+        """
+        Yield every user of an entity, reading USER_EXPORT_BATCH_SIZE rows at a time
+
+        Raises RuntimeError if a page can't be fetched.
+        """
+        after = None
+        while True:
+            success, users = await self.fetch_entity_users(entity_id, user_role, active, after, USER_EXPORT_BATCH_SIZE)
+            if not success:
+                raise RuntimeError("failed to fetch entity users")
+            for user in users:
+                yield user
+            if len(users) < USER_EXPORT_BATCH_SIZE:
+                return
+            after = users[-1]["user_id"]
@@ -0,0 +1,122 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+from typing import Dict, Optional
+
+from app.settings import SESSION_TOKEN_MODE, SESSION_TOKEN_SECRET, SESSION_TOKEN_TTL
+
+SESSION_TOKEN_MODES = ("uuid", "signed")
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _b64encode(value: bytes) -> str:
+    return base64.urlsafe_b64encode(value).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(SESSION_TOKEN_SECRET.encode("utf-8"), payload.encode("ascii"), hashlib.sha256).digest())
+
+
+def signed_tokens_enabled() -> bool:
+    return bool(SESSION_TOKEN_SECRET)
+
+
+def validate_session_token_settings():
+    """
+    Raises RuntimeError at startup when the session token settings can't issue tokens
+    """
+    if SESSION_TOKEN_MODE not in SESSION_TOKEN_MODES:
+        raise RuntimeError(f"SESSION_TOKEN_MODE must be one of {', '.join(SESSION_TOKEN_MODES)}")
+    if SESSION_TOKEN_MODE == "signed" and not signed_tokens_enabled():
+        raise RuntimeError("SESSION_TOKEN_MODE=signed requires SESSION_TOKEN_SECRET")
+
+
+def is_signed_token(token: str) -> bool:
+    return token.count(".") == 1
+
+
+def issue_session_token(
+    user_id: str, is_chief_admin: bool, permission_version: str, ttl: int = SESSION_TOKEN_TTL
+) -> str:
+    """
+    Issue an HMAC-SHA256 signed session token
+
+    The token is `<base64url claims>.<base64url signature>`, claims carry the user id (uid),
+    chief admin flag (adm), permission version (pv) and issue/expiry times in epoch ms (iat/exp).
+    """
+    issued_at = _now_ms()
+    claims = {
+        "uid": user_id,
+        "adm": bool(is_chief_admin),
+        "pv": permission_version,
+        "iat": issued_at,
+        "exp": issued_at + ttl * 1000,
+    }
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_sign(payload)}"
+
+
+def decode_session_token(token: str) -> Optional[dict]:
+    """
+    Verify signature, expiry and revocation of a signed token, returns its claims or None
+    """
+    if not signed_tokens_enabled() or not is_signed_token(token):
+        return None
+
+    payload, signature = token.split(".")
+    try:
+        # tokens come from a header, non ASCII payloads or signatures are invalid rather than errors
+        if not hmac.compare_digest(_sign(payload), signature):
+            return None
+        claims = json.loads(_b64decode(payload))
+    except (UnicodeError, TypeError, ValueError):
+        return None
+    if not isinstance(claims, dict):
+        return None
+
+    if claims.get("exp", 0) <= _now_ms() or session_revocations.is_revoked(claims):
+        return None
+    return claims
+
+
+class RevocationList:
+    """
+    Per user cut-off times, signed tokens of a user issued at or before the cut-off are rejected
+
+    Kept in sync with the `session_revocations` table by a periodic refresh. Cut-offs older than
+    the token lifetime can no longer match a valid token and are dropped to keep the list compact.
+    """
+
+    def __init__(self):
+        self._revoked_before: Dict[str, int] = {}
+        self.last_revoked_at = 0
+
+    def revoke(self, user_id: str, revoked_at: int):
+        if revoked_at > self._revoked_before.get(user_id, 0):
+            self._revoked_before[user_id] = revoked_at
+        self.last_revoked_at = max(self.last_revoked_at, revoked_at)
+
+    def is_revoked(self, claims: dict) -> bool:
+        return claims["iat"] <= self._revoked_before.get(claims["uid"], 0)
+
+    def compact(self):
+        oldest_valid_issue = _now_ms() - SESSION_TOKEN_TTL * 1000
+        self._revoked_before = {
+            user_id: revoked_at for user_id, revoked_at in self._revoked_before.items()
+            if revoked_at >= oldest_valid_issue
+        }
+
+    def __len__(self) -> int:
+        return len(self._revoked_before)
+
+
+session_revocations = RevocationList()
@@ -0,0 +1,133 @@
+import logging
+from collections import OrderedDict
+from time import monotonic, time
+from typing import Dict, Hashable, Optional, Tuple
+
+from app.resp import RESPClient
+from app.settings import LOGIN_THROTTLE_ENABLED, LOGIN_THROTTLE_EMAIL_RATE, LOGIN_THROTTLE_EMAIL_BURST, \
+    LOGIN_THROTTLE_IP_RATE, LOGIN_THROTTLE_IP_BURST, LOGIN_THROTTLE_MAX_KEYS, LOGIN_THROTTLE_REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBuckets:
+    """
+    In-process token buckets, one per key, refilled at `rate` tokens per second up to `burst`
+
+    Buckets are kept in LRU order and the least recently used ones are dropped beyond
+    `max_keys`, a dropped bucket restarts full.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> (tokens, updated_at)
+        self._buckets: "OrderedDict[Hashable, Tuple[float, float]]" = OrderedDict()
+
+    async def acquire(self, key: Hashable) -> float:
+        """
+        Take a token from the bucket of `key`, returns 0 or the seconds until a token is available
+        """
+        now = monotonic()
+        tokens, updated_at = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / self.rate
+
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+# refill and take in one round trip, the bucket expires once it would be full again
+TOKEN_BUCKET_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 't', 'u')
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = math.min(burst, (tonumber(bucket[1]) or burst) + math.max(0, now - (tonumber(bucket[2]) or now)) * rate)
+local retry_after = 0
+if tokens >= 1 then tokens = tokens - 1 else retry_after = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 't', tostring(tokens), 'u', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(retry_after)
+"""
+
+
+class SharedTokenBuckets:
+    """
+    Token buckets stored on a Redis protocol server, shared by every worker using it
+
+    The server being unreachable must not take logins down with it, attempts are then
+    throttled by the in-process `fallback` buckets until the client retries the server.
+    """
+
+    def __init__(self, client: RESPClient, prefix: str, fallback: TokenBuckets):
+        self.client = client
+        self.prefix = prefix
+        self.fallback = fallback
+
+    async def acquire(self, key: Hashable) -> float:
+        if not self.client.available:
+            return await self.fallback.acquire(key)
+        try:
+            retry_after = await self.client.execute(
+                "EVAL", TOKEN_BUCKET_SCRIPT, 1, f"{self.prefix}:{key}",
+                self.fallback.rate, self.fallback.burst, f"{time():.6f}"
+            )
+            return float(retry_after)
+        except Exception as e:
+            logger.warning(f"shared throttle unavailable, using in-process buckets: {e}")
+            return await self.fallback.acquire(key)
+
+
+class LoginThrottle:
+    """
+    Admission control for password checks, attempts are limited per client IP and per email
+
+    The IP bucket is checked first so that a single client spraying many emails doesn't drain
+    the buckets of the accounts it targets.
+    """
+
+    def __init__(self, ip_buckets, email_buckets, enabled: bool = True):
+        self.ip_buckets = ip_buckets
+        self.email_buckets = email_buckets
+        self.enabled = enabled
+        self.admitted = 0
+        self.shed: Dict[str, int] = {"ip": 0, "email": 0}
+
+    async def acquire(self, ip: Optional[str], email: str) -> float:
+        """
+        Returns 0 when the attempt may proceed, else the seconds to wait before retrying
+        """
+        if not self.enabled:
+            return 0.0
+        if ip:
+            retry_after = await self.ip_buckets.acquire(ip)
+            if retry_after:
+                self.shed["ip"] += 1
+                return retry_after
+        retry_after = await self.email_buckets.acquire(email.lower())
+        if retry_after:
+            self.shed["email"] += 1
+            return retry_after
+        self.admitted += 1
+        return 0.0
+
+
+def init_login_throttle() -> LoginThrottle:
+    # settings are per minute, buckets refill per second
+    ip_buckets = TokenBuckets(LOGIN_THROTTLE_IP_RATE / 60, LOGIN_THROTTLE_IP_BURST, LOGIN_THROTTLE_MAX_KEYS)
+    email_buckets = TokenBuckets(LOGIN_THROTTLE_EMAIL_RATE / 60, LOGIN_THROTTLE_EMAIL_BURST, LOGIN_THROTTLE_MAX_KEYS)
+    if LOGIN_THROTTLE_REDIS_URL:
+        client = RESPClient(LOGIN_THROTTLE_REDIS_URL)
+        ip_buckets = SharedTokenBuckets(client, "login_throttle:ip", ip_buckets)
+        email_buckets = SharedTokenBuckets(client, "login_throttle:email", email_buckets)
+    return LoginThrottle(ip_buckets, email_buckets, enabled=LOGIN_THROTTLE_ENABLED)
+
+
+login_throttle = init_login_throttle()
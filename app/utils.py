@@ -1,73 +1,248 @@
+import asyncio
+import csv
+import io
+import json
 import logging
+from functools import lru_cache
 from hashlib import sha256
 
 import nanoid
 from base64 import b64encode
 
 from os import urandom
-from typing import Tuple, List
+from time import perf_counter
+from typing import AsyncIterator, Awaitable, Iterable, Tuple, List
 from uuid import UUID
 
 from databases import Database
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response
 from pymysql import IntegrityError
 
 from app.enums import Tables
+from app.metrics import record_serialize_time
+from app.negotiation import response_format, packb, unpackb, is_msgpack, JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPE
+from app.settings import QUERY_CACHE_SIZE, LOG_RESPONSE_BODY, LOG_RESPONSE_BODY_MAX_LENGTH
 
 logger = logging.getLogger(__name__)
 
 
+def _dump_json(content) -> bytes:
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
 def standard_response_generator(
-    success, message, http_status, data={}
+    success, message, http_status, data={}, headers: dict = None
 ):
-    logger.info("API RESPONSE")
     response = {
         "success": success,
         "message": message,
         "data": data,
     }
-    json_compatible_response = jsonable_encoder(response)
-    api_response = JSONResponse(status_code=http_status, content=json_compatible_response)
-    logger.info(f"RESPONSE_STATUS_CODE : {api_response.status_code}")
-    logger.info(f"RESPONSE_DATA : {response}")
-    logger.info(f"RESPONSE_HEADERS : {api_response.headers}")
+    # service payloads are plain dicts/lists of JSON types, encode them directly and only fall back
+    # to the generic encoder for anything json can't handle (records, datetimes, models, ...)
+    encode, media_type = _dump_json, JSON_MEDIA_TYPE
+    if response_format.get() == "msgpack":
+        encode, media_type = packb, MSGPACK_MEDIA_TYPE
+    start = perf_counter()
+    try:
+        body = encode(response)
+    except (TypeError, ValueError):
+        body = encode(jsonable_encoder(response))
+    record_serialize_time(perf_counter() - start)
+    api_response = Response(content=body, status_code=http_status, headers=headers, media_type=media_type)
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("API RESPONSE : RESPONSE_STATUS_CODE : %s", api_response.status_code)
+        if LOG_RESPONSE_BODY:
+            logger.info("RESPONSE_DATA : %s", body[:LOG_RESPONSE_BODY_MAX_LENGTH].decode("utf-8", "replace"))
+        logger.debug("RESPONSE_HEADERS : %s", api_response.headers)
     return api_response
 
 
-def create_insert_query_with_values(table: Tables, insert_data: dict) -> Tuple[str, dict]:
-    columns = ", ".join(list(insert_data.keys()))
-    columns_alias = ", ".join(f":{key}" for key in insert_data.keys())
-    query = f"INSERT INTO {table} ({columns}) VALUES ({columns_alias});"
-    return query, insert_data
+def content_etag(content) -> str:
+    """
+    Strong ETag of JSON serializable content, equal content gives the same ETag in every process
+    """
+    digest = sha256(json.dumps(content, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    If-None-Match uses the weak comparison, a W/ prefix is ignored
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def _param_name(column: str) -> str:
+    return column.replace(".", "_")
+
+
+def _where_clause(where_columns: Tuple[str, ...], conditions: Tuple[str, ...]) -> str:
+    clauses = [f"{column} = :{_param_name(column)}" for column in where_columns] + list(conditions)
+    return " WHERE " + " AND ".join(clauses) if clauses else ""
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _compile_select_query(
+    table: str, columns: Tuple[str, ...], where_columns: Tuple[str, ...], suffix: str,
+    conditions: Tuple[str, ...] = (), distinct: bool = False
+) -> str:
+    select = "SELECT DISTINCT" if distinct else "SELECT"
+    return f"{select} {', '.join(columns)} FROM {table}{_where_clause(where_columns, conditions)}{suffix};"
+
+
+def _insert_verb(ignore: bool) -> str:
+    return "INSERT IGNORE INTO" if ignore else "INSERT INTO"
+
 
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _compile_insert_query(
+    table: str, columns: Tuple[str, ...], ignore: bool = False, update_on_duplicate: Tuple[str, ...] = ()
+) -> str:
+    placeholders = ", ".join(f":{column}" for column in columns)
+    query = f"{_insert_verb(ignore)} {table} ({', '.join(columns)}) VALUES ({placeholders})"
+    if update_on_duplicate:
+        updates = ", ".join(f"{column} = VALUES({column})" for column in update_on_duplicate)
+        query += f" ON DUPLICATE KEY UPDATE {updates}"
+    return f"{query};"
 
-def create_update_query_with_values(table: Tables, update_data: dict, where_condition: dict) -> Tuple[str, dict]:
-    set_clause = ", ".join(f"{key} = :{key}" for key in update_data.keys())
-    where_clause = " AND ".join(f"{key} = :{key}" for key in where_condition.keys())
-    query = f"UPDATE {table} SET {set_clause} WHERE {where_clause};"
-    values = {**update_data, **where_condition}
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _compile_bulk_insert_query(table: str, columns: Tuple[str, ...], row_count: int, ignore: bool = False) -> str:
+    row_aliases = (
+        "(" + ", ".join(f":{column}_{index}" for column in columns) + ")" for index in range(row_count)
+    )
+    return f"{_insert_verb(ignore)} {table} ({', '.join(columns)}) VALUES {', '.join(row_aliases)};"
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _compile_update_query(
+    table: str, columns: Tuple[str, ...], where_columns: Tuple[str, ...], conditions: Tuple[str, ...] = ()
+) -> str:
+    set_clause = ", ".join(f"{column} = :{column}" for column in columns)
+    return f"UPDATE {table} SET {set_clause}{_where_clause(where_columns, conditions)};"
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _compile_case_update_query(table: str, column: str, key_column: str, row_count: int) -> str:
+    cases = " ".join(f"WHEN :{key_column}_{index} THEN :{column}_{index}" for index in range(row_count))
+    keys = ", ".join(f":{key_column}_{index}" for index in range(row_count))
+    return f"UPDATE {table} SET {column} = CASE {key_column} {cases} END WHERE {key_column} IN ({keys});"
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _compile_in_condition(column: str, alias: str, count: int) -> str:
+    return f"{column} IN ({', '.join(f':{alias}_{index}' for index in range(count))})"
+
+
+def _merge_conditions(conditions: List[Tuple[str, dict]] = None) -> Tuple[Tuple[str, ...], dict]:
+    texts, values = list(), dict()
+    for text, condition_values in conditions or []:
+        texts.append(text)
+        values.update(condition_values)
+    return tuple(texts), values
+
+
+def create_select_query_with_values(
+    table: str, columns: List[str], where_condition: dict = None, suffix: str = "",
+    conditions: List[Tuple[str, dict]] = None, distinct: bool = False
+) -> Tuple[str, dict]:
+    """
+    Create a SELECT with bound `column = :column` equality conditions
+
+    `table` may be a full FROM clause including joins, dotted column names are bound as `alias_column`.
+    `conditions` are further (condition, values) pairs built by the create_*_condition helpers, the
+    `suffix` is for ORDER BY and LIMIT. The statement text is cached per shape.
+    """
+    where_condition = where_condition or {}
+    condition_texts, condition_values = _merge_conditions(conditions)
+    query = _compile_select_query(table, tuple(columns), tuple(where_condition), suffix, condition_texts, distinct)
+    values = {_param_name(column): value for column, value in where_condition.items()}
+    values.update(condition_values)
     return query, values
 
 
-def create_query_params(columns: list = None, where_dict: dict = None):
-    where = ""
-    if columns:
-        columns = create_column_query(columns)
-    if where_dict:
-        where = create_where_condition(where_dict)
+def create_insert_query_with_values(
+    table: Tables, insert_data: dict, ignore: bool = False, update_on_duplicate: List[str] = None
+) -> Tuple[str, dict]:
+    """
+    Create an INSERT, `ignore` skips rows hitting a unique key, `update_on_duplicate` columns are overwritten instead
+    """
+    return _compile_insert_query(table, tuple(insert_data), ignore, tuple(update_on_duplicate or ())), insert_data
 
-    return columns, where
 
+def create_bulk_insert_query_with_values(table: Tables, rows: List[dict], ignore: bool = False) -> Tuple[str, dict]:
+    """
+    Create a single multi-row INSERT for rows sharing the same columns
+    """
+    columns = tuple(rows[0])
+    values = dict()
+    for index, row in enumerate(rows):
+        for column in columns:
+            values[f"{column}_{index}"] = row[column]
+    return _compile_bulk_insert_query(table, columns, len(rows), ignore), values
 
-def create_where_condition(where_dict: dict):
-    where_condition = " AND ".join(list(where_dict.keys()))
-    where_condition = where_condition % tuple(where_dict.values())
-    return where_condition
 
+def create_in_condition(column: str, values: list, alias: str = None) -> Tuple[str, dict]:
+    """
+    Create a bound `column IN (...)` condition along with its values
+    """
+    alias = alias or _param_name(column)
+    in_values = {f"{alias}_{index}": value for index, value in enumerate(values)}
+    return _compile_in_condition(column, alias, len(values)), in_values
 
-def create_column_query(columns: list):
-    return ", ".join(columns)
+
+COMPARISON_OPERATORS = frozenset(("=", "!=", "<", "<=", ">", ">="))
+
+
+def create_comparison_condition(column: str, operator: str, value, alias: str = None) -> Tuple[str, dict]:
+    """
+    Create a bound `column <operator> :alias` condition, e.g. the `> :after` of keyset pagination
+    """
+    if operator not in COMPARISON_OPERATORS:
+        raise ValueError(f"unsupported comparison operator {operator}")
+    alias = alias or _param_name(column)
+    return f"{column} {operator} :{alias}", {alias: value}
+
+
+def create_null_condition(column: str, is_null: bool = True) -> Tuple[str, dict]:
+    return f"{column} IS {'' if is_null else 'NOT '}NULL", {}
+
+
+def create_or_condition(conditions: List[Tuple[str, dict]]) -> Tuple[str, dict]:
+    """
+    Combine conditions with OR, their aliases must not collide
+    """
+    texts, values = _merge_conditions(conditions)
+    return f"({' OR '.join(texts)})", values
+
+
+def create_update_query_with_values(
+    table: Tables, update_data: dict, where_condition: dict, conditions: List[Tuple[str, dict]] = None
+) -> Tuple[str, dict]:
+    condition_texts, condition_values = _merge_conditions(conditions)
+    query = _compile_update_query(table, tuple(update_data), tuple(where_condition), condition_texts)
+    values = {**update_data, **where_condition, **condition_values}
+    return query, values
+
+
+def create_case_update_query_with_values(
+    table: Tables, column: str, key_column: str, updates: dict
+) -> Tuple[str, dict]:
+    """
+    Create a single UPDATE setting `column` to a different value per `key_column` value
+    """
+    values = dict()
+    for index, (key, value) in enumerate(updates.items()):
+        values[f"{key_column}_{index}"] = key
+        values[f"{column}_{index}"] = value
+    return _compile_case_update_query(table, column, key_column, len(updates)), values
 
 
 async def execute_transactional_queries(db: Database, queries: List[Tuple[str, dict]]):
@@ -76,6 +251,64 @@ async def execute_transactional_queries(db: Database, queries: List[Tuple[str, d
             await db.execute(query=query_data[0], values=query_data[1])
 
 
+async def ndjson_stream(rows: AsyncIterator[dict], logger) -> AsyncIterator[bytes]:
+    """
+    Encode rows as newline delimited JSON
+
+    A failure is logged and raised again, the server then aborts the response instead of ending
+    the chunked body cleanly, so clients can't mistake a truncated export for a complete one.
+    """
+    try:
+        async for row in rows:
+            yield json.dumps(row, ensure_ascii=False, default=str).encode("utf-8") + b"\n"
+    except Exception as e:
+        logger.error(f"failed to stream rows due to {e}")
+        raise
+
+
+async def gather_limited(coroutines: Iterable[Awaitable], limit: int) -> list:
+    """
+    asyncio.gather running at most `limit` of the coroutines at a time
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
+
+
+def chunked(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def parse_bulk_rows(body: bytes, content_type: str) -> List[dict]:
+    """
+    Parse a bulk upload sent either as a JSON or MessagePack array or as CSV with a header row
+
+    Raises ValueError if the body cannot be parsed.
+    """
+    if "csv" in (content_type or ""):
+        reader = csv.DictReader(io.StringIO(body.decode("utf-8-sig"), newline=""))
+        try:
+            return [{key: value for key, value in row.items() if key and value not in (None, "")} for row in reader]
+        except csv.Error as e:
+            raise ValueError(str(e))
+
+    if is_msgpack(content_type):
+        try:
+            rows = unpackb(body)
+        except Exception as e:
+            raise ValueError(f"invalid MessagePack body: {e}")
+    else:
+        rows = json.loads(body or b"null")
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ValueError("expected an array of objects")
+    return rows
+
+
 def _is_valid_uuid(val):
     try:
         UUID(str(val))
@@ -107,10 +340,15 @@ def get_passkey(password: str, salt: str):
     return sha256(bytes("{}{}".format(password, salt), encoding="utf-8")).hexdigest()
 
 
-def is_unique_violation(exc: Exception) -> bool:
+def is_unique_violation(exc: Exception, key: str = None) -> bool:
+    """
+    True for a duplicate entry error, on the unique key named `key` when given
+    """
     if isinstance(exc, IntegrityError):
-        orig = getattr(exc, "orig", None)
-        if orig and hasattr(orig, "args") and len(orig.args) > 0:
+        # aiomysql raises the pymysql error itself, other drivers wrap it in `orig`
+        orig = getattr(exc, "orig", None) or exc
+        if hasattr(orig, "args") and len(orig.args) > 0:
             if orig.args[0] == 1062:
-                return True
+                # "Duplicate entry '...' for key '[table.]<key>'"
+                return key is None or (len(orig.args) > 1 and f"{key}'" in str(orig.args[1]))
     return False
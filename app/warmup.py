@@ -0,0 +1,115 @@
+"""
+Startup warm-up, run in the background while /ready keeps the pod out of rotation
+
+    1. ping the primary and the replica once, their pools opened DB_POOL_MIN_SIZE connections on connect
+    2. cache the users and permissions of the WARMUP_SESSION_LIMIT most recently active sessions
+    3. cache the permission sets of up to WARMUP_ENTITY_LIMIT entities of those users
+
+/ready is marked ready once warm-up finishes, fails or runs past WARMUP_TIMEOUT, whichever comes first.
+
+The email filter is loaded separately by `load_email_filter`, creations query MySQL until it's ready.
+"""
+import asyncio
+from time import perf_counter
+
+from fastapi import FastAPI
+
+from app.bloom import email_filter
+from app.cache import auth_token_cache, session_permission_cache
+from app.services.permissions import EntityPermissions
+from app.services.user_details import UserCreation, UserDetails
+from app.session_tokens import signed_tokens_enabled
+from app.settings import DB_POOL_MIN_SIZE, WARMUP_SESSION_LIMIT, WARMUP_ENTITY_LIMIT, WARMUP_TIMEOUT, \
+    EMAIL_FILTER_LOAD_BATCH_SIZE
+from app.utils import gather_limited
+
+
+async def ping(db):
+    await db.fetch_val("SELECT 1;")
+
+
+async def warm_sessions(app: FastAPI, limit: int):
+    """
+    Cache the recently active users, returns their user ids
+    """
+    user_details_processor = UserDetails(db=app.db, read_db=app.read_db, logger=app.logger)
+    signed = signed_tokens_enabled()
+    success, users = await user_details_processor.fetch_recently_active_users(limit, with_token=not signed)
+    if not success:
+        return []
+
+    async def warm_user(user: dict):
+        success, permissions = await user_details_processor.fetch_user_permissions(user["user_id"])
+        if not success:
+            return
+        if signed:
+            await session_permission_cache.set(user["user_id"], (True, permissions))
+        else:
+            data = {key: user[key] for key in ("user_id", "user_name", "is_chief_admin")}
+            await auth_token_cache.set(user["authentication_token"], {**data, "permissions": permissions})
+
+    await gather_limited((warm_user(user) for user in users), DB_POOL_MIN_SIZE)
+    return [user["user_id"] for user in users]
+
+
+async def warm_entity_permissions(app: FastAPI, user_ids: list, limit: int) -> int:
+    if not user_ids:
+        return 0
+    success, entity_ids = await UserDetails(
+        db=app.db, read_db=app.read_db, logger=app.logger
+    ).fetch_user_entity_ids(user_ids)
+    if not success:
+        return 0
+
+    entity_permissions = EntityPermissions(db=app.db, read_db=app.read_db, logger=app.logger)
+    entity_ids = entity_ids[:limit]
+    await gather_limited(
+        (entity_permissions.fetch_entity_permissions(entity_id) for entity_id in entity_ids), DB_POOL_MIN_SIZE
+    )
+    return len(entity_ids)
+
+
+async def warm_up(app: FastAPI):
+    start = perf_counter()
+    await ping(app.db)
+    if app.read_db is not app.db:
+        await ping(app.read_db)
+    user_ids = await warm_sessions(app, WARMUP_SESSION_LIMIT)
+    entities = await warm_entity_permissions(app, user_ids, WARMUP_ENTITY_LIMIT)
+    app.logger.info(
+        f"✅ warm-up done in {perf_counter() - start:.2f}s, {len(user_ids)} sessions and {entities} entities cached"
+    )
+
+
+async def run_warm_up(app: FastAPI):
+    """
+    Warm up within WARMUP_TIMEOUT seconds, the app is marked ready afterwards even if warm-up failed
+    """
+    try:
+        await asyncio.wait_for(warm_up(app), WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        app.logger.error(f"warm-up didn't finish within {WARMUP_TIMEOUT}s, serving with partially warm caches")
+    except Exception as e:
+        app.logger.error(f"warm-up failed due to {e}")
+    app.ready = True
+
+
+async def load_email_filter(app: FastAPI):
+    start = perf_counter()
+    user_creation_processor = UserCreation(db=app.db, read_db=app.read_db, logger=app.logger)
+    try:
+        # without the unique key an email the filter calls absent could be inserted twice
+        if not await user_creation_processor.has_user_email_unique_key():
+            app.logger.warning(
+                f"{UserCreation.user_email_unique_key} is missing, existence checks keep querying MySQL"
+            )
+            return
+        await email_filter.load(user_creation_processor.iterate_user_emails(EMAIL_FILTER_LOAD_BATCH_SIZE))
+    except Exception as e:
+        app.logger.error(f"failed to load the email filter due to {e}, existence checks keep querying MySQL")
+        return
+    bloom = email_filter.bloom
+    app.logger.info(
+        f"✅ email filter loaded in {perf_counter() - start:.2f}s, {bloom.count} emails in "
+        f"{bloom.memory_bytes / 2 ** 20:.1f} MiB, expected false positive rate {bloom.expected_error_rate():.2%}"
+    )
@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from app.settings import TOKEN_WRITE_BEHIND_JOURNAL, TOKEN_WRITE_BEHIND_MAX_DELAY_MS, TOKEN_WRITE_BEHIND_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindJournal:
+    """
+    Append-only journal of `key<TAB>value` records, an empty value discards the key
+
+    New records go to `path`. When a flush starts, every record appended so far is moved to
+    `path.flushing`, which is removed once the flush committed. Replay reads both, the last record
+    of a key wins.
+
+    Appends return once their record is synced to disk. Records appended while a sync runs are
+    written and synced together by the next one (group commit), or by the rotation if it comes
+    first. File operations run in order on a single thread, off the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.flushing_path = Path(f"{path}.flushing")
+        self.syncs = 0
+        self._fd: Optional[int] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="write-behind-journal")
+        self._buffer: List[bytes] = []
+        self._waiters: List[asyncio.Future] = []
+        self._sync_task: Optional[asyncio.Task] = None
+
+    def _submit(self, fn: Callable, *args) -> asyncio.Future:
+        # submitted right away, file operations run in the order they were submitted
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def append(self, key: str, value: Optional[str]) -> asyncio.Future:
+        """
+        Buffer a record, the returned future resolves once it is synced
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._buffer.append(f"{key}\t{value or ''}\n".encode("utf-8"))
+        self._waiters.append(waiter)
+        if self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync())
+        return waiter
+
+    def _take_buffer(self):
+        records, waiters = b"".join(self._buffer), self._waiters
+        self._buffer, self._waiters = [], []
+        return records, waiters
+
+    def _settle(self, waiters: List[asyncio.Future], written: asyncio.Future):
+        error = written.exception() if not written.cancelled() else asyncio.CancelledError()
+        if error is None:
+            self.syncs += 1
+        for waiter in waiters:
+            if not waiter.done():
+                if error is None:
+                    waiter.set_result(None)
+                else:
+                    waiter.set_exception(error)
+
+    async def _sync(self):
+        try:
+            while self._buffer:
+                records, waiters = self._take_buffer()
+                written = self._submit(self._write, records)
+                await asyncio.wait([written])
+                self._settle(waiters, written)
+        finally:
+            self._sync_task = None
+
+    def _write(self, records: bytes):
+        if self._fd is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        os.write(self._fd, records)
+        os.fsync(self._fd)
+
+    def rotate(self) -> asyncio.Future:
+        """
+        Move every record appended so far to `path.flushing`, later records go to the new `path`
+
+        Records still buffered are written by the rotation itself. A sync in flight was submitted before
+        it and completes first, so no record appended before the rotation can land in the new `path`.
+        """
+        records, waiters = self._take_buffer()
+        rotated = self._submit(self._rotate, records)
+        if waiters:
+            rotated.add_done_callback(lambda written: self._settle(waiters, written))
+        return rotated
+
+    def commit(self) -> asyncio.Future:
+        return self._submit(self._commit)
+
+    def _rotate(self, records: bytes):
+        if records:
+            self._write(records)
+        self._close()
+        if not self.path.exists():
+            return
+        # a failed flush leaves its records behind, new ones are appended after them
+        with open(self.flushing_path, "ab") as flushing:
+            flushing.write(self.path.read_bytes())
+            flushing.flush()
+            os.fsync(flushing.fileno())
+        self.path.unlink()
+
+    def _commit(self):
+        if self.flushing_path.exists():
+            self.flushing_path.unlink()
+
+    def replay(self) -> Dict[str, str]:
+        records = dict()
+        for path in (self.flushing_path, self.path):
+            if not path.exists():
+                continue
+            for line in path.read_text("utf-8").splitlines():
+                key, _, value = line.partition("\t")
+                if value:
+                    records[key] = value
+                else:
+                    records.pop(key, None)
+        return records
+
+    async def close(self):
+        if self._sync_task is not None:
+            await self._sync_task
+        await self._submit(self._close)
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class TokenWriteBehind:
+    """
+    Write-behind buffer for user_id -> authentication token updates
+
+    `record` journals a token and keeps it pending, a background task hands the pending tokens
+    to `flush_fn` at most `max_delay` seconds later, or as soon as `batch_size` are pending.
+    `flush_fn(tokens)` must return True once the tokens are stored, failed flushes are retried.
+    """
+
+    def __init__(self, journal_path: str, max_delay: float, batch_size: int):
+        self.journal = WriteBehindJournal(journal_path)
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.flushed = 0
+        self.flushes = 0
+        self._flush_fn: Optional[Callable[[Dict[str, str]], Awaitable[bool]]] = None
+        self._pending: Dict[str, str] = {}
+        # latest unflushed token of every user, pending or being flushed, and its reverse
+        self._user_tokens: Dict[str, str] = {}
+        self._token_users: Dict[str, str] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, flush_fn: Callable[[Dict[str, str]], Awaitable[bool]]):
+        """
+        Replay the journal left by a previous process and start the background flushes
+        """
+        self._flush_fn = flush_fn
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        for user_id, token in self.journal.replay().items():
+            self._set_pending(user_id, token)
+        await self.flush()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        await self.journal.close()
+
+    def _set_pending(self, user_id: str, token: str):
+        self._token_users.pop(self._user_tokens.get(user_id), None)
+        self._pending[user_id] = token
+        self._user_tokens[user_id] = token
+        self._token_users[token] = user_id
+
+    async def record(self, user_id: str, token: str):
+        """
+        Keep the token pending and journal it, returns once the journal record is on disk
+        """
+        # the record is buffered in the same step as the token becomes pending, a flush taking the
+        # pending tokens therefore rotates every record of its batch, synced or still buffered
+        journaled = self.journal.append(user_id, token)
+        self._set_pending(user_id, token)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        try:
+            await asyncio.shield(journaled)
+        except Exception:
+            if self._pending.get(user_id) == token:
+                del self._pending[user_id]
+                self._token_users.pop(self._user_tokens.pop(user_id), None)
+            raise
+
+    async def discard(self, user_id: str):
+        """
+        Drop the pending token of a user whose token is about to be written directly
+        """
+        async with self._flush_lock:
+            if user_id in self._pending:
+                journaled = self.journal.append(user_id, None)
+                del self._pending[user_id]
+                self._token_users.pop(self._user_tokens.pop(user_id), None)
+                await journaled
+
+    def pending_user(self, token: str) -> Optional[str]:
+        """
+        User of a token that hasn't been flushed yet
+        """
+        return self._token_users.get(token)
+
+    def pending_token(self, user_id: str) -> Optional[str]:
+        """
+        Token of the user that hasn't been flushed yet, it supersedes the token stored in user_details
+        """
+        return self._user_tokens.get(user_id)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> bool:
+        async with self._flush_lock:
+            if not self._pending:
+                return True
+            batch, self._pending = self._pending, {}
+            flushed = False
+            try:
+                await self.journal.rotate()
+                items = list(batch.items())
+                for start in range(0, len(items), self.batch_size):
+                    if not await self._flush_fn(dict(items[start:start + self.batch_size])):
+                        return False
+                flushed = True
+            except Exception as e:
+                logger.error(f"failed to flush authentication tokens due to {e}")
+                return False
+            finally:
+                if not flushed:
+                    # tokens recorded while flushing are newer than the batch
+                    self._pending = {**batch, **self._pending}
+
+            await self.journal.commit()
+            self.flushes += 1
+            self.flushed += len(batch)
+            for user_id, token in batch.items():
+                if self._user_tokens.get(user_id) == token:
+                    del self._user_tokens[user_id]
+                    del self._token_users[token]
+            return True
+
+
+token_write_behind = TokenWriteBehind(
+    TOKEN_WRITE_BEHIND_JOURNAL, TOKEN_WRITE_BEHIND_MAX_DELAY_MS / 1000, TOKEN_WRITE_BEHIND_BATCH_SIZE
+)
@@ -0,0 +1,57 @@
+"""
+Memory and false positive rate of the email Bloom filter
+
+Fills a filter sized for the given number of emails (5M by default) at the configured
+EMAIL_FILTER_ERROR_RATE, then probes it with as many emails that were never added. A set of
+the same emails is measured for comparison.
+
+    python -m benchmarks.email_filter [emails]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("DB_PORT", "3306")
+
+from app.bloom import BloomFilter  # noqa: E402
+from app.settings import EMAIL_FILTER_ERROR_RATE  # noqa: E402
+
+PROBES = 1000000
+
+
+def email(index: int, domain: str = "school.example.com") -> str:
+    return f"student.{index:08d}@{domain}"
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+    bloom = BloomFilter(count, EMAIL_FILTER_ERROR_RATE)
+
+    start = time.perf_counter()
+    for index in range(count):
+        bloom.add(email(index))
+    add_us = (time.perf_counter() - start) / count * 1e6
+
+    probes = min(PROBES, count)
+    start = time.perf_counter()
+    false_positives = sum(1 for index in range(probes) if email(index, "other.example.com") in bloom)
+    check_us = (time.perf_counter() - start) / probes * 1e6
+    assert all(email(index) in bloom for index in range(0, count, 997)), "added email reported absent"
+
+    tracemalloc.start()
+    emails = {email(index) for index in range(min(count, 1000000))}
+    set_bytes = tracemalloc.get_traced_memory()[0] / len(emails) * count
+    tracemalloc.stop()
+    del emails
+
+    print(f"emails                 {count}")
+    print(f"bits / hash functions  {bloom.size} / {bloom.hash_count}")
+    print(f"filter memory          {bloom.memory_bytes / 2 ** 20:.2f} MiB ({bloom.memory_bytes * 8 / count:.1f} bits/email)")
+    print(f"set of emails memory   {set_bytes / 2 ** 20:.0f} MiB (extrapolated)")
+    print(f"false positive rate    {false_positives / probes:.3%} measured, {bloom.expected_error_rate():.3%} expected")
+    print(f"add / check            {add_us:.2f} us / {check_us:.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+JSON vs MessagePack for the payloads internal callers exchange with the service
+
+Payloads are the 50 permission set response of benchmarks.response_encoding and a user lookup
+response of 100 users. Encoding runs through standard_response_generator with each response
+format, decoding is what a Python caller does with the body.
+
+    python -m benchmarks.msgpack_encoding
+"""
+import json
+import logging
+import os
+import timeit
+from http import HTTPStatus
+
+os.environ.setdefault("DB_PORT", "3306")
+
+import msgpack  # noqa: E402
+
+from app.negotiation import response_format  # noqa: E402
+from app.utils import standard_response_generator  # noqa: E402
+from benchmarks.response_encoding import permission_payload  # noqa: E402
+
+ITERATIONS = 2000
+
+
+def user_payload(users: int = 100) -> dict:
+    return {
+        f"{index:010d}": {
+            "user_id": f"{index:010d}",
+            "user_name": f"user {index}",
+            "user_email": f"user{index}@example.com",
+            "user_code": f"C{index:05d}",
+            "is_chief_admin": False,
+            "active": True,
+            "entities": [{"entity_id": f"{index % 7:012d}", "user_role": "teacher", "permission_id": "perm0001"}],
+        }
+        for index in range(users)
+    }
+
+
+def bench(label: str, data: dict):
+    results = dict()
+    for format_name, decode in (("json", json.loads), ("msgpack", msgpack.unpackb)):
+        token = response_format.set(format_name)
+        try:
+            body = standard_response_generator(True, "ok", HTTPStatus.OK, data).body
+            encode_seconds = timeit.timeit(
+                lambda: standard_response_generator(True, "ok", HTTPStatus.OK, data), number=ITERATIONS
+            )
+        finally:
+            response_format.reset(token)
+        decode_seconds = timeit.timeit(lambda: decode(body), number=ITERATIONS)
+        results[format_name] = (len(body), encode_seconds / ITERATIONS * 1e6, decode_seconds / ITERATIONS * 1e6)
+
+    for format_name, (size, encode_us, decode_us) in results.items():
+        print(f"{label:<22}{format_name:<9}{size:>9}{encode_us:>13.1f}{decode_us:>13.1f}")
+    json_size, msgpack_size = results["json"][0], results["msgpack"][0]
+    print(f"{'':<22}{'size':<9}{msgpack_size / json_size:>9.0%}")
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    print(f"{'payload':<22}{'format':<9}{'bytes':>9}{'encode us':>13}{'decode us':>13}")
+    bench("50 permission sets", permission_payload())
+    bench("100 users", user_payload())
+
+
+if __name__ == "__main__":
+    main()
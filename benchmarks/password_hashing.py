@@ -0,0 +1,57 @@
+"""
+Login throughput per core for each password hashing cost setting
+
+Every login verifies exactly one passkey, so the verifications per second of a single
+worker thread is the login throughput ceiling of one core. The pool column runs the same
+verifications through app.passwords.check_password to show the event loop overhead.
+
+    python -m benchmarks.password_hashing
+"""
+import asyncio
+import os
+import time
+
+os.environ.setdefault("DB_PORT", "3306")
+
+from app.passwords import make_passkey, verify_passkey, check_password  # noqa: E402
+from app.utils import generate_salt  # noqa: E402
+
+SETTINGS = [
+    ("sha256", {}),
+    ("pbkdf2_sha256", {"iterations": 100000}),
+    ("pbkdf2_sha256", {"iterations": 310000}),
+    ("pbkdf2_sha256", {"iterations": 600000}),
+    ("scrypt", {"n": 2 ** 14, "r": 8, "p": 1}),
+    ("scrypt", {"n": 2 ** 15, "r": 8, "p": 1}),
+    ("scrypt", {"n": 2 ** 16, "r": 8, "p": 1}),
+]
+MIN_DURATION = 1.0
+
+
+def bench_single_core(passkey: str, salt: str) -> float:
+    count, start = 0, time.perf_counter()
+    while time.perf_counter() - start < MIN_DURATION:
+        verify_passkey(passkey, salt, "Password@1234")
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+async def bench_pool(passkey: str, salt: str, count: int) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*(check_password(passkey, salt, "Password@1234") for _ in range(count)))
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    print(f"{'setting':<36}{'ms/login':>10}{'logins/s/core':>16}{'logins/s pool':>16}")
+    for algorithm, params in SETTINGS:
+        salt = generate_salt()
+        passkey = make_passkey("Password@1234", salt, algorithm, **params)
+        per_core = bench_single_core(passkey, salt)
+        pooled = asyncio.run(bench_pool(passkey, salt, max(int(per_core * MIN_DURATION), 4)))
+        label = algorithm + "".join(f" {key}={value}" for key, value in params.items())
+        print(f"{label:<36}{1000 / per_core:>10.2f}{per_core:>16.1f}{pooled:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
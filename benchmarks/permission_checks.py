@@ -0,0 +1,106 @@
+"""
+Bitmask PermissionIndex vs the original walk over the user's permission dicts
+
+The dict walk is reproduced inline from the original verify_permission. Both sides hold the
+merged permissions of a user linked to 5 permission sets over 20 submodules with 10 endpoints
+each; memory is the tracemalloc'd size of the structure cached per user.
+
+    python -m benchmarks.permission_checks
+"""
+import copy
+import os
+import timeit
+import tracemalloc
+from functools import partial
+
+os.environ.setdefault("DB_PORT", "3306")
+
+from app.permission_index import PermissionIndex, compile_permission_masks, permission_registry  # noqa: E402
+
+ITERATIONS = 200000
+MODULE = "USER"
+
+
+def permission_set(offset: int, submodules: int = 20, endpoints: int = 10) -> dict:
+    return {
+        MODULE: {
+            f"submodule_{submodule}": {
+                "read": {f"endpoint_{endpoint}": ["GET"] for endpoint in range(endpoints)},
+                "write": {
+                    f"endpoint_{endpoint}": ["POST", "PATCH"] for endpoint in range(endpoints) if endpoint % 5 == offset
+                },
+            }
+            for submodule in range(submodules)
+        }
+    }
+
+
+def merge_permission_sets(permission_sets: list) -> dict:
+    merged = dict()
+    for permission_json in permission_sets:
+        for submodule, grants in permission_json[MODULE].items():
+            target = merged.setdefault(MODULE, {}).setdefault(submodule, {"read": {}, "write": {}})
+            for access in ("read", "write"):
+                for endpoint, methods in grants[access].items():
+                    target[access][endpoint] = sorted(set(target[access].get(endpoint, [])) | set(methods))
+    return merged
+
+
+def dict_walk_allows(permissions: dict, submodules: list, endpoint: str, method: str) -> bool:
+    service_permissions = permissions.get(MODULE, {})
+    for submodule in submodules:
+        submodule_permissions = service_permissions.get(submodule, {})
+        if method in (
+            submodule_permissions.get("read", {}).get(endpoint, [])
+            + submodule_permissions.get("write", {}).get(endpoint, [])
+        ):
+            return True
+    return False
+
+
+def build_index(permission_sets: list) -> PermissionIndex:
+    slot_sets = list()
+    for permission_json in permission_sets:
+        name_masks = compile_permission_masks(permission_json)
+        for name in name_masks:
+            if permission_registry.slot(*name) is None:
+                permission_registry.add(permission_registry.max_slot_id + 1, *name)
+        slot_sets.append(permission_registry.slot_masks(name_masks))
+    return PermissionIndex.from_slot_masks(slot_sets)
+
+
+def traced_size(build) -> int:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    value = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del value
+    return sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+
+def main():
+    permission_sets = [permission_set(offset) for offset in range(5)]
+    merged = merge_permission_sets(permission_sets)
+    index = build_index(permission_sets)
+
+    checks = [
+        (("submodule_3", "submodule_19"), "endpoint_9", "GET"),
+        (("submodule_7",), "endpoint_4", "PATCH"),
+        (("submodule_1", "submodule_2"), "endpoint_3", "DELETE"),
+    ]
+    for submodules, endpoint, method in checks:
+        assert dict_walk_allows(merged, submodules, endpoint, method) == index.allows(MODULE, submodules, endpoint, method)
+
+    implementations = (("dict walk", partial(dict_walk_allows, merged)), ("bitmask", partial(index.allows, MODULE)))
+    for label, allows in implementations:
+        seconds = timeit.timeit(lambda: [allows(*check) for check in checks], number=ITERATIONS // len(checks))
+        print(f"{label:>9}: {seconds / ITERATIONS * 1e9:7.0f} ns/check")
+
+    print(f"dict walk: {traced_size(lambda: copy.deepcopy(merged)):7d} bytes/user")
+    print(f"  bitmask: {traced_size(lambda: PermissionIndex(dict(index._masks))):7d} bytes/user")
+    print(f" registry: {len(permission_registry)} slots, shared by every user")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Old vs new standard_response_generator on a 50 permission set payload
+
+The old path is reproduced inline: jsonable_encoder + JSONResponse with the three
+eagerly formatted INFO log lines. Logging is configured at WARNING for both runs,
+matching production where INFO is dropped downstream.
+
+    python -m benchmarks.response_encoding
+"""
+import logging
+import os
+import timeit
+from http import HTTPStatus
+
+os.environ.setdefault("DB_PORT", "3306")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+from app.utils import standard_response_generator  # noqa: E402
+
+logger = logging.getLogger("benchmarks.response_encoding")
+ITERATIONS = 2000
+
+
+def old_standard_response_generator(success, message, http_status, data={}):
+    logger.info("API RESPONSE")
+    response = {
+        "success": success,
+        "message": message,
+        "data": data,
+    }
+    json_compatible_response = jsonable_encoder(response)
+    api_response = JSONResponse(status_code=http_status, content=json_compatible_response)
+    logger.info(f"RESPONSE_STATUS_CODE : {api_response.status_code}")
+    logger.info(f"RESPONSE_DATA : {response}")
+    logger.info(f"RESPONSE_HEADERS : {api_response.headers}")
+    return api_response
+
+
+def permission_payload(permission_sets: int = 50) -> dict:
+    data = dict()
+    for index in range(permission_sets):
+        permission_id = f"perm{index:04d}"
+        data[permission_id] = {
+            "permission_id": permission_id,
+            "permission_name": f"permission set {index}",
+            "permission_json": {
+                "USER": {
+                    f"submodule_{submodule}": {"read": True, "write": submodule % 2 == 0}
+                    for submodule in range(20)
+                }
+            }
+        }
+    return data
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    data = permission_payload()
+    old = old_standard_response_generator(True, "ok", HTTPStatus.OK, data)
+    new = standard_response_generator(True, "ok", HTTPStatus.OK, data)
+    assert old.body == new.body, "encodings differ"
+
+    for label, func in (("old", old_standard_response_generator), ("new", standard_response_generator)):
+        seconds = timeit.timeit(lambda: func(True, "ok", HTTPStatus.OK, data), number=ITERATIONS)
+        print(f"{label}: {seconds / ITERATIONS * 1e6:9.1f} us/response  ({len(new.body)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
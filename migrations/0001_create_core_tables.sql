@@ -0,0 +1,54 @@
+-- core user service tables and the indexes backing its hot lookups. Existing databases keep their tables,
+-- changes to them are made by the ALTER TABLE migrations that follow
+
+CREATE TABLE IF NOT EXISTS user_details (
+    user_id VARCHAR(10) NOT NULL,
+    user_name VARCHAR(255) NOT NULL,
+    user_email VARCHAR(255) NOT NULL,
+    user_code VARCHAR(10) NULL,
+    authentication_token CHAR(36) NULL,
+    is_chief_admin BOOLEAN NOT NULL DEFAULT FALSE,
+    active BOOLEAN NOT NULL DEFAULT TRUE,
+    is_deleted BOOLEAN NOT NULL DEFAULT FALSE,
+    created_by VARCHAR(10) NULL,
+    updated_by VARCHAR(10) NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;
+
+CREATE TABLE IF NOT EXISTS user_authentication (
+    user_id VARCHAR(10) NOT NULL,
+    user_passkey VARCHAR(255) NOT NULL,
+    salt VARCHAR(32) NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id),
+    CONSTRAINT fk_user_authentication_user FOREIGN KEY (user_id) REFERENCES user_details (user_id)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;
+
+CREATE TABLE IF NOT EXISTS entity_permissions (
+    permission_id VARCHAR(8) NOT NULL,
+    entity_id VARCHAR(12) NOT NULL,
+    permission_name VARCHAR(255) NOT NULL,
+    permission_json JSON NOT NULL,
+    active BOOLEAN NOT NULL DEFAULT TRUE,
+    created_by VARCHAR(10) NULL,
+    updated_by VARCHAR(10) NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (permission_id)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;
+
+CREATE TABLE IF NOT EXISTS user_entity_details (
+    entity_id VARCHAR(12) NOT NULL,
+    user_id VARCHAR(10) NOT NULL,
+    user_role VARCHAR(20) NOT NULL,
+    permission_id VARCHAR(8) NOT NULL,
+    created_by VARCHAR(10) NULL,
+    updated_by VARCHAR(10) NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, entity_id),
+    CONSTRAINT fk_user_entity_details_user FOREIGN KEY (user_id) REFERENCES user_details (user_id)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;
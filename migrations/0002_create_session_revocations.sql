@@ -0,0 +1,8 @@
+-- per user cut-off of signed session tokens, see app.session_tokens.RevocationList
+
+CREATE TABLE IF NOT EXISTS session_revocations (
+    user_id VARCHAR(10) NOT NULL,
+    revoked_at BIGINT NOT NULL,
+    PRIMARY KEY (user_id),
+    KEY idx_session_revocations_revoked_at (revoked_at)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;
@@ -0,0 +1,14 @@
+-- interned (module, submodule, endpoint) names and the compact permission bitmasks referencing them,
+-- see app.permission_index. Sets created before this migration get their permission_bits compiled
+-- from permission_json by the backfill of `python -m app.migrations upgrade`.
+
+CREATE TABLE IF NOT EXISTS permission_slots (
+    slot_id INT UNSIGNED NOT NULL AUTO_INCREMENT,
+    module VARCHAR(64) NOT NULL,
+    submodule VARCHAR(64) NOT NULL,
+    endpoint VARCHAR(128) NOT NULL,
+    PRIMARY KEY (slot_id),
+    UNIQUE KEY uq_permission_slots_name (module, submodule, endpoint)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;
+
+ALTER TABLE entity_permissions ADD COLUMN permission_bits VARBINARY(4096) NULL AFTER permission_json;
@@ -0,0 +1,3 @@
+-- recently active users for the startup warm-up, see app.warmup
+
+ALTER TABLE user_details ADD KEY idx_user_details_updated_at (updated_at);
@@ -0,0 +1,16 @@
+-- widen user_passkey for the algorithm$params$digest passkeys of app.passwords, and a unique key for the
+-- token lookup of login_required. A token shared by several users can't authenticate any of them reliably,
+-- duplicates are cleared first, which logs those users out.
+
+ALTER TABLE user_authentication MODIFY user_passkey VARCHAR(255) NOT NULL;
+
+UPDATE user_details AS duplicate
+JOIN (
+    SELECT authentication_token FROM user_details
+    WHERE authentication_token IS NOT NULL
+    GROUP BY authentication_token HAVING COUNT(*) > 1
+) AS shared USING (authentication_token)
+SET duplicate.authentication_token = NULL;
+
+ALTER TABLE user_details
+    ADD UNIQUE KEY uq_user_details_authentication_token (authentication_token), ALGORITHM = INPLACE, LOCK = NONE;
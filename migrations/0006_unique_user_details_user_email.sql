@@ -0,0 +1,13 @@
+-- unique key for the email lookups of login and user creation, creations rely on it to catch duplicates
+-- the email filter of app.bloom can't see.
+--
+-- Duplicate emails (compared case insensitively) make this migration fail and have to be merged by hand
+-- first, they are listed by:
+--
+--     SELECT user_email, GROUP_CONCAT(user_id) FROM user_details GROUP BY user_email HAVING COUNT(*) > 1;
+--
+-- keep one user_id per email, move its user_entity_details rows over and delete the other users together
+-- with their user_authentication rows, then run the upgrade again.
+
+ALTER TABLE user_details
+    ADD UNIQUE KEY uq_user_details_user_email (user_email), ALGORITHM = INPLACE, LOCK = NONE;
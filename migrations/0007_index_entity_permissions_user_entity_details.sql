@@ -0,0 +1,21 @@
+-- indexes of the entity permission and entity user lookups. Databases created before the migrations existed kept
+-- their tables without them, every index is added by its own statement so the ones already there are skipped.
+--
+-- Duplicate permission names within an entity make the unique key fail and have to be renamed by hand first,
+-- they are listed by:
+--
+--     SELECT entity_id, permission_name, GROUP_CONCAT(permission_id) FROM entity_permissions
+--     GROUP BY entity_id, permission_name HAVING COUNT(*) > 1;
+
+ALTER TABLE entity_permissions
+    ADD UNIQUE KEY uq_entity_permissions_entity_name (entity_id, permission_name), ALGORITHM = INPLACE, LOCK = NONE;
+
+ALTER TABLE entity_permissions
+    ADD KEY idx_entity_permissions_entity_active_name (entity_id, active, permission_name),
+    ALGORITHM = INPLACE, LOCK = NONE;
+
+ALTER TABLE user_entity_details
+    ADD KEY idx_user_entity_details_entity_user (entity_id, user_id), ALGORITHM = INPLACE, LOCK = NONE;
+
+ALTER TABLE user_entity_details
+    ADD KEY idx_user_entity_details_permission (permission_id), ALGORITHM = INPLACE, LOCK = NONE;
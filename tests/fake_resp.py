@@ -0,0 +1,106 @@
+import asyncio
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+
+def encode_reply(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, int):
+        return f":{reply}\r\n".encode()
+    if isinstance(reply, str):
+        return f"+{reply}\r\n".encode()
+    if isinstance(reply, list):
+        return f"*{len(reply)}\r\n".encode() + b"".join(encode_reply(item) for item in reply)
+    return f"${len(reply)}\r\n".encode() + reply + b"\r\n"
+
+
+async def read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    args = list()
+    for _ in range(int(line[1:-2])):
+        length = int((await reader.readline())[1:-2])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+class FakeRESPServer:
+    """
+    In-memory server speaking the subset of the Redis protocol RESPCacheBackend uses
+
+    Supports GET, SET with PX, DEL, PUBLISH and SUBSCRIBE. `stop()` closes every connection,
+    which lets tests exercise the fallback to the in-process caches, and replies are held back
+    for `delay` seconds to let them cancel commands in flight.
+    """
+
+    def __init__(self):
+        self.delay = 0.0
+        self.data: Dict[bytes, Tuple[float, bytes]] = {}
+        self.commands: List[List[bytes]] = []
+        self.subscribers: Dict[bytes, List[asyncio.StreamWriter]] = {}
+        self._writers: List[asyncio.StreamWriter] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"redis://{host}:{port}/0"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+
+    async def stop(self):
+        self._server.close()
+        for writer in self._writers:
+            writer.close()
+        await self._server.wait_closed()
+
+    def _get(self, key: bytes) -> Optional[bytes]:
+        entry = self.data.get(key)
+        if entry is None or entry[0] <= monotonic():
+            self.data.pop(key, None)
+            return None
+        return entry[1]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.append(writer)
+        try:
+            while True:
+                args = await read_command(reader)
+                if args is None:
+                    return
+                self.commands.append(args)
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                writer.write(encode_reply(self._execute(args, writer)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for writers in self.subscribers.values():
+                if writer in writers:
+                    writers.remove(writer)
+            writer.close()
+
+    def _execute(self, args: List[bytes], writer: asyncio.StreamWriter):
+        command = args[0].upper()
+        if command == b"GET":
+            return self._get(args[1])
+        if command == b"SET":
+            ttl = int(args[4]) / 1000 if len(args) > 4 and args[3].upper() == b"PX" else float("inf")
+            self.data[args[1]] = (monotonic() + ttl, args[2])
+            return "OK"
+        if command == b"DEL":
+            return sum(1 for key in args[1:] if self.data.pop(key, None) is not None)
+        if command == b"PUBLISH":
+            receivers = self.subscribers.get(args[1], [])
+            for receiver in receivers:
+                receiver.write(encode_reply([b"message", args[1], args[2]]))
+            return len(receivers)
+        if command == b"SUBSCRIBE":
+            self.subscribers.setdefault(args[1], []).append(writer)
+            return [b"subscribe", args[1], 1]
+        return "OK"
+
@@ -0,0 +1,139 @@
+"""
+SharedCache over RESPCacheBackend against an in-memory fake server
+
+    python -m unittest discover tests
+"""
+import asyncio
+import json
+import os
+import unittest
+
+os.environ.setdefault("DB_PORT", "3306")
+
+from app.cache import CacheBackend, RESPCacheBackend, SharedCache, TTLCache, WORKER_ID, auth_token_cache, \
+    consume_invalidations, entity_permission_cache, use_cache_backend  # noqa: E402
+from app.permission_index import PermissionIndex, permission_registry  # noqa: E402
+from app.resp import RESPClient  # noqa: E402
+from tests.fake_resp import FakeRESPServer  # noqa: E402
+
+
+def json_cache(name: str = "test") -> SharedCache:
+    return SharedCache(name, TTLCache(maxsize=16, ttl=60), lambda value: json.dumps(value).encode("utf-8"), json.loads)
+
+
+class RESPCacheBackendTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = FakeRESPServer()
+        await self.server.start()
+        self.backend = RESPCacheBackend(RESPClient(self.server.url, timeout=0.5, retry_interval=0.1))
+
+    async def asyncTearDown(self):
+        use_cache_backend(CacheBackend())
+        for cache in (auth_token_cache, entity_permission_cache):
+            cache.local.clear()
+        self.backend.client.close()
+        await self.server.stop()
+
+    def worker(self, name: str = "test") -> SharedCache:
+        cache = json_cache(name)
+        cache.backend = self.backend
+        return cache
+
+    async def test_value_set_by_one_worker_is_read_by_another(self):
+        writer, reader = self.worker(), self.worker()
+        await writer.set("entity", {"permissions": [1, 2]})
+
+        self.assertIn(b"user_service:cache:test:entity", self.server.data)
+        self.assertEqual(await reader.get("entity"), {"permissions": [1, 2]})
+        # the value read from the backend is kept locally
+        self.assertEqual(reader.local.get("entity"), {"permissions": [1, 2]})
+
+    async def test_entries_expire_with_the_local_ttl(self):
+        cache = self.worker()
+        await cache.set("entity", {"a": 1})
+        set_command = next(command for command in self.server.commands if command[0] == b"SET")
+        self.assertEqual(set_command[3:], [b"PX", b"60000"])
+
+    async def test_undecodable_entries_are_misses(self):
+        reader = self.worker()
+        await self.backend.set("test:entity", b"not json", 60)
+        self.assertIsNone(await reader.get("entity"))
+
+    async def test_user_entries_round_trip_their_permission_index(self):
+        permission_registry.add(1, "user_service", "users", "*")
+        permissions = PermissionIndex({1: 0b11})
+        auth_token_cache.backend = self.backend
+        await auth_token_cache.set("token", {"user_id": "0000000001", "permissions": permissions})
+        auth_token_cache.local.clear()
+
+        user = await auth_token_cache.get("token")
+        self.assertEqual(user["user_id"], "0000000001")
+        self.assertEqual(user["permissions"].to_bits(), permissions.to_bits())
+
+    async def test_invalidate_deletes_and_publishes(self):
+        cache = self.worker()
+        await cache.set("entity", {"a": 1})
+        await cache.invalidate("entity")
+
+        self.assertNotIn(b"user_service:cache:test:entity", self.server.data)
+        self.assertIn(
+            [b"PUBLISH", self.backend.channel.encode(), f"test\t{WORKER_ID}\tentity".encode()], self.server.commands
+        )
+
+    async def test_invalidation_from_another_worker_drops_the_local_entry(self):
+        use_cache_backend(self.backend)
+        entity_permission_cache.local.set("000000000001", [{"permission_id": "00000001"}])
+        version = entity_permission_cache.version("000000000001")
+        task = asyncio.create_task(consume_invalidations(self.backend.client, self.backend.channel))
+        try:
+            while not self.server.subscribers.get(self.backend.channel.encode()):
+                await asyncio.sleep(0.01)
+            await self.backend.publish(f"entity_permission\t{WORKER_ID}\t000000000001")
+            await self.backend.publish("entity_permission\tother-worker\t000000000001")
+            while entity_permission_cache.version("000000000001") == version:
+                await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+
+        # the message published by this worker was skipped, the other one bumped the version once
+        self.assertEqual(entity_permission_cache.version("000000000001"), version + 1)
+        self.assertIsNone(entity_permission_cache.local.get("000000000001"))
+
+    async def test_unreachable_backend_falls_back_to_the_local_cache(self):
+        cache = self.worker()
+        await self.server.stop()
+
+        await cache.set("entity", {"a": 1})
+        self.assertEqual(await cache.get("entity"), {"a": 1})
+        self.assertIsNone(await cache.get("missing"))
+        await cache.invalidate("entity")
+        self.assertIsNone(await cache.get("entity"))
+        self.assertFalse(self.backend.available)
+
+    async def test_cancelled_command_does_not_leave_its_reply_to_the_next_one(self):
+        client = self.backend.client
+        await client.execute("SET", "first", b"1")
+        await client.execute("SET", "second", b"2")
+
+        self.server.delay = 0.1
+        task = asyncio.create_task(client.execute("GET", "first"))
+        while [b"GET", b"first"] not in self.server.commands:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        self.server.delay = 0.0
+        self.assertEqual(await client.execute("GET", "second"), b"2")
+        self.assertTrue(client.available)
+
+    async def test_values_are_not_encoded_without_a_shared_backend(self):
+        cache = SharedCache("test", TTLCache(maxsize=16, ttl=60), lambda value: 1 / 0, json.loads)
+        await cache.set("entity", None)
+        await cache.set("other", {"a": 1})
+        self.assertEqual(await cache.get("other"), {"a": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+TokenWriteBehind journal replay across restarts
+
+    python -m unittest discover tests
+"""
+import asyncio
+import os
+import tempfile
+import unittest
+
+os.environ.setdefault("DB_PORT", "3306")
+
+from app.write_behind import TokenWriteBehind  # noqa: E402
+
+
+class TokenWriteBehindTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal_path = os.path.join(self.directory.name, "tokens.journal")
+        # user_id -> token as stored in user_details, None once logged out
+        self.stored = {}
+        self.flushed_batches = []
+
+    async def asyncTearDown(self):
+        self.directory.cleanup()
+
+    async def flush_fn(self, tokens: dict) -> bool:
+        self.flushed_batches.append(dict(tokens))
+        self.stored.update(tokens)
+        return True
+
+    async def start(self) -> TokenWriteBehind:
+        write_behind = TokenWriteBehind(self.journal_path, max_delay=60, batch_size=100)
+        await write_behind.start(self.flush_fn)
+        return write_behind
+
+    async def test_flushed_token_is_not_replayed_after_logout(self):
+        write_behind = await self.start()
+
+        # the flush starts before the journal record of its token was written
+        recorded = asyncio.create_task(write_behind.record("0000000001", "token-1"))
+        await asyncio.sleep(0)
+        self.assertTrue(await write_behind.flush())
+        await recorded
+        self.assertEqual(self.stored, {"0000000001": "token-1"})
+
+        # logout clears the stored token directly, the user has nothing pending anymore
+        await write_behind.discard("0000000001")
+        self.stored["0000000001"] = None
+        await write_behind.stop()
+
+        self.flushed_batches.clear()
+        restarted = await self.start()
+        await restarted.stop()
+        self.assertEqual(self.flushed_batches, [])
+        self.assertIsNone(self.stored["0000000001"])
+
+    async def test_tokens_recorded_while_flushing_are_replayed(self):
+        write_behind = await self.start()
+        await write_behind.record("0000000001", "token-1")
+
+        flushing = asyncio.Event()
+        release = asyncio.Event()
+
+        async def slow_flush_fn(tokens: dict) -> bool:
+            flushing.set()
+            await release.wait()
+            return await self.flush_fn(tokens)
+
+        write_behind._flush_fn = slow_flush_fn
+        flush = asyncio.create_task(write_behind.flush())
+        await flushing.wait()
+        await write_behind.record("0000000002", "token-2")
+        release.set()
+        self.assertTrue(await flush)
+
+        # the process dies before the second token is flushed
+        write_behind._task.cancel()
+        await write_behind.journal.close()
+
+        restarted = await self.start()
+        await restarted.stop()
+        self.assertEqual(self.stored, {"0000000001": "token-1", "0000000002": "token-2"})
+        self.assertEqual(self.flushed_batches[-1], {"0000000002": "token-2"})
+
+
+if __name__ == "__main__":
+    unittest.main()